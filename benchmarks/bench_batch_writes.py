@@ -0,0 +1,60 @@
+"""
+Time adding a long thread of messages one insert_message at a time, inside
+one transaction(), and with insert_messages, and check that a unit of work
+that fails midway leaves nothing behind.
+
+Run from the repository root:
+    python -m benchmarks.bench_batch_writes [messages]
+"""
+import os
+import sys
+import time
+import tempfile
+import db_setup
+from db import database
+
+def rows(count):
+    return [('user' if i % 2 == 0 else 'assistant', f"Message {i} of a long thread " * 8) for i in range(count)]
+
+def timed(name, write, count):
+    conversation_id = database.insert_conversation(title=name)
+    start = time.perf_counter()
+    write(conversation_id, rows(count))
+    elapsed = (time.perf_counter() - start) * 1000
+    assert database.get_message_count(conversation_id) == count
+    print(f"{name:<32} {elapsed:9.1f} ms   {elapsed * 1000 / count:7.1f} us/message")
+
+def one_by_one(conversation_id, messages):
+    for role, text in messages:
+        database.insert_message(conversation_id, role, text)
+
+def one_transaction(conversation_id, messages):
+    with database.transaction():
+        one_by_one(conversation_id, messages)
+
+def main(count=400):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    database.DB_PATH = db_path
+    db_setup.init_db(db_path)
+    # Commit durability as on a real disk: fsync on every commit
+    database.get_connection().execute("PRAGMA synchronous=FULL")
+
+    print(f"{count} messages, synchronous=FULL")
+    timed("insert_message per row", one_by_one, count)
+    timed("insert_message in transaction()", one_transaction, count)
+    timed("insert_messages", database.insert_messages, count)
+
+    before = database.get_connection().execute("SELECT count(*) FROM conversations").fetchone()[0]
+    try:
+        with database.transaction():
+            conversation_id = database.insert_conversation(title="Half written")
+            database.insert_messages(conversation_id, rows(count // 2))
+            raise RuntimeError("crash midway")
+    except RuntimeError:
+        pass
+    after = database.get_connection().execute("SELECT count(*) FROM conversations").fetchone()[0]
+    print(f"failed unit of work left {after - before} conversations behind")
+    database.close_connections()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,77 @@
+"""
+Time how long the calling thread (the GUI, in the app) is held up storing
+messages: committing each insert_message itself, against queueing it on the
+write-behind DatabaseWriter. Also checks that concurrent writers' messages
+keep their order per conversation, and how many commits the writes took.
+
+Run from the repository root; set TMPDIR to put the database on the disk
+you care about (fsync on tmpfs is free):
+    python -m benchmarks.bench_db_writer [messages] [threads]
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+import db_setup
+from db import database
+from db.writer import DatabaseWriter
+
+def report(name, latencies, total):
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<28} caller p50 {p50:7.1f} us   p99 {p99:8.1f} us   all stored after {total:7.1f} ms")
+
+def main(count=2000, threads=4):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    database.DB_PATH = db_path
+    # fsync on every commit, as a laptop disk with synchronous=FULL would
+    database.CONNECTION_PRAGMAS = database.CONNECTION_PRAGMAS + ("PRAGMA synchronous=FULL",)
+    db_setup.init_db(db_path)
+    conversation_id = database.insert_conversation(title="Benchmark")
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        call = time.perf_counter()
+        database.insert_message(conversation_id, "user", f"Message {i}")
+        latencies.append((time.perf_counter() - call) * 1e6)
+    report("insert_message, own commit", latencies, (time.perf_counter() - start) * 1000)
+
+    writer = DatabaseWriter()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        call = time.perf_counter()
+        writer.submit(database.insert_message, conversation_id, "user", f"Message {i}")
+        latencies.append((time.perf_counter() - call) * 1e6)
+    writer.flush()
+    report("DatabaseWriter.submit", latencies, (time.perf_counter() - start) * 1000)
+    stats = writer.stats()
+    print(f"{'':<28} {stats['writes']} writes in {stats['commits']} commits")
+
+    # Several threads at once, e.g. replies finishing in different branches
+    conversations = [database.insert_conversation(title=f"Thread {t}") for t in range(threads)]
+    futures = {conversation: [] for conversation in conversations}
+
+    def produce(conversation):
+        for i in range(count // threads):
+            futures[conversation].append(writer.submit(database.insert_message, conversation, "user", str(i)))
+    workers = [threading.Thread(target=produce, args=(conversation,)) for conversation in conversations]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    writer.flush()
+    in_order = all(
+        [future.result() for future in futures[conversation]] == sorted(future.result() for future in futures[conversation])
+        and [text for _, _, text in database.get_conversation_rows(conversation)] == [str(i) for i in range(count // threads)]
+        for conversation in conversations)
+    print(f"{threads} threads writing at once: per-conversation order kept: {in_order}")
+
+    writer.shutdown()
+    database.close_connections()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
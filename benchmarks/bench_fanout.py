@@ -0,0 +1,61 @@
+"""
+Time sending one question to several branches: one blocking request after
+another, against the asyncio client's bounded fan-out. The stub server waits
+before each reply, like the real API spending time on generation.
+
+Run from the repository root:
+    python -m benchmarks.bench_fanout [branches] [delay_ms]
+"""
+import sys
+import time
+import asyncio
+from utils import api_client, async_api_client
+from benchmarks.stub_server import StubHandler, start_stub_server
+
+QUESTION = "How do I reverse a list in Python?"
+
+class SlowHandler(StubHandler):
+    """Stub that waits before answering"""
+    delay = 0.2
+
+    def do_POST(self):
+        time.sleep(SlowHandler.delay)
+        super().do_POST()
+
+def histories(branches):
+    # Each branch has its own history before the shared question
+    return [[{"role": "user", "content": f"Branch {i} context"},
+             {"role": "assistant", "content": f"Branch {i} answer"},
+             {"role": "user", "content": QUESTION}] for i in range(branches)]
+
+def timed(call):
+    start = time.perf_counter()
+    call()
+    return (time.perf_counter() - start) * 1000
+
+def main(branches=8, delay_ms=200):
+    SlowHandler.delay = delay_ms / 1000
+    server, url = start_stub_server(SlowHandler)
+    api_client.API_URL = url
+
+    def sequential():
+        for history in histories(branches):
+            "".join(api_client.stream_chat_response(history))
+
+    async def stream(client, history):
+        return "".join([delta async for delta in async_api_client.stream_chat_response(client, history)])
+
+    async def fan_out():
+        async with async_api_client.create_client() as client:
+            results = await async_api_client.gather_bounded(stream(client, history) for history in histories(branches))
+            assert not any(isinstance(result, Exception) for result in results), results
+
+    print(f"{branches} branches, {delay_ms} ms per reply")
+    print(f"{'sequential (requests)':<24} {timed(sequential):8.1f} ms")
+    print(f"{'fan-out (asyncio)':<24} {timed(lambda: asyncio.run(fan_out())):8.1f} ms"
+          f"   (at most {async_api_client.MAX_CONCURRENT_ASYNC_REQUESTS} at once)")
+    server.shutdown()
+    api_client.close_session()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
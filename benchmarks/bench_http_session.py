@@ -0,0 +1,55 @@
+"""
+Compare per-request latency of a fresh connection per call against the shared
+keep-alive session in utils.api_client.
+
+Run from the repository root:
+    python -m benchmarks.bench_http_session [requests]
+"""
+import sys
+import time
+import requests
+from utils import api_client
+from benchmarks.stub_server import start_stub_server
+
+HISTORY = [{"role": "user", "content": "How do I reverse a list in Python?"}]
+
+def time_calls(call, count):
+    """Return per-call latencies in milliseconds"""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+def report(name, latencies):
+    mean = sum(latencies) / len(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<24} mean {mean:7.3f} ms   p50 {p50:7.3f} ms   p95 {p95:7.3f} ms")
+
+def main(count=500):
+    server, url = start_stub_server()
+    api_client.API_URL = url
+
+    def fresh_connection():
+        # What every call did before the shared session existed
+        response = requests.post(url, json={"model": "gpt-3.5-turbo", "messages": HISTORY})
+        response.json()
+
+    def shared_session():
+        api_client.get_chat_response(HISTORY)
+
+    # Warm up both paths so imports and the pool don't skew the first sample
+    fresh_connection()
+    shared_session()
+
+    print(f"{count} requests against {url}")
+    report("requests.post", time_calls(fresh_connection, count))
+    report("shared session", time_calls(shared_session, count))
+
+    api_client.close_session()
+    server.shutdown()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
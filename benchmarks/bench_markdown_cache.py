@@ -0,0 +1,98 @@
+"""
+Time opening a conversation of code-heavy messages with the markdown render
+cache cold and warm: how long the GUI thread is busy, and how long until
+every code block has been highlighted by the render pool.
+
+Run from the repository root (no display needed):
+    python -m benchmarks.bench_markdown_cache [messages]
+"""
+import os
+import sys
+import time
+import tempfile
+import markdown
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import db_setup
+from db import database
+from db.writer import get_writer, shutdown_writer
+from utils import markdown_renderer
+
+CODE_MESSAGE = """Here is version {i} of the helper:
+
+```python
+def merge_sorted(left, right):
+    result = []
+    while left and right:
+        result.append(left.pop(0) if left[0] <= right[0] else right.pop(0))
+    return result + left + right  # attempt {i}
+```
+
+| input | output |
+|-------|--------|
+| [1, 3] and [2] | [1, 2, 3] |
+"""
+
+def seed(message_count):
+    conversation_id = database.insert_conversation(title="Benchmark")
+    database.insert_messages(conversation_id, [('user' if i % 2 == 0 else 'assistant', CODE_MESSAGE.format(i=i))
+                                               for i in range(message_count)])
+    return conversation_id
+
+def open_tab(app, conversation_id):
+    from ui import main_window
+    start = time.perf_counter()
+    tab = main_window.ChatTab("Benchmark", conversation_id=conversation_id)
+    blocked = (time.perf_counter() - start) * 1000
+    # Deliver the background renders and swap them into the chat log
+    while tab.markdown_renderer.busy():
+        app.processEvents()
+        time.sleep(0.001)
+    app.processEvents()
+    return blocked, (time.perf_counter() - start) * 1000
+
+def main(message_count=500):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    database.DB_PATH = db_path
+    db_setup.init_db(db_path)
+    conversation_id = seed(message_count)
+    texts = [text for _, _, text in database.get_conversation_rows(conversation_id)]
+
+    from PyQt5.QtWidgets import QApplication
+    from ui import main_window
+    app = QApplication.instance() or QApplication(sys.argv)
+    # Render the whole conversation when the tab opens, not just the latest page
+    main_window.HISTORY_PAGE_SIZE = message_count
+
+    extensions = ['markdown.extensions.fenced_code', 'markdown.extensions.codehilite',
+                  'markdown.extensions.tables', 'markdown.extensions.nl2br']
+    start = time.perf_counter()
+    for text in texts:
+        markdown.markdown(text, extensions=extensions)
+    uncached = (time.perf_counter() - start) * 1000
+
+    # Start the render workers up front so the cold run doesn't time process startup
+    markdown_renderer.get_render_pool().submit(markdown_renderer.render_markdown, extensions, "").result()
+
+    cold = open_tab(app, conversation_id)
+    warm_memory = open_tab(app, conversation_id)
+    # A fresh process: empty in-memory LRU, rendered HTML still in chat.db
+    get_writer().flush()
+    markdown_renderer._renderers.clear()
+    warm_disk = open_tab(app, conversation_id)
+
+    print(f"{message_count} code-heavy messages")
+    print(f"{'':<36}{'GUI thread':>12}{'highlighted':>14}")
+    print(f"{'markdown.markdown per message':<36}{uncached:>9.1f} ms{uncached:>11.1f} ms")
+    for label, (blocked, highlighted) in [("open tab, cold cache", cold),
+                                          ("open tab, warm on-disk cache", warm_disk),
+                                          ("open tab, warm in-memory cache", warm_memory)]:
+        print(f"{label:<36}{blocked:>9.1f} ms{highlighted:>11.1f} ms")
+
+    markdown_renderer.shutdown_render_pool()
+    shutdown_writer()
+    database.close_connections()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
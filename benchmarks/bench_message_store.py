@@ -0,0 +1,152 @@
+"""
+Report the on-disk size of a seeded branching corpus as the schema moved from
+copied branches (version 1) to fork pointers (version 8) to shared,
+compressed message bodies (version 9), and time reading history pages.
+
+The corpus mimics heavy branching: long assistant replies with code, the
+same prompt sent to every branch of a conversation, and replies restored
+from the response cache.
+
+Run from the repository root:
+    python -m benchmarks.bench_message_store [conversations] [branches]
+"""
+import os
+import sys
+import time
+import random
+import itertools
+import sqlite3
+import tempfile
+import db_setup
+from db import database
+
+WORDS = [''.join(random.Random(i).choices("abcdefghijklmnopqrstuvwxyz", k=random.Random(-i).randint(2, 9)))
+         for i in range(3000)]
+# Word frequencies in natural text fall off as 1/rank (Zipf)
+WORD_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+CODE = """```python
+def {name}(items, key=None):
+    \"\"\"Sort items by key and drop duplicates\"\"\"
+    seen = set()
+    result = []
+    for item in sorted(items, key=key):
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+```
+"""
+
+def prose(rng, words):
+    return " ".join(rng.choices(WORDS, cum_weights=WORD_WEIGHTS, k=words)).capitalize() + "."
+
+def reply(rng):
+    parts = [prose(rng, rng.randint(40, 160))]
+    if rng.random() < 0.6:
+        parts.append(CODE.format(name=f"{rng.choice(WORDS)}_{rng.choice(WORDS)}"))
+        parts.append(prose(rng, rng.randint(20, 80)))
+    return "\n\n".join(parts)
+
+def seed_copied(conn, conversations, branches, rng):
+    """Version 1 layout: each branch starts with a copy of its parent's history"""
+    def add(conversation_id, rows):
+        conn.executemany("INSERT INTO messages (conversation_id, role, message_text) VALUES (?, ?, ?)",
+                         [(conversation_id, role, text) for role, text in rows])
+
+    for c in range(conversations):
+        root_id = conn.execute("INSERT INTO conversations (title) VALUES (?)", (f"Conversation {c}",)).lastrowid
+        history = []
+        for _ in range(rng.randint(10, 30)):
+            history += [("user", prose(rng, rng.randint(5, 40))), ("assistant", reply(rng))]
+        add(root_id, history)
+        # "Send to All" prompts: the same question asked in every branch
+        shared_prompts = [prose(rng, rng.randint(60, 120)) for _ in range(3)]
+        cached_replies = [reply(rng) for _ in range(3)]
+        for b in range(branches):
+            branch_id = conn.execute("INSERT INTO conversations (parent_id, title) VALUES (?, ?)",
+                                     (root_id, f"Branch {b}")).lastrowid
+            rows = list(history)
+            for prompt, cached in zip(shared_prompts, cached_replies):
+                # Some replies come back from the response cache word for word
+                rows += [("user", prompt), ("assistant", cached if rng.random() < 0.3 else reply(rng))]
+            for _ in range(rng.randint(2, 6)):
+                rows += [("user", prose(rng, rng.randint(5, 40))), ("assistant", reply(rng))]
+            add(branch_id, rows)
+    conn.commit()
+
+def file_size(db_path):
+    """(file size, bytes used by message text, bytes used by the search index) after a VACUUM"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("VACUUM")
+    page_count, page_size = conn.execute("PRAGMA page_count").fetchone()[0], conn.execute("PRAGMA page_size").fetchone()[0]
+    text, index = conn.execute(
+        "SELECT SUM(CASE WHEN name IN ('messages', 'message_bodies') THEN pgsize END), "
+        "SUM(CASE WHEN name LIKE 'messages_fts%' THEN pgsize END) FROM dbstat").fetchone()
+    conn.close()
+    return page_count * page_size, text, index or 0
+
+def time_pages(conversation_ids, shared_bodies):
+    """Mean ms to read the newest 50 messages of each conversation"""
+    conn = database.get_connection()
+    start = time.perf_counter()
+    for conversation_id in conversation_ids:
+        if shared_bodies:
+            database.with_bodies(conn.execute(
+                "SELECT id, role, message_text, body_id FROM messages "
+                "WHERE conversation_id = ? ORDER BY id DESC LIMIT 50", (conversation_id,)).fetchall())
+        else:
+            conn.execute("SELECT id, role, message_text FROM messages "
+                         "WHERE conversation_id = ? ORDER BY id DESC LIMIT 50", (conversation_id,)).fetchall()
+    return (time.perf_counter() - start) * 1000 / len(conversation_ids)
+
+def main(conversations=40, branches=8):
+    rng = random.Random(7)
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    db_setup.init_db(db_path, target_version=1)
+    conn = sqlite3.connect(db_path)
+    seed_copied(conn, conversations, branches, rng)
+    message_count, text_bytes = conn.execute(
+        "SELECT COUNT(*), SUM(length(CAST(message_text AS BLOB))) FROM messages").fetchone()
+    conn.close()
+    sizes = [("v1, copied branches", file_size(db_path))]
+
+    db_setup.init_db(db_path, target_version=8)
+    sizes.append(("v8, fork pointers", file_size(db_path)))
+    database.DB_PATH = db_path
+    ids = [row[0] for row in database.get_connection().execute("SELECT id FROM conversations")]
+    before = time_pages(ids, False)
+    database.close_connections()
+
+    start = time.perf_counter()
+    db_setup.init_db(db_path)
+    migration = (time.perf_counter() - start) * 1000
+    sizes.append(("v9, shared compressed bodies", file_size(db_path)))
+
+    conn = database.get_connection()
+    stored, inline = conn.execute(
+        "SELECT COUNT(body_id), COUNT(message_text) FROM messages").fetchone()
+    bodies, body_bytes, compressed_bytes = conn.execute(
+        "SELECT COUNT(*), SUM(size), SUM(length(body)) FROM message_bodies").fetchone()
+    database._body_cache.clear()
+    cold = time_pages(ids, True)
+    # Reopening the conversations used most recently, which fit in the LRU
+    recent = ids[-10:]
+    time_pages(recent, True)
+    warm = time_pages(recent, True)
+
+    print(f"{conversations} conversations x {branches} branches, "
+          f"{message_count} messages as copied, {text_bytes / 1e6:.1f} MB of text")
+    print(f"{'':<32} {'file':>11} {'':>12} {'messages':>11} {'search index':>14}")
+    for label, (size, text, index) in sizes:
+        print(f"{label:<32} {size / 1e6:8.2f} MB {size / sizes[0][1][0]:6.1%} of v1 "
+              f"{text / 1e6:8.2f} MB {index / 1e6:11.2f} MB")
+    print(f"v8 -> v9: file {1 - sizes[2][1][0] / sizes[1][1][0]:.1%} smaller, "
+          f"message storage {1 - sizes[2][1][1] / sizes[1][1][1]:.1%} smaller; migration took {migration:.0f} ms")
+    print(f"{stored} messages share {bodies} bodies ({stored / max(bodies, 1):.2f} per body), {inline} short ones inline")
+    print(f"bodies: {body_bytes / 1e6:.2f} MB of text in {compressed_bytes / 1e6:.2f} MB "
+          f"({compressed_bytes / body_bytes:.1%})")
+    print(f"history page of 50: {before:.2f} ms at v8, {cold:.2f} ms at v9 cold, {warm:.2f} ms at v9 reopened (LRU)")
+    database.close_connections()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
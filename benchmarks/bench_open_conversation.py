@@ -0,0 +1,72 @@
+"""
+Time opening a conversation with many branches in ChatWindow, and count the
+SQL statements it runs, with branch tabs loaded lazily (the default) and
+with every tab loaded up front.
+
+Run from the repository root (no display needed):
+    python -m benchmarks.bench_open_conversation [branches] [messages per branch]
+"""
+import os
+import sys
+import time
+import tempfile
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import db_setup
+from db import database
+
+def seed(branch_count, messages_per_branch):
+    root_id = database.insert_conversation(title="Benchmark")
+    ids = database.insert_messages(root_id, [('user' if i % 2 == 0 else 'assistant',
+                                              f"Root message {i} with **some** markdown")
+                                             for i in range(messages_per_branch)])
+    last_id = ids[-1] if ids else None
+    for b in range(branch_count):
+        branch_id = database.insert_conversation(parent_id=root_id, title=f"Branch {b}", fork_message_id=last_id)
+        database.insert_messages(branch_id, [('user' if i % 2 == 0 else 'assistant',
+                                              f"Branch {b} message {i} with *some* markdown")
+                                             for i in range(messages_per_branch)])
+    return root_id
+
+def open_conversation(window, root_id, load_all):
+    statements = []
+    database.get_connection().set_trace_callback(statements.append)
+    start = time.perf_counter()
+    tab_widget = window.show_conversation(root_id)
+    if load_all:
+        for index in range(tab_widget.count()):
+            window.load_branch_tab(tab_widget, index)
+    elapsed = (time.perf_counter() - start) * 1000
+    database.get_connection().set_trace_callback(None)
+    return elapsed, len(statements)
+
+def main(branch_count=30, messages_per_branch=50):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    database.DB_PATH = db_path
+    db_setup.init_db(db_path)
+    root_id = seed(branch_count, messages_per_branch)
+
+    from PyQt5.QtWidgets import QApplication
+    import main as chat_app
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    print(f"Conversation with {branch_count} branches of {messages_per_branch} messages")
+    print(f"{'':<28}{'ms':>10}{'statements':>12}")
+    for label, load_all in [("open, lazy branch tabs", False), ("open, every tab loaded", True)]:
+        # Warm the render cache so both runs time the tabs, not markdown
+        open_conversation(chat_app.ChatWindow(), root_id, load_all=True)
+        elapsed, statements = open_conversation(chat_app.ChatWindow(), root_id, load_all)
+        print(f"{label:<28}{elapsed:>10.1f}{statements:>12}")
+
+    window = chat_app.ChatWindow()
+    tab_widget = window.show_conversation(root_id)
+    start = time.perf_counter()
+    tab_widget.setCurrentIndex(branch_count // 2)
+    print(f"{'first select of a branch':<28}{(time.perf_counter() - start) * 1000:>10.1f}")
+
+    database.close_connections()
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
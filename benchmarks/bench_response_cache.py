@@ -0,0 +1,64 @@
+"""
+Time repeated identical API calls with the response cache off and on, and
+print the cache's hit/miss stats. Requests go to the local stub server.
+
+Run from the repository root:
+    python -m benchmarks.bench_response_cache [calls]
+"""
+import os
+import sys
+import tempfile
+import db_setup
+from db import database
+from utils import api_client, response_cache
+from benchmarks.stub_server import StubHandler, start_stub_server
+from benchmarks.bench_http_session import time_calls
+
+HISTORY = [{"role": "user", "content": "How do I reverse a list in Python?"}]
+
+class CountingHandler(StubHandler):
+    """Stub that counts the requests that actually reach it"""
+    requests_served = 0
+
+    def do_POST(self):
+        CountingHandler.requests_served += 1
+        super().do_POST()
+
+def report(name, latencies):
+    mean = sum(latencies) / len(latencies)
+    p50 = latencies[len(latencies) // 2]
+    print(f"{name:<30} mean {mean * 1000:9.1f} us   p50 {p50 * 1000:9.1f} us")
+
+def main(count=500):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    database.DB_PATH = db_path
+    db_setup.init_db(db_path)
+    server, url = start_stub_server(CountingHandler)
+    api_client.API_URL = url
+
+    response_cache.RESPONSE_CACHE_ENABLED = False
+    report("cache off", time_calls(lambda: api_client.get_chat_response(HISTORY), count))
+    served_uncached = CountingHandler.requests_served
+
+    response_cache.RESPONSE_CACHE_ENABLED = True
+    cache = response_cache.get_response_cache()
+    api_client.get_chat_response(HISTORY)  # The one miss that fills the cache
+    report("cache on, memory hit", time_calls(lambda: api_client.get_chat_response(HISTORY), count))
+
+    def database_hit():
+        cache._memory.clear()  # As after a restart: only the table has the entry
+        api_client.get_chat_response(HISTORY)
+    report("cache on, database hit", time_calls(database_hit, count))
+
+    def streamed():
+        "".join(api_client.stream_chat_response(HISTORY))
+    report("cache on, streamed reply", time_calls(streamed, count))
+
+    print(f"requests sent: {served_uncached} with the cache off, "
+          f"{CountingHandler.requests_served - served_uncached} with it on")
+    print("stats:", cache.stats())
+    server.shutdown()
+    database.close_connections()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
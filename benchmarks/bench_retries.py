@@ -0,0 +1,165 @@
+"""
+Send chat requests to a stub server that injects 429s, 5xx and dropped
+connections, with retries off and on. Prints how many calls succeeded, the
+typed errors the rest raised, and the latency retries add.
+
+With --check it instead serves scripted failures and asserts how they are
+handled, through both the requests and the asyncio client: Retry-After and
+rate limit headers are waited out, non-retryable errors raise their
+APIError subclass at once, running out of retries raises the last error,
+and malformed replies raise APIResponseError. It exits non-zero on the
+first check that fails.
+
+Run from the repository root:
+    python -m benchmarks.bench_retries [calls] [failure_percent]
+    python -m benchmarks.bench_retries --check
+"""
+import sys
+import time
+import asyncio
+from collections import Counter
+from utils import api_client, async_api_client
+from utils.api_client import (RequestScheduler, APIError, RateLimitError, QuotaExceededError,
+                              ServerError, APIResponseError, parse_stream_line)
+from benchmarks.stub_server import FlakyHandler, start_stub_server
+
+HISTORY = [{"role": "user", "content": "How do I reverse a list in Python?"}]
+
+def run(name, call, count):
+    errors = Counter()
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            call()
+        except APIError as e:
+            errors[type(e).__name__] += 1
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    ok = count - sum(errors.values())
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<28} ok {ok:4}/{count}   p50 {p50:7.2f} ms   p95 {p95:7.2f} ms   {dict(errors) or ''}")
+
+def main(count=300, failure_percent=30):
+    FlakyHandler.failure_rate = failure_percent / 100
+    server, url = start_stub_server(FlakyHandler)
+    api_client.API_URL = url
+
+    def streamed():
+        "".join(api_client.stream_chat_response(HISTORY))
+
+    print(f"{failure_percent}% of attempts fail")
+    api_client._scheduler = RequestScheduler(max_retries=0, backoff_base=0.01)
+    run("no retries", lambda: api_client.get_chat_response(HISTORY), count)
+    api_client._scheduler = scheduler = RequestScheduler(backoff_base=0.01)
+    run("retries", lambda: api_client.get_chat_response(HISTORY), count)
+    run("retries, streamed", streamed, count)
+
+    async def async_calls():
+        async with async_api_client.create_client() as client:
+            return await async_api_client.gather_bounded(
+                async_api_client.get_chat_response(client, HISTORY) for _ in range(count))
+    start = time.perf_counter()
+    results = asyncio.run(async_calls())
+    failed = Counter(type(result).__name__ for result in results if isinstance(result, Exception))
+    print(f"{'retries, async fan-out':<28} ok {count - sum(failed.values()):4}/{count}   "
+          f"total {(time.perf_counter() - start) * 1000:7.1f} ms   {dict(failed) or ''}")
+
+    print("scheduler:", scheduler.stats())
+    print("server saw:", dict(FlakyHandler.counts))
+    server.shutdown()
+    api_client.close_session()
+
+def clients():
+    """(name, call) for each way of sending a request; call returns the reply or the APIError raised"""
+    async def async_call(request):
+        async with async_api_client.create_client() as client:
+            if request == "stream":
+                return "".join([delta async for delta in async_api_client.stream_chat_response(client, HISTORY)])
+            return await async_api_client.get_chat_response(client, HISTORY)
+
+    def outcome(call):
+        try:
+            return call()
+        except APIError as e:
+            return e
+
+    return [
+        ("requests", lambda: outcome(lambda: api_client.get_chat_response(HISTORY))),
+        ("requests, streamed", lambda: outcome(lambda: "".join(api_client.stream_chat_response(HISTORY)))),
+        ("asyncio", lambda: outcome(lambda: asyncio.run(async_call("chat")))),
+        ("asyncio, streamed", lambda: outcome(lambda: asyncio.run(async_call("stream")))),
+    ]
+
+def scripted(call, script, retry_after="0", **scheduler_args):
+    """Serve script's outcomes, then successes, to one call; returns (result, seconds, attempts, scheduler)"""
+    FlakyHandler.script[:] = script
+    FlakyHandler.retry_after = retry_after
+    FlakyHandler.counts.clear()
+    api_client._scheduler = scheduler = RequestScheduler(
+        requests_per_minute=0, tokens_per_minute=0, backoff_base=0.001, **scheduler_args)
+    start = time.perf_counter()
+    result = call()
+    return result, time.perf_counter() - start, sum(FlakyHandler.counts.values()), scheduler
+
+def check():
+    FlakyHandler.failure_rate = 0
+    server, url = start_stub_server(FlakyHandler)
+    api_client.API_URL = url
+    expected = f"Echo: {HISTORY[-1]['content']}"
+
+    def passed(name, condition, detail):
+        assert condition, f"{name}: {detail}"
+        print(f"ok  {name}")
+
+    try:
+        for line in ('data: {"choices": [', 'data: [1]', 'data: {"choices": [1]}'):
+            try:
+                parse_stream_line(line)
+            except APIResponseError:
+                continue
+            raise AssertionError(f"parse_stream_line({line!r}) did not raise APIResponseError")
+        print("ok  malformed stream lines raise APIResponseError")
+
+        for client, call in clients():
+            result, seconds, attempts, _ = scripted(call, [429], retry_after="0.3")
+            passed(f"{client}: 429 waits out Retry-After",
+                   str(result).strip() == expected and seconds >= 0.3 and attempts == 2,
+                   f"{result!r} after {seconds:.3f}s and {attempts} attempts")
+
+            # The 429 also says no requests are left for 20ms; the retry waits for the bucket
+            result, seconds, attempts, scheduler = scripted(call, [429])
+            throttled = scheduler.stats()["throttle_seconds"]
+            passed(f"{client}: rate limit headers hold the retry back",
+                   str(result).strip() == expected and throttled >= 0.015 and seconds >= 0.015,
+                   f"{result!r}, throttled {throttled:.3f}s")
+
+            for script, error_type in (([400], APIError), (["quota"], QuotaExceededError)):
+                result, seconds, attempts, _ = scripted(call, script)
+                passed(f"{client}: {script[0]} raises {error_type.__name__} without retrying",
+                       type(result) is error_type and attempts == 1,
+                       f"{result!r} after {attempts} attempts")
+
+            result, seconds, attempts, scheduler = scripted(call, [503, 429, 503], max_retries=2)
+            passed(f"{client}: running out of retries raises the last error",
+                   type(result) is ServerError and result.status == 503 and attempts == 3
+                   and scheduler.stats()["failures"] == 1,
+                   f"{result!r} after {attempts} attempts")
+
+            result, seconds, attempts, _ = scripted(call, [429, 429], max_retries=1)
+            passed(f"{client}: the last error keeps its type",
+                   type(result) is RateLimitError and attempts == 2, f"{result!r} after {attempts} attempts")
+
+            result, seconds, attempts, _ = scripted(call, ["garbled"])
+            passed(f"{client}: a malformed reply raises APIResponseError",
+                   type(result) is APIResponseError and attempts == 1, f"{result!r} after {attempts} attempts")
+    finally:
+        server.shutdown()
+        api_client.close_session()
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--check"]:
+        check()
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,102 @@
+"""
+Seed a large chat database and time the common lookups before and after the
+index and message_count migrations in db_setup.
+
+Run from the repository root:
+    python -m benchmarks.bench_schema [messages] [conversations]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import db_setup
+from db import database
+
+# (label, query used before the indexes/counters, db/database.py function after)
+LOOKUPS = [
+    ("get_message_count",
+     "SELECT COUNT(*) FROM messages WHERE conversation_id = ?",
+     database.get_message_count),
+    ("get_branches_for_conversation",
+     "SELECT id, title FROM conversations WHERE parent_id = ? ORDER BY created_at",
+     database.get_branches_for_conversation),
+    ("latest history page",
+     "SELECT role, message_text FROM messages WHERE conversation_id = ? ORDER BY timestamp",
+     lambda conversation_id: database.get_conversation_page(conversation_id, 50)),
+]
+
+def seed(db_path, message_count, conversation_count):
+    """Create conversations with a few branches each and spread messages over them"""
+    random.seed(42)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conversations = []
+    for i in range(conversation_count):
+        if conversations and random.random() < 0.3:
+            parent_id = random.choice(conversations)
+        else:
+            parent_id = None
+        cursor = conn.execute("INSERT INTO conversations (parent_id, title) VALUES (?, ?)",
+                              (parent_id, f"Conversation {i}"))
+        conversations.append(cursor.lastrowid)
+
+    def rows():
+        for i in range(message_count):
+            role = 'user' if i % 2 == 0 else 'assistant'
+            yield (random.choice(conversations), role, f"Message {i} " + "lorem ipsum " * 20)
+
+    conn.executemany("INSERT INTO messages (conversation_id, role, message_text) VALUES (?, ?, ?)", rows())
+    conn.commit()
+    conn.close()
+    return conversations
+
+def time_lookup(lookup, conversation_ids):
+    start = time.perf_counter()
+    for conversation_id in conversation_ids:
+        lookup(conversation_id)
+    return (time.perf_counter() - start) * 1000 / len(conversation_ids)
+
+def main(message_count=1_000_000, conversation_count=20_000, samples=200):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    database.DB_PATH = db_path
+
+    # Schema as it was before the indexes and counters (migrations 1-2)
+    db_setup.init_db(db_path, target_version=2)
+    start = time.perf_counter()
+    conversations = seed(db_path, message_count, conversation_count)
+    print(f"Seeded {message_count} messages in {conversation_count} conversations "
+          f"in {time.perf_counter() - start:.1f} s")
+    sample = random.sample(conversations, min(samples, len(conversations)))
+
+    conn = sqlite3.connect(db_path)
+    before = {}
+    for label, sql, _ in LOOKUPS:
+        before[label] = time_lookup(lambda cid: conn.execute(sql, (cid,)).fetchall(), sample)
+    start = time.perf_counter()
+    conn.execute("SELECT id, title, parent_id FROM conversations ORDER BY created_at DESC").fetchall()
+    before["get_all_conversations"] = (time.perf_counter() - start) * 1000
+    conn.close()
+
+    start = time.perf_counter()
+    db_setup.init_db(db_path)
+    print(f"Migrated to schema version {len(db_setup.MIGRATIONS)} in {time.perf_counter() - start:.1f} s")
+
+    after = {}
+    for label, _, function in LOOKUPS:
+        after[label] = time_lookup(function, sample)
+    start = time.perf_counter()
+    database.get_all_conversations()
+    after["get_all_conversations"] = (time.perf_counter() - start) * 1000
+
+    print(f"{'lookup':<32}{'before ms':>12}{'after ms':>12}")
+    for label in before:
+        print(f"{label:<32}{before[label]:>12.3f}{after[label]:>12.3f}")
+
+    database.close_connections()
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,88 @@
+"""
+Seed a large chat database and time full-text searches through
+database.search_messages, for common, rare and prefix queries.
+
+Run from the repository root:
+    python -m benchmarks.bench_search [messages] [conversations]
+"""
+import os
+import sys
+import time
+import random
+import itertools
+import sqlite3
+import tempfile
+import db_setup
+from db import database
+
+def make_vocabulary(size):
+    """Pronounceable made-up words, so word frequencies are under our control"""
+    random.seed(7)
+    syllables = ["ka", "lo", "mi", "ter", "van", "sul", "re", "po", "dex", "na", "qui", "bor"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(random.choice(syllables) for _ in range(random.randint(2, 4))))
+    return sorted(words)
+
+def seed(db_path, message_count, conversation_count, vocabulary):
+    """Conversations with branches, and messages whose words follow a Zipf-like distribution"""
+    random.seed(42)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=OFF")
+    conversations = []
+    for i in range(conversation_count):
+        parent_id = random.choice(conversations) if conversations and random.random() < 0.3 else None
+        cursor = conn.execute("INSERT INTO conversations (parent_id, title) VALUES (?, ?)",
+                              (parent_id, f"Conversation {i}"))
+        conversations.append(cursor.lastrowid)
+
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    def rows():
+        for i in range(message_count):
+            words = random.choices(vocabulary, cum_weights=cum_weights, k=30)
+            role = 'user' if i % 2 == 0 else 'assistant'
+            yield (random.choice(conversations), role, " ".join(words))
+
+    conn.executemany("INSERT INTO messages (conversation_id, role, message_text) VALUES (?, ?, ?)", rows())
+    conn.commit()
+    conn.close()
+
+def main(message_count=1_000_000, conversation_count=20_000, samples=10):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    vocabulary = make_vocabulary(20_000)
+
+    # Seed before the search migration so building the index is timed too
+    search_version = db_setup.MIGRATIONS.index(db_setup.add_message_search)
+    db_setup.init_db(db_path, target_version=search_version)
+    print(f"Seeding {message_count} messages in {conversation_count} conversations...")
+    seed(db_path, message_count, conversation_count, vocabulary)
+
+    start = time.perf_counter()
+    db_setup.init_db(db_path)
+    print(f"Building the search index: {time.perf_counter() - start:.1f} s")
+
+    database.DB_PATH = db_path
+    # As typed into the sidebar: a trailing space ends the word, otherwise
+    # the last word is matched as a prefix
+    queries = [
+        ("common word", vocabulary[0] + " "),
+        ("rare word", vocabulary[-1] + " "),
+        ("two words", f"{vocabulary[10]} {vocabulary[500]} "),
+        ("2-letter prefix", vocabulary[0][:2]),
+        ("3-letter prefix", vocabulary[200][:3]),
+        ("5-letter prefix", vocabulary[5000][:5]),
+    ]
+    print(f"{'query':<24}{'hits':>6}{'avg ms':>10}")
+    for label, query in queries:
+        hits = database.search_messages(query)
+        start = time.perf_counter()
+        for _ in range(samples):
+            database.search_messages(query)
+        elapsed = (time.perf_counter() - start) * 1000 / samples
+        print(f"{label:<24}{len(hits):>6}{elapsed:>10.2f}")
+
+    database.close_connections()
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
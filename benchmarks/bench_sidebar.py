@@ -0,0 +1,80 @@
+"""
+Time keeping the sidebar up to date with tens of thousands of conversations:
+the old full rebuild from get_all_conversations against the paged list
+model and its single-row updates.
+
+Run from the repository root (no display needed):
+    python -m benchmarks.bench_sidebar [conversations]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import db_setup
+from db import database
+
+def seed(db_path, conversation_count):
+    """Top-level conversations, about a third of them with branches"""
+    random.seed(42)
+    conn = sqlite3.connect(db_path)
+    roots = []
+    for i in range(conversation_count):
+        if roots and random.random() < 0.3:
+            conn.execute("INSERT INTO conversations (parent_id, title) VALUES (?, ?)",
+                         (random.choice(roots), f"Branch {i}"))
+        else:
+            roots.append(conn.execute("INSERT INTO conversations (title) VALUES (?)",
+                                      (f"Conversation {i}",)).lastrowid)
+    conn.commit()
+    conn.close()
+
+def full_rebuild(list_widget):
+    """What refresh_conversation_list did on every new chat and title change"""
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtWidgets import QListWidgetItem
+    list_widget.clear()
+    for convo_id, title, parent_id in database.get_all_conversations():
+        if parent_id is None:
+            item = QListWidgetItem(f"{title}")
+            item.setData(Qt.UserRole, convo_id)
+            list_widget.addItem(item)
+
+def timed(fn, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def main(conversation_count=50_000):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    database.DB_PATH = db_path
+    db_setup.init_db(db_path)
+    seed(db_path, conversation_count)
+
+    from PyQt5.QtWidgets import QApplication, QListWidget, QListView
+    from ui.conversation_list import ConversationListModel
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    list_widget = QListWidget()
+    model = ConversationListModel()
+    view = QListView()
+    view.setModel(model)
+    model.reload()
+    newest_id = model.data(model.index(0), 0x0100)
+
+    print(f"{conversation_count} conversations")
+    print(f"{'full rebuild (before)':<36}{timed(lambda: full_rebuild(list_widget)):>10.2f} ms")
+    print(f"{'model: first page':<36}{timed(model.reload):>10.2f} ms")
+    print(f"{'model: next page':<36}{timed(model.fetchMore):>10.2f} ms")
+    print(f"{'model: new conversation':<36}{timed(lambda: model.add_conversation(-1, 'New Chat')):>10.2f} ms")
+    print(f"{'model: rename':<36}{timed(lambda: model.rename_conversation(newest_id, 'Renamed')):>10.2f} ms")
+
+    database.close_connections()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
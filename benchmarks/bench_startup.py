@@ -0,0 +1,133 @@
+"""
+Cold-start time of the app: how long `import main` takes and what it pulls
+in (python -X importtime), and how long a fresh process takes to paint the
+main window and to fill the sidebar from a seeded database.
+
+Every run is a new interpreter, so nothing is cached in-process; the OS
+file cache is warm after the first run, so the median is reported. Qt runs
+offscreen unless QT_QPA_PLATFORM is set.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup [--runs N] [--top N] [--conversations N]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+from benchmarks.corpus import seed_database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in each fresh process; prints wall-clock times so the parent can
+# include interpreter startup
+CHILD = """
+import sys, time, json
+started = time.time()
+import main
+imported = time.time()
+from PyQt5.QtCore import QObject, QEvent
+marks = {"started": started, "imported": imported}
+
+class FirstPaint(QObject):
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Paint and "painted" not in marks:
+            marks["painted"] = time.time()
+            finish()
+        return False
+
+def schema_checked(error=None):
+    marks.setdefault("sidebar", time.time())
+    finish()
+
+def finish():
+    if "painted" in marks and "sidebar" in marks:
+        app.quit()
+
+app, window = main.create_app(sys.argv[:1])
+marks["shown"] = time.time()
+first_paint = FirstPaint()
+window.installEventFilter(first_paint)
+window.schema_checked.connect(schema_checked)
+if window.schema_ready.done():
+    # Checked before the window was built, so the sidebar was filled in its constructor
+    schema_checked()
+app.exec_()
+print(json.dumps(marks))
+"""
+
+def import_profile(module="main"):
+    """{imported module: (self ms, cumulative ms, depth)} for one cold `import module`
+
+    Only module and what it pulls in; the interpreter's own startup imports
+    (site and .pth files) are left out.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(own) / 1000, int(cumulative) / 1000, depth))
+
+    # Each module is listed after everything it imported, so module's
+    # subtree is the run of deeper entries just before it
+    end = max(index for index, entry in enumerate(entries) if entry[0] == module and entry[3] == 0)
+    start = end
+    while start > 0 and entries[start - 1][3] > 0:
+        start -= 1
+    return {name: (own, cumulative, depth) for name, own, cumulative, depth in entries[start:end + 1]}
+
+def startup(db_dir):
+    """Milliseconds from spawning the process to each startup mark"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    spawned = time.time()
+    result = subprocess.run([sys.executable, "-c", CHILD], cwd=db_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    marks = json.loads(result.stdout.strip().splitlines()[-1])
+    return {name: (wall - spawned) * 1000 for name, wall in marks.items()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start time of the chat app")
+    parser.add_argument("--runs", type=int, default=7, help="fresh processes per measurement")
+    parser.add_argument("--top", type=int, default=12, help="slowest imports to list")
+    parser.add_argument("--conversations", type=int, default=200, help="top-level conversations to seed")
+    args = parser.parse_args(argv)
+
+    profiles = [import_profile() for _ in range(args.runs)]
+    median = lambda values: statistics.median(values) if values else 0.0
+    total = median([profile["main"][1] for profile in profiles if "main" in profile])
+    print(f"import main: {total:.1f} ms (median of {args.runs}, python -X importtime)")
+
+    # Modules main imports directly, by what each costs including its own imports
+    direct = {name for profile in profiles for name, (_, _, depth) in profile.items() if depth == 1}
+    costs = {name: median([profile[name][1] for profile in profiles if name in profile]) for name in direct}
+    print(f"\n{'imported by main':<32} {'cumulative ms':>14}")
+    for name, cost in sorted(costs.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<32} {cost:14.1f}")
+
+    # Modules whose own top-level code is slowest, wherever they are imported
+    own = {name for profile in profiles for name in profile if name != "main"}
+    own_costs = {name: median([profile[name][0] for profile in profiles if name in profile]) for name in own}
+    print(f"\n{'slowest modules':<32} {'self ms':>14}")
+    for name, cost in sorted(own_costs.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<32} {cost:14.1f}")
+
+    db_dir = tempfile.mkdtemp()
+    corpus = seed_database(os.path.join(db_dir, "chat.db"), conversations=args.conversations)
+    runs = [startup(db_dir) for _ in range(args.runs)]
+    print(f"\nfrom process spawn, {corpus['conversations']} conversations "
+          f"(median of {args.runs}):")
+    for mark, label in (("started", "interpreter ready"), ("imported", "main imported"),
+                        ("shown", "window shown"), ("painted", "first paint"),
+                        ("sidebar", "sidebar filled")):
+        print(f"{label:<32} {median([run[mark] for run in runs]):8.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Time conversation-tree lookups on a seeded database of nested branches: one
+query per level (get_parent_id / get_branches_for_conversation, as the UI
+used to walk the tree), one recursive CTE query (db/tree.py), and the
+cached ConversationTree.
+
+Run from the repository root:
+    python -m benchmarks.bench_tree [trees] [branches_per_tree]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import db_setup
+from db import database, tree
+
+def seed(trees, branches):
+    """Root conversations, each with branches hanging off random earlier conversations in its tree"""
+    rng = random.Random(3)
+    conn = database.get_connection()
+    leaves = []
+    with database.transaction():
+        for t in range(trees):
+            root_id = conn.execute("INSERT INTO conversations (title) VALUES (?)", (f"Tree {t}",)).lastrowid
+            members = [root_id]
+            for b in range(branches):
+                # Prefer recent conversations, so trees grow deep as well as wide
+                parent_id = members[-1 - min(int(rng.expovariate(0.5)), len(members) - 1)]
+                members.append(conn.execute("INSERT INTO conversations (parent_id, title) VALUES (?, ?)",
+                                            (parent_id, f"Branch {b}")).lastrowid)
+            leaves.append((root_id, members[-1]))
+    return leaves
+
+def per_level(root_id, leaf_id):
+    """Ancestors by following parent_id one query at a time, the subtree one query per node"""
+    ancestors = [leaf_id]
+    while True:
+        parent_id = database.get_parent_id(ancestors[-1])
+        if parent_id is None:
+            break
+        ancestors.append(parent_id)
+    subtree = []
+    pending = [root_id]
+    while pending:
+        children = [branch_id for branch_id, _ in database.get_branches_for_conversation(pending.pop())]
+        subtree += children
+        pending += children
+    return len(ancestors), len(subtree)
+
+def one_query(root_id, leaf_id):
+    return len(tree.get_ancestor_ids(leaf_id)), len(tree.get_descendants(root_id))
+
+def cached(root_id, leaf_id):
+    conversation_tree = tree.get_conversation_tree(leaf_id)
+    return len(conversation_tree.ancestors(leaf_id)) + 1, len(conversation_tree.descendants(root_id))
+
+def timed(name, lookup, leaves):
+    conn = database.get_connection()
+    queries = []
+    conn.set_trace_callback(queries.append)
+    start = time.perf_counter()
+    results = [lookup(root_id, leaf_id) for root_id, leaf_id in leaves]
+    elapsed = (time.perf_counter() - start) * 1000
+    conn.set_trace_callback(None)
+    print(f"{name:<28} {elapsed / len(leaves):8.3f} ms per tree   {len(queries) / len(leaves):7.1f} queries per tree")
+    return results
+
+def main(trees=200, branches=60):
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    db_setup.init_db(database.DB_PATH)
+    leaves = seed(trees, branches)
+    depth = sum(tree.get_depth(leaf_id) for _, leaf_id in leaves) / len(leaves)
+
+    print(f"{trees} trees of {branches + 1} conversations, newest branch {depth:.1f} levels deep on average")
+    print("ancestors of the newest branch + every branch under the root:")
+    expected = timed("one query per level", per_level, leaves)
+    assert timed("recursive CTE", one_query, leaves) == expected
+    tree.clear_tree_cache()
+    assert timed("ConversationTree, first use", cached, leaves) == expected
+    # Reopening the trees used most recently, which fit in the cache
+    recent = leaves[-tree.TREE_CACHE_SIZE:]
+    assert timed("ConversationTree, cached", cached, recent) == expected[-tree.TREE_CACHE_SIZE:]
+    database.close_connections()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
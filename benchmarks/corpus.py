@@ -0,0 +1,83 @@
+"""Synthetic chat databases for the benchmark suite"""
+import os
+import random
+import db_setup
+from db import database
+
+WORDS = ("the a to of and in that is for it with as on be this by are or from at can you "
+         "function value list string thread branch message query index table cache render "
+         "request window widget token model context history reply python sqlite markdown").split()
+
+CODE = """```python
+def {name}(items):
+    \"\"\"Return the items sorted, without duplicates\"\"\"
+    result = []
+    for item in sorted(items):
+        if item not in result:
+            result.append(item)
+    return result
+```"""
+
+def message_text(rng, role):
+    """A user question, or an assistant reply with markdown and sometimes a code block"""
+    sentence = lambda: " ".join(rng.choices(WORDS, k=rng.randint(6, 18))).capitalize() + "."
+    if role == "user":
+        return " ".join(sentence() for _ in range(rng.randint(1, 3)))
+    parts = [" ".join(sentence() for _ in range(rng.randint(2, 6))),
+             "\n".join(f"- **{rng.choice(WORDS)}**: {sentence()}" for _ in range(rng.randint(0, 4)))]
+    if rng.random() < 0.4:
+        parts.append(CODE.format(name=f"{rng.choice(WORDS)}_{rng.choice(WORDS)}"))
+    return "\n\n".join(part for part in parts if part)
+
+def exchange_rows(rng, count):
+    return [(role, message_text(rng, role)) for role in ("user", "assistant") * (count // 2)]
+
+def seed_database(db_path, conversations=200, branches=4, depth=2, messages=40, seed=0):
+    """
+    Create a chat database at db_path with branching conversations.
+
+    Each conversation gets branches branches; each branch hangs off a random
+    earlier conversation in its tree that is less than depth levels deep,
+    forks from one of that conversation's own messages and adds half as many
+    messages of its own. The same arguments always give the same database.
+
+    Returns:
+        dict: roots (conversation ids), deepest (the branch with the longest
+        history), message and conversation counts and the file size
+    """
+    rng = random.Random(seed)
+    database.DB_PATH = db_path
+    db_setup.init_db(db_path)
+
+    roots = []
+    deepest, deepest_history = None, -1
+    with database.transaction():
+        for c in range(conversations):
+            root_id = database.insert_conversation(title=f"Conversation {c}")
+            own_ids = {root_id: database.insert_messages(root_id, exchange_rows(rng, messages))}
+            levels = {root_id: 0}
+            history = {root_id: messages}
+            for b in range(branches):
+                parent_id = rng.choice([member for member, level in levels.items() if level < depth])
+                fork_index = rng.randrange(len(own_ids[parent_id])) if own_ids[parent_id] else None
+                fork_message_id = own_ids[parent_id][fork_index] if fork_index is not None else None
+                branch_id = database.insert_conversation(parent_id=parent_id, title=f"Branch {c}.{b}",
+                                                         fork_message_id=fork_message_id)
+                own_ids[branch_id] = database.insert_messages(branch_id, exchange_rows(rng, messages // 2))
+                levels[branch_id] = levels[parent_id] + 1
+                inherited = history[parent_id] - len(own_ids[parent_id]) + (fork_index or 0) + 1
+                history[branch_id] = inherited + len(own_ids[branch_id])
+                if history[branch_id] > deepest_history:
+                    deepest, deepest_history = branch_id, history[branch_id]
+            roots.append(root_id)
+
+    conn = database.get_connection()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    message_count, = conn.execute("SELECT COUNT(*) FROM messages").fetchone()
+    return {
+        "roots": roots,
+        "deepest": deepest if deepest is not None else roots[-1],
+        "conversations": conversations * (branches + 1),
+        "messages": message_count,
+        "db_bytes": os.path.getsize(db_path),
+    }
@@ -0,0 +1,135 @@
+"""Local stand-in for the OpenAI chat completions endpoint used by the benchmarks"""
+import sys
+import json
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers chat completion requests with an echo of the last message"""
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.reply(self.read_body())
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def reply(self, body):
+        messages = body.get('messages') or [{"content": ""}]
+        reply = f"Echo: {messages[-1]['content'][:200]}"
+
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for word in reply.split(" "):
+                event = {"choices": [{"delta": {"content": word + " "}}]}
+                self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        else:
+            data = json.dumps({
+                "choices": [{"message": {"role": "assistant", "content": reply}}]
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+class FlakyHandler(StubHandler):
+    """Stub that fails a share of requests like a loaded API does
+
+    Failures are 429s with Retry-After and rate limit headers, 500s and 503s,
+    and connections dropped without a reply, in proportion to the weights.
+    Outcomes in script are served first, in order; besides those and status
+    codes, "quota" is a 429 for an exhausted quota and "garbled" a 200 whose
+    body isn't valid JSON.
+    """
+    failure_rate = 0.3
+    retry_after = "0.05"
+    weights = {429: 2, 500: 1, 503: 1, "drop": 1}
+    script = []
+    counts = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.read_body()
+        with self.lock:
+            if self.script:
+                outcome = self.script.pop(0)
+            elif random.random() < self.failure_rate:
+                outcome = random.choices(list(self.weights), list(self.weights.values()))[0]
+            else:
+                outcome = 200
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+        if outcome == "drop":
+            self.close_connection = True
+            return
+        if outcome == "garbled":
+            self.reply_garbled(body)
+            return
+        if outcome != 200:
+            error = {"message": f"Injected {outcome}", "type": "injected"}
+            if outcome == "quota":
+                error["code"] = "insufficient_quota"
+            data = json.dumps({"error": error}).encode()
+            self.send_response(429 if outcome == "quota" else outcome)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            if outcome == 429:
+                self.send_header("Retry-After", self.retry_after)
+                self.send_header("x-ratelimit-limit-requests", "3500")
+                self.send_header("x-ratelimit-remaining-requests", "0")
+                self.send_header("x-ratelimit-reset-requests", "20ms")
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self.reply(body)
+
+    def reply_garbled(self, body):
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self._write_chunk(b'data: {"choices": [\n\n')
+            self._write_chunk(b"")
+        else:
+            data = b'{"choices": ['
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+class StubServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections when many requests start at
+    # once, and each dropped one costs a second-long SYN retry
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients closing a connection mid-reply is expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start_stub_server(handler=StubHandler):
+    """Start the stub on a free local port; returns (server, chat completions URL)"""
+    server = StubServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+    return server, url
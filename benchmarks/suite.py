@@ -0,0 +1,386 @@
+"""
+Headless benchmark suite for the database, rendering, UI and API paths.
+
+Seeds a synthetic chat database (benchmarks/corpus.py), times each
+registered benchmark asv-style (warm-up call, then repeated samples of
+enough calls to outlast timer noise) and saves the results as JSON named
+after the current commit. Pass an earlier results file to --compare to see
+what got slower. Qt runs offscreen and API requests go to a local stub
+server (benchmarks/stub_server.py), so no display or network is needed.
+
+Run from the repository root:
+    python -m benchmarks.suite [--conversations N] [--branches N] [--depth N] [--messages N]
+                               [--repeat N] [--filter TEXT] [--output FILE] [--compare FILE]
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import sqlite3
+import itertools
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from db import database
+from db.tree import get_tree_summaries
+from db.writer import get_writer, shutdown_writer
+from utils import api_client, async_api_client
+from utils.context_builder import build_context
+from utils.markdown_renderer import shutdown_render_pool
+from benchmarks.corpus import seed_database, message_text
+from benchmarks.stub_server import start_stub_server
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Each timed sample runs the benchmark this long at least
+MIN_SAMPLE_SECONDS = 0.05
+
+# A benchmark this much slower than in the compared run is reported as a
+# regression. Runs are compared by their fastest sample, which noise from
+# other processes can only make slower.
+REGRESSION_THRESHOLD = 0.2
+
+BENCHMARKS = []  # (name, setup function)
+
+def benchmark(name):
+    """
+    Register a benchmark.
+
+    The decorated function is called with the Environment once, untimed, and
+    returns what to time: either run() or a (prepare, run) pair. With a pair,
+    prepare() runs untimed before every call and its result is passed to
+    run(), for benchmarks that need a fresh state each time.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+class Environment:
+    """What the benchmarks share: the seeded database, a chat window and the stub API"""
+    def __init__(self, corpus):
+        self.corpus = corpus
+        # The read benchmarks use the tree with the longest history; create_branch grows another one
+        self.deep_root = database.get_root_conversation_id(corpus["deepest"])
+        self.spare_root = next(root_id for root_id in reversed(corpus["roots"]) if root_id != self.deep_root)
+        self._app = None
+        self._window = None
+        self._server = None
+
+    @property
+    def app(self):
+        if self._app is None:
+            from PyQt5.QtWidgets import QApplication
+            self._app = QApplication.instance() or QApplication(sys.argv)
+        return self._app
+
+    @property
+    def window(self):
+        if self._window is None:
+            self.app
+            import main as chat_app
+            self._window = chat_app.ChatWindow()
+        return self._window
+
+    def process_events(self):
+        """Deliver queued signals and delete widgets passed to deleteLater"""
+        from PyQt5.QtCore import QCoreApplication, QEvent
+        self.app.processEvents()
+        QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+
+    def start_api(self):
+        """Point the API clients at the stub server"""
+        if self._server is None:
+            self._server, api_client.API_URL = start_stub_server()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+        api_client.close_session()
+        shutdown_writer()
+        shutdown_render_pool()
+        database.close_connections()
+
+# --- database ---
+
+@benchmark("db.get_root_conversations")
+def bench_root_conversations(env):
+    return lambda: database.get_root_conversations(100)
+
+@benchmark("db.get_conversation_page")
+def bench_conversation_page(env):
+    return lambda: database.get_conversation_page(env.corpus["deepest"], 50)
+
+@benchmark("db.get_conversation_rows")
+def bench_conversation_rows(env):
+    return lambda: database.get_conversation_rows(env.corpus["deepest"])
+
+@benchmark("db.iter_conversation_messages")
+def bench_iter_conversation_messages(env):
+    return lambda: list(database.iter_conversation_messages(env.corpus["deepest"]))
+
+@benchmark("db.get_message_count")
+def bench_message_count(env):
+    return lambda: database.get_message_count(env.corpus["deepest"])
+
+@benchmark("db.get_tree_summaries")
+def bench_tree_summaries(env):
+    return lambda: get_tree_summaries(env.deep_root)
+
+@benchmark("db.search_messages")
+def bench_search(env):
+    return lambda: database.search_messages("branch cache")
+
+@benchmark("db.insert_message")
+def bench_insert_message(env):
+    conversation_id = database.insert_conversation(title="Inserts")
+    return lambda: database.insert_message(conversation_id, "user", "How do I reverse a list in Python?")
+
+@benchmark("db.insert_messages")
+def bench_insert_messages(env):
+    conversation_id = database.insert_conversation(title="Batch inserts")
+    rows = [("user", "How do I reverse a list?"), ("assistant", "Use reversed() or slicing.")] * 10
+    return lambda: database.insert_messages(conversation_id, rows)
+
+@benchmark("db.writer_write")
+def bench_writer_write(env):
+    conversation_id = database.insert_conversation(title="Queued inserts")
+    return lambda: get_writer().write(database.insert_message, conversation_id, "user", "Queued message")
+
+@benchmark("context.build_context")
+def bench_build_context(env):
+    return lambda: build_context(env.corpus["deepest"])
+
+# --- rendering ---
+
+def _scratch_tab(env):
+    """A ChatTab in the window that isn't showing a conversation"""
+    from ui.main_window import ChatTab
+    return ChatTab("Scratch", parent_window=env.window)
+
+@benchmark("render.format_markdown")
+def bench_format_markdown(env):
+    tab = _scratch_tab(env)
+    counter = itertools.count()
+    text = message_text(random.Random(1), "assistant")
+    # A different text every call, so nothing comes from the render cache
+    return lambda: tab.format_markdown(f"{text}\n\nReply {next(counter)}")
+
+@benchmark("render.format_markdown_cached")
+def bench_format_markdown_cached(env):
+    tab = _scratch_tab(env)
+    text = message_text(random.Random(2), "assistant")
+    return lambda: tab.format_markdown(text)
+
+# --- UI ---
+
+@benchmark("ui.refresh_conversation_list")
+def bench_refresh_conversation_list(env):
+    return lambda: env.window.refresh_conversation_list()
+
+@benchmark("ui.open_conversation")
+def bench_open_conversation(env):
+    from PyQt5.QtCore import Qt
+    window = env.window
+    model = window.conversation_model
+    window.refresh_conversation_list()
+    while model.canFetchMore():
+        model.fetchMore()
+    root_id = env.deep_root
+    index = next(model.index(row) for row in range(model.rowCount()) if model.index(row).data(Qt.UserRole) == root_id)
+
+    def prepare():
+        # Close the conversation so every call opens it from scratch
+        tab_widget = window.chat_tabs.pop(root_id, None)
+        if tab_widget is not None:
+            window.chat_container.removeWidget(tab_widget)
+            tab_widget.deleteLater()
+        env.process_events()
+    return prepare, lambda _: window.open_conversation(index)
+
+@benchmark("ui.load_conversation_history")
+def bench_load_conversation_history(env):
+    tabs = []
+
+    def prepare():
+        while tabs:
+            tabs.pop().deleteLater()
+        env.process_events()
+        tab = _scratch_tab(env)
+        tab.conversation_id = env.corpus["deepest"]
+        tabs.append(tab)
+        return tab
+    return prepare, lambda tab: tab.load_conversation_history()
+
+@benchmark("ui.create_branch")
+def bench_create_branch(env):
+    tab_widget = env.window.show_conversation(env.spare_root)
+    tab = tab_widget.widget(0)
+    return lambda: tab.create_branch()
+
+# --- API (local stub server) ---
+
+@benchmark("api.get_chat_response")
+def bench_get_chat_response(env):
+    env.start_api()
+    history = database.get_conversation_messages(env.corpus["deepest"])[-20:]
+    return lambda: api_client.get_chat_response(history)
+
+@benchmark("api.stream_chat_response")
+def bench_stream_chat_response(env):
+    env.start_api()
+    history = database.get_conversation_messages(env.corpus["deepest"])[-20:]
+    return lambda: "".join(api_client.stream_chat_response(history))
+
+@benchmark("api.send_to_all")
+def bench_send_to_all(env):
+    env.start_api()
+    summaries = get_tree_summaries(env.deep_root)
+    histories = [database.get_conversation_messages(conversation_id)[-20:] + [{"role": "user", "content": "Why?"}]
+                 for conversation_id, *_ in summaries]
+
+    async def stream(client, history):
+        return "".join([delta async for delta in async_api_client.stream_chat_response(client, history)])
+
+    async def send_all():
+        async with async_api_client.create_client() as client:
+            await async_api_client.gather_bounded(stream(client, history) for history in histories)
+    return lambda: asyncio.run(send_all())
+
+def measure(run, prepare=None, repeat=7):
+    """Time run() asv-style; returns (calls per sample, per-call seconds of each sample)"""
+    # The first call pays for imports, parsers and cold caches
+    run(prepare()) if prepare else run()
+    number = 1
+    if prepare is None:
+        # Calls per sample: grow until a sample lasts MIN_SAMPLE_SECONDS
+        for number in (10 ** exponent * step for exponent in itertools.count() for step in (1, 2, 5)):
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+            if time.perf_counter() - start >= MIN_SAMPLE_SECONDS:
+                break
+    samples = []
+    for _ in range(repeat):
+        if prepare is None:
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+        else:
+            state = prepare()
+            start = time.perf_counter()
+            run(state)
+        samples.append((time.perf_counter() - start) / number)
+    return number, samples
+
+def git_revision():
+    """(short commit hash, whether tracked files have uncommitted changes)"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, bool(status.strip())
+
+def compare(results, previous, threshold=REGRESSION_THRESHOLD):
+    """Print each benchmark's fastest sample against an earlier run; returns the names that got slower than threshold"""
+    print(f"\nCompared with {previous.get('commit', '?')} ({previous.get('timestamp', '?')}):")
+    regressions = []
+    for name, result in results.items():
+        before = previous.get("results", {}).get(name)
+        if before is None:
+            print(f"  {name:<34} new")
+            continue
+        ratio = result["min_ms"] / before["min_ms"] if before["min_ms"] else float("inf")
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            verdict = "REGRESSION"
+        elif ratio < 1 / (1 + threshold):
+            verdict = "faster"
+        else:
+            verdict = ""
+        print(f"  {name:<34} {before['min_ms']:10.3f} -> {result['min_ms']:10.3f} ms  x{ratio:5.2f}  {verdict}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmarks for the chat app")
+    parser.add_argument("--conversations", type=int, default=200, help="top-level conversations to seed")
+    parser.add_argument("--branches", type=int, default=4, help="branches per conversation")
+    parser.add_argument("--depth", type=int, default=2, help="how deep branches of branches go")
+    parser.add_argument("--messages", type=int, default=40, help="messages per conversation (half per branch)")
+    parser.add_argument("--repeat", type=int, default=7, help="timed samples per benchmark")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown reported as a regression, e.g. 0.2 for 20%%")
+    args = parser.parse_args(argv)
+
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_chat.db")
+    start = time.perf_counter()
+    corpus = seed_database(db_path, args.conversations, args.branches, args.depth, args.messages)
+    print(f"Seeded {corpus['conversations']} conversations, {corpus['messages']} messages, "
+          f"{corpus['db_bytes'] / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s")
+
+    env = Environment(corpus)
+    results = {}
+    try:
+        for name, setup in BENCHMARKS:
+            if args.filter not in name:
+                continue
+            timed = setup(env)
+            prepare, run = timed if isinstance(timed, tuple) else (None, timed)
+            number, samples = measure(run, prepare, args.repeat)
+            samples_ms = [sample * 1000 for sample in samples]
+            results[name] = {
+                "median_ms": statistics.median(samples_ms),
+                "min_ms": min(samples_ms),
+                "mean_ms": statistics.mean(samples_ms),
+                "stdev_ms": statistics.stdev(samples_ms) if len(samples_ms) > 1 else 0.0,
+                "number": number,
+                "repeat": len(samples_ms),
+            }
+            print(f"{name:<34} {results[name]['median_ms']:10.3f} ms  (min {results[name]['min_ms']:.3f}, "
+                  f"{number} x {len(samples_ms)})")
+    finally:
+        env.close()
+
+    commit, dirty = git_revision()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "params": {key: value for key, value in vars(args).items()
+                   if key in ("conversations", "branches", "depth", "messages", "repeat")},
+        "corpus": {key: value for key, value in corpus.items() if key != "roots"},
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous.get("params") != report["params"]:
+            print("Note: the compared run used different parameters:", previous.get("params"))
+        if compare(results, previous, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
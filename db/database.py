@@ -1,54 +1,487 @@
+import re
+import zlib
+import atexit
+import hashlib
 import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from utils.tracing import traced
 
 DB_PATH = 'chat.db'
 
+# Pragmas applied once to every new connection. WAL lets the GUI thread read
+# while a worker thread writes, and synchronous=NORMAL is durable in WAL mode
+# without an fsync on every commit.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Number of compiled statements each connection keeps around for reuse
+STATEMENT_CACHE_SIZE = 256
+
+# Message bodies of at least this many bytes are stored once, compressed, in
+# message_bodies and shared by every message with the same text; a shorter
+# body stays inline, where a reference would cost about as much as the text
+MESSAGE_BODY_MIN_SIZE = 256
+
+# Decompressed message bodies kept in memory
+BODY_CACHE_SIZE = 1000
+
+# How a message_bodies row is encoded
+CODEC_RAW = 0  # UTF-8 text, when compressing doesn't make it smaller
+CODEC_ZLIB = 1
+
+def encode_body(text):
+    """(hash, codec, size, body) of a message_bodies row for text"""
+    data = text.encode('utf-8')
+    compressed = zlib.compress(data, 6)
+    if len(compressed) < len(data):
+        return hashlib.sha256(data).digest(), CODEC_ZLIB, len(data), compressed
+    return hashlib.sha256(data).digest(), CODEC_RAW, len(data), data
+
+def decode_body(codec, body):
+    """The text of a message_bodies row; also SQL's inflate(codec, body)"""
+    if body is None:
+        return None
+    if codec == CODEC_ZLIB:
+        body = zlib.decompress(body)
+    return bytes(body).decode('utf-8')
+
+def register_functions(conn):
+    """SQL functions the schema relies on; the message_texts view calls inflate()"""
+    conn.create_function("inflate", 2, decode_body, deterministic=True)
+
+class ConnectionManager:
+    """Hands out one long-lived SQLite connection per thread"""
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get(self, db_path):
+        """Return this thread's connection to db_path, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.db_path == db_path:
+            return conn
+        if conn is not None:
+            self._discard(conn)
+
+        conn = sqlite3.connect(
+            db_path,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            # Only the owning thread uses it, but close_all() may run elsewhere
+            check_same_thread=False,
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        register_functions(conn)
+
+        self._local.conn = conn
+        self._local.db_path = db_path
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+        self._local.conn = None
+
+    def close_all(self):
+        """Close every connection opened by any thread"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                print(f"Error closing database connection: {str(e)}")
+        self._local = threading.local()
+
+_manager = ConnectionManager()
+
 def get_connection():
-    return sqlite3.connect(DB_PATH)
+    """Get the calling thread's pooled connection (do not close it)"""
+    return _manager.get(DB_PATH)
+
+def close_connections():
+    """Close all pooled connections; called on application shutdown"""
+    _manager.close_all()
+
+atexit.register(close_connections)
+
+_transactions = threading.local()
 
-def insert_conversation(parent_id=None, title=""):
+@contextmanager
+def transaction():
+    """
+    Unit of work: every write on this thread inside the block commits together.
+    
+    A block that raises is rolled back, so nothing is left half written.
+    Blocks nest; only the outermost one commits. The write functions in this
+    module use it themselves, so they can be grouped freely:
+    
+        with transaction():
+            conversation_id = insert_conversation(title=title)
+            insert_message(conversation_id, "user", text)
+    
+    Yields:
+        sqlite3.Connection: This thread's connection
+    """
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO conversations (parent_id, title) VALUES (?, ?)",
-        (parent_id, title)
-    )
-    conn.commit()
-    convo_id = cursor.lastrowid
-    conn.close()
-    return convo_id
+    depth = getattr(_transactions, "depth", 0)
+    if depth == 0:
+        _transactions.committed = []
+        if not conn.in_transaction:
+            # Take the write lock up front rather than failing to upgrade a read lock later
+            conn.execute("BEGIN IMMEDIATE")
+    _transactions.depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        _transactions.depth = depth
+        if depth == 0:
+            _transactions.committed = []
+            conn.rollback()
+        raise
+    _transactions.depth = depth
+    if depth == 0:
+        conn.commit()
+        callbacks, _transactions.committed = _transactions.committed, []
+        for callback in callbacks:
+            callback()
+
+def after_commit(callback):
+    """
+    Call callback() once the calling thread's transaction has committed.
+    
+    For caches of what other threads read: cleared any earlier, a reader
+    could fill them again from the old data. Outside a transaction it is
+    called straight away; if the transaction rolls back, not at all.
+    """
+    if getattr(_transactions, "depth", 0) == 0:
+        callback()
+    else:
+        _transactions.committed.append(callback)
+
+_body_cache = OrderedDict()  # body id -> text
+_body_cache_lock = threading.Lock()
+
+@traced("db.get_message_bodies")
+def get_message_bodies(body_ids):
+    """Get the text of message_bodies rows as {body_id: text}, from the in-memory LRU where possible"""
+    bodies = {}
+    missing = []
+    with _body_cache_lock:
+        for body_id in set(body_ids):
+            text = _body_cache.get(body_id)
+            if text is None:
+                missing.append(body_id)
+            else:
+                _body_cache.move_to_end(body_id)
+                bodies[body_id] = text
+    if not missing:
+        return bodies
 
-def insert_message(conversation_id, role, message_text):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO messages (conversation_id, role, message_text) VALUES (?, ?, ?)",
-        (conversation_id, role, message_text)
+    loaded = {}
+    for start in range(0, len(missing), 500):
+        chunk = missing[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        for body_id, codec, body in conn.execute(
+                f"SELECT id, codec, body FROM message_bodies WHERE id IN ({placeholders})", chunk):
+            loaded[body_id] = decode_body(codec, body)
+    with _body_cache_lock:
+        for body_id, text in loaded.items():
+            _body_cache[body_id] = text
+            _body_cache.move_to_end(body_id)
+        while len(_body_cache) > BODY_CACHE_SIZE:
+            _body_cache.popitem(last=False)
+    bodies.update(loaded)
+    return bodies
+
+def with_bodies(rows):
+    """(id, role, message_text, body_id) rows as (id, role, message_text), filling in shared bodies"""
+    body_ids = [row[3] for row in rows if row[2] is None and row[3] is not None]
+    bodies = get_message_bodies(body_ids) if body_ids else {}
+    return [(message_id, role, message_text if message_text is not None else bodies.get(body_id))
+            for message_id, role, message_text, body_id in rows]
+
+def store_body(conn, message_text):
+    """
+    Values for the (message_text, body_id) columns of a new message.
+    
+    A long body is added to message_bodies unless the same text is already
+    there; the messages_text_* triggers keep its reference count.
+    """
+    data_size = len(message_text.encode('utf-8')) if message_text else 0
+    if data_size < MESSAGE_BODY_MIN_SIZE:
+        return message_text, None
+    content_hash, codec, size, body = encode_body(message_text)
+    row = conn.execute("SELECT id FROM message_bodies WHERE hash = ?", (content_hash,)).fetchone()
+    if row:
+        return None, row[0]
+    cursor = conn.execute(
+        "INSERT INTO message_bodies (hash, codec, size, body) VALUES (?, ?, ?, ?)",
+        (content_hash, codec, size, body)
+    )
+    return None, cursor.lastrowid
+
+def index_pending_messages(conn):
+    """
+    Apply the search index changes the messages_text_* triggers queued.
+
+    The triggers can't decompress bodies, so messages with a body are added
+    to and removed from messages_fts here, in the order they were queued.
+    A removal also drops the body reference it was holding.
+    """
+    rows = conn.execute(
+        "SELECT p.id, p.message_id, p.message_text, p.body_id, p.adds, b.codec, b.body "
+        "FROM search_pending p LEFT JOIN message_bodies b ON b.id = p.body_id ORDER BY p.id"
+    ).fetchall()
+    for _, message_id, message_text, body_id, adds, codec, body in rows:
+        if message_text is None:
+            message_text = decode_body(codec, body)
+        if adds:
+            conn.execute("INSERT INTO messages_fts (rowid, message_text) VALUES (?, ?)", (message_id, message_text))
+            continue
+        conn.execute("INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', ?, ?)",
+                     (message_id, message_text))
+        if body_id is not None:
+            conn.execute("UPDATE message_bodies SET refs = refs - 1 WHERE id = ?", (body_id,))
+            conn.execute("DELETE FROM message_bodies WHERE id = ? AND refs <= 0", (body_id,))
+    if rows:
+        conn.execute("DELETE FROM search_pending WHERE id <= ?", (rows[-1][0],))
+
+# The full context of a conversation is its own messages plus, for a branch,
+# the ancestor messages up to and including its fork_message_id. Message ids
+# grow monotonically and a branch only gets messages after the message it
+# forked from, so ordering by id gives the correct history.
+_CONTEXT_CHAIN = """
+    WITH RECURSIVE chain(conversation_id, upto) AS (
+        SELECT ?, NULL
+        UNION ALL
+        SELECT fork.conversation_id, c.fork_message_id
+        FROM chain
+        JOIN conversations c ON c.id = chain.conversation_id
+        JOIN messages fork ON fork.id = c.fork_message_id
     )
-    conn.commit()
-    conn.close()
+"""
+_CONTEXT_MESSAGES = """
+    FROM chain
+    JOIN messages m ON m.conversation_id = chain.conversation_id
+    WHERE (chain.upto IS NULL OR m.id <= chain.upto)
+"""
+CONTEXT_ROWS_SQL = _CONTEXT_CHAIN + "SELECT m.id, m.role, m.message_text, m.body_id" + _CONTEXT_MESSAGES + "ORDER BY m.id"
+CONTEXT_IDS_SQL = _CONTEXT_CHAIN + "SELECT m.id" + _CONTEXT_MESSAGES + "ORDER BY m.id"
+# The (conversation_id, upto) segments of the same history, oldest first.
+# Paging walks the segments so each read is a plain range scan on the
+# (conversation_id, id) index with no sort.
+CONTEXT_SEGMENTS_SQL = """
+    WITH RECURSIVE chain(conversation_id, upto, depth) AS (
+        SELECT ?, NULL, 0
+        UNION ALL
+        SELECT fork.conversation_id, c.fork_message_id, chain.depth + 1
+        FROM chain
+        JOIN conversations c ON c.id = chain.conversation_id
+        JOIN messages fork ON fork.id = c.fork_message_id
+    )
+    SELECT conversation_id, upto FROM chain ORDER BY depth DESC
+"""
+_MAX_ID = 2 ** 63 - 1
+
+# Ranking scores every match, so a common word would cost a full pass over
+# its posting list; only the newest SEARCH_CANDIDATES matches are ranked
+SEARCH_CANDIDATES = 2000
+
+# Walks the posting list newest first without scoring anything
+SEARCH_CUTOFF_SQL = """
+    SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?
+    ORDER BY rowid DESC LIMIT 1 OFFSET ?
+"""
+# Best matches first (FTS5's bm25 rank); snippet() marks the matched terms
+SEARCH_SQL = """
+    SELECT m.id, m.conversation_id, c.title, m.role, m.message_text, m.body_id,
+           snippet(messages_fts, 0, ?, ?, '…', ?)
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH ? AND messages_fts.rowid >= ?
+    ORDER BY rank
+"""
 
+@traced("db.insert_conversation")
+def insert_conversation(parent_id=None, title="", fork_message_id=None):
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO conversations (parent_id, title, fork_message_id) VALUES (?, ?, ?)",
+            (parent_id, title, fork_message_id)
+        )
+        if parent_id is not None:
+            # The parent's cached tree no longer has every branch, once the branch can be read
+            from db.tree import invalidate_conversation_tree
+            after_commit(lambda: invalidate_conversation_tree(parent_id))
+    return cursor.lastrowid
+
+@traced("db.insert_message")
+def insert_message(conversation_id, role, message_text):
+    with transaction() as conn:
+        text, body_id = store_body(conn, message_text)
+        cursor = conn.execute(
+            "INSERT INTO messages (conversation_id, role, message_text, body_id) VALUES (?, ?, ?, ?)",
+            (conversation_id, role, text, body_id)
+        )
+        if body_id is not None:
+            index_pending_messages(conn)
+    return cursor.lastrowid
+
+@traced("db.insert_messages")
+def insert_messages(conversation_id, rows):
+    """
+    Add several messages to a conversation in one statement and one commit.
+    
+    Args:
+        conversation_id (int): Conversation the messages belong to
+        rows (iterable): (role, message_text) pairs, oldest first
+    
+    Returns:
+        list: The new message ids, in the order of rows
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    with transaction() as conn:
+        values = [(conversation_id, role, *store_body(conn, message_text)) for role, message_text in rows]
+        conn.executemany(
+            "INSERT INTO messages (conversation_id, role, message_text, body_id) VALUES (?, ?, ?, ?)", values
+        )
+        # Rows inserted under one write lock get consecutive ids
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        if any(body_id is not None for *_, body_id in values):
+            index_pending_messages(conn)
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+@traced("db.get_conversation_messages")
 def get_conversation_messages(conversation_id):
+    """Get the full message history of a conversation, including inherited branch context"""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT role, message_text FROM messages WHERE conversation_id = ? ORDER BY timestamp",
-        (conversation_id,)
-    )
-    messages = [{'role': role, 'content': message_text} for role, message_text in cursor.fetchall()]
-    conn.close()
+    cursor.execute(CONTEXT_ROWS_SQL, (conversation_id,))
+    messages = [{'role': role, 'content': message_text} for _, role, message_text in with_bodies(cursor.fetchall())]
     return messages
 
+@traced("db.get_conversation_rows")
+def get_conversation_rows(conversation_id):
+    """Get the full message history as (id, role, message_text) rows"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(CONTEXT_ROWS_SQL, (conversation_id,))
+    return with_bodies(cursor.fetchall())
+
+@traced("db.get_context_segments")
+def get_context_segments(conversation_id):
+    """Get the (conversation_id, last included message id or None) segments that make up a history"""
+    conn = get_connection()
+    return conn.execute(CONTEXT_SEGMENTS_SQL, (conversation_id,)).fetchall()
+
+@traced("db.get_conversation_page")
+def get_conversation_page(conversation_id, limit, before_id=None):
+    """Get up to limit (id, role, message_text) rows of the history, oldest first
+
+    Without before_id this is the latest page; pass the id of the oldest row
+    already loaded to get the page before it.
+    """
+    conn = get_connection()
+    rows = []
+    before_id = before_id if before_id is not None else _MAX_ID
+    for segment_id, upto in reversed(get_context_segments(conversation_id)):
+        rows.extend(conn.execute(
+            "SELECT id, role, message_text, body_id FROM messages "
+            "WHERE conversation_id = ? AND id <= ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (segment_id, upto if upto is not None else _MAX_ID, before_id, limit - len(rows))
+        ).fetchall())
+        if len(rows) >= limit:
+            break
+    rows.reverse()
+    return with_bodies(rows)
+
+@traced("db.iter_conversation_messages")
+def iter_conversation_messages(conversation_id, batch_size=200):
+    """Yield the full message history oldest first, fetching batch_size rows at a time
+
+    Yields the same dicts as get_conversation_messages without holding the
+    whole history in memory.
+    """
+    conn = get_connection()
+    for segment_id, upto in get_context_segments(conversation_id):
+        upto = upto if upto is not None else _MAX_ID
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, role, message_text, body_id FROM messages "
+                "WHERE conversation_id = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?",
+                (segment_id, last_id, upto, batch_size)
+            ).fetchall()
+            for _, role, message_text in with_bodies(rows):
+                yield {'role': role, 'content': message_text}
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+
+@traced("db.get_context_messages_by_role")
+def get_context_messages_by_role(conversation_id, role):
+    """Get the (id, role, message_text) rows of one role from the full history, oldest first"""
+    conn = get_connection()
+    rows = []
+    for segment_id, upto in get_context_segments(conversation_id):
+        rows.extend(conn.execute(
+            "SELECT id, role, message_text, body_id FROM messages "
+            "WHERE conversation_id = ? AND id <= ? AND role = ? ORDER BY id",
+            (segment_id, upto if upto is not None else _MAX_ID, role)
+        ).fetchall())
+    return with_bodies(rows)
+
+@traced("db.get_conversation_message_ids")
+def get_conversation_message_ids(conversation_id):
+    """Get the database ids of the full message history, in the same order as get_conversation_messages"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(CONTEXT_IDS_SQL, (conversation_id,))
+    return [message_id for (message_id,) in cursor.fetchall()]
+
+@traced("db.get_all_conversations")
 def get_all_conversations():
     """Get all conversations"""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id, title, parent_id FROM conversations ORDER BY created_at DESC"
+        "SELECT id, title, parent_id FROM conversations ORDER BY id DESC"
     )
     conversations = cursor.fetchall()
-    conn.close()
     return conversations
 
+@traced("db.get_root_conversations")
+def get_root_conversations(limit, before_id=None):
+    """Get up to limit (id, title) top-level conversations, newest first
+
+    Pass the id of the last conversation already loaded to get the next page.
+    """
+    conn = get_connection()
+    # A range scan on the (parent_id, id) index
+    return conn.execute(
+        "SELECT id, title FROM conversations WHERE parent_id IS NULL AND id < ? ORDER BY id DESC LIMIT ?",
+        (before_id if before_id is not None else _MAX_ID, limit)
+    ).fetchall()
+
+@traced("db.get_conversation_title")
 def get_conversation_title(conversation_id):
     """Get the title of a conversation"""
     conn = get_connection()
@@ -58,45 +491,44 @@ def get_conversation_title(conversation_id):
         (conversation_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else "Untitled"
 
+@traced("db.get_branches_for_conversation")
 def get_branches_for_conversation(conversation_id):
     """Get all branches for a given conversation"""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id, title FROM conversations WHERE parent_id = ? ORDER BY created_at",
+        "SELECT id, title FROM conversations WHERE parent_id = ? ORDER BY id",
         (conversation_id,)
     )
     branches = cursor.fetchall()
-    conn.close()
     return branches
 
+@traced("db.update_conversation_title")
 def update_conversation_title(conversation_id, new_title):
     """Update the title of a conversation"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE conversations SET title = ? WHERE id = ?",
-        (new_title, conversation_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE conversations SET title = ? WHERE id = ?",
+            (new_title, conversation_id)
+        )
     return True
 
+@traced("db.get_message_count")
 def get_message_count(conversation_id):
-    """Get the number of messages in a conversation"""
+    """Get the number of messages stored in a conversation itself (excluding inherited branch context)"""
     conn = get_connection()
     cursor = conn.cursor()
+    # Maintained by triggers on messages, so this is a single row lookup
     cursor.execute(
-        "SELECT COUNT(*) FROM messages WHERE conversation_id = ?",
+        "SELECT message_count FROM conversations WHERE id = ?",
         (conversation_id,)
     )
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    result = cursor.fetchone()
+    return result[0] if result else 0
 
+@traced("db.get_parent_id")
 def get_parent_id(conversation_id):
     """Get the parent_id of a conversation, if it exists"""
     conn = get_connection()
@@ -106,5 +538,202 @@ def get_parent_id(conversation_id):
         (conversation_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result and result[0] is not None else None
+
+@traced("db.get_token_counts")
+def get_token_counts(message_ids, tokenizer):
+    """Get cached token counts for messages as {message_id: count}; uncached ids are left out"""
+    conn = get_connection()
+    counts = {}
+    # Stay well under SQLite's limit on bound parameters
+    for start in range(0, len(message_ids), 500):
+        chunk = message_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        counts.update(conn.execute(
+            f"SELECT message_id, token_count FROM message_tokens WHERE tokenizer = ? AND message_id IN ({placeholders})",
+            (tokenizer, *chunk)
+        ).fetchall())
+    return counts
+
+@traced("db.save_token_counts")
+def save_token_counts(tokenizer, counts):
+    """Cache token counts given as {message_id: count}"""
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO message_tokens (message_id, tokenizer, token_count) VALUES (?, ?, ?)",
+            [(message_id, tokenizer, count) for message_id, count in counts.items()]
+        )
+
+@traced("db.get_rendered_html")
+def get_rendered_html(content_hash, variant):
+    """Get cached markdown output for a message body, or None"""
+    conn = get_connection()
+    result = conn.execute(
+        "SELECT html FROM rendered_html WHERE content_hash = ? AND variant = ?",
+        (content_hash, variant)
+    ).fetchone()
+    return result[0] if result else None
+
+@traced("db.get_rendered_html_many")
+def get_rendered_html_many(content_hashes, variant):
+    """Get cached markdown output for several message bodies as {content_hash: html}; misses are left out"""
+    conn = get_connection()
+    found = {}
+    # Stay well under SQLite's limit on bound parameters
+    for start in range(0, len(content_hashes), 500):
+        chunk = content_hashes[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        found.update(conn.execute(
+            f"SELECT content_hash, html FROM rendered_html WHERE variant = ? AND content_hash IN ({placeholders})",
+            (variant, *chunk)
+        ).fetchall())
+    return found
+
+@traced("db.save_rendered_html")
+def save_rendered_html(content_hash, variant, html, now):
+    """Cache markdown output for a message body"""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO rendered_html (content_hash, variant, html, last_used) VALUES (?, ?, ?, ?)",
+            (content_hash, variant, html, now)
+        )
+
+@traced("db.touch_rendered_html")
+def touch_rendered_html(content_hashes, variant, now):
+    """Mark cached markdown output as used, so it is evicted later"""
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE rendered_html SET last_used = ? WHERE content_hash = ? AND variant = ?",
+            [(now, content_hash, variant) for content_hash in content_hashes]
+        )
+
+@traced("db.prune_rendered_html")
+def prune_rendered_html(variant, max_rows):
+    """Drop cached markdown output of every other variant, then the least recently used beyond max_rows
+
+    Output of an old theme or extension set is never read again, and neither
+    is that of deleted messages, which ages out of the LRU.
+
+    Returns:
+        int: Number of rows removed
+    """
+    with transaction() as conn:
+        stale = conn.execute("DELETE FROM rendered_html WHERE variant != ?", (variant,)).rowcount
+        evicted = conn.execute(
+            "DELETE FROM rendered_html WHERE content_hash IN "
+            "(SELECT content_hash FROM rendered_html ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (max_rows,)
+        ).rowcount
+    return stale + evicted
+
+@traced("db.get_cached_response")
+def get_cached_response(request_hash, min_created_at):
+    """Get (response, created_at) of a cached API response created after min_created_at, or None"""
+    conn = get_connection()
+    return conn.execute(
+        "SELECT response, created_at FROM response_cache WHERE request_hash = ? AND created_at >= ?",
+        (request_hash, min_created_at)
+    ).fetchone()
+
+@traced("db.touch_cached_response")
+def touch_cached_response(request_hash, now):
+    """Mark a cached API response as used, so it is evicted later"""
+    with transaction() as conn:
+        conn.execute("UPDATE response_cache SET last_used = ? WHERE request_hash = ?", (now, request_hash))
+
+@traced("db.save_cached_response")
+def save_cached_response(request_hash, response, now, min_created_at, max_entries):
+    """Cache an API response, then drop expired entries and the least recently used beyond max_entries
+
+    Returns:
+        int: Number of entries removed
+    """
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (request_hash, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (request_hash, response, now, now)
+        )
+        expired = conn.execute("DELETE FROM response_cache WHERE created_at < ?", (min_created_at,)).rowcount
+        evicted = conn.execute(
+            "DELETE FROM response_cache WHERE request_hash IN "
+            "(SELECT request_hash FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (max_entries,)
+        ).rowcount
+    return expired + evicted
+
+@traced("db.get_root_conversation_id")
+def get_root_conversation_id(conversation_id):
+    """Get the top-level conversation a branch (at any depth) belongs to"""
+    # Trees are cached, so repeated lookups (e.g. every search keystroke) don't query
+    from db.tree import get_conversation_tree
+    tree = get_conversation_tree(conversation_id)
+    return tree.root_id if tree else conversation_id
+
+def search_match_expression(text):
+    """Turn what the user typed into an FTS5 query: every word must match
+
+    The last word is matched as a prefix while it is still being typed, i.e.
+    unless the text ends in whitespace. Words are quoted, so punctuation and
+    FTS5 operators in the input are searched for as plain text instead of
+    being parsed as query syntax.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if not text[-1].isspace():
+        terms[-1] += "*"
+    return " ".join(terms)
+
+@traced("db.search_messages")
+def search_messages(query, limit=50, start_mark="<b>", end_mark="</b>", snippet_tokens=12):
+    """Full-text search over every message in all conversations and branches
+
+    The newest SEARCH_CANDIDATES matching messages are ranked, best first.
+    Messages with the same role and text in one conversation tree (e.g. an
+    old branch that still holds a copy of its parent's history) are collapsed
+    into their best-ranked hit.
+
+    Args:
+        query (str): Text typed by the user
+        limit (int): Maximum number of hits
+        start_mark, end_mark (str): Put around matched terms in the snippet
+        snippet_tokens (int): Approximate snippet length in tokens
+
+    Returns:
+        list: Dicts with message_id, conversation_id, root_id, title, role and
+        snippet, best match first
+    """
+    expression = search_match_expression(query)
+    if expression is None:
+        return []
+
+    conn = get_connection()
+    cutoff = conn.execute(SEARCH_CUTOFF_SQL, (expression, SEARCH_CANDIDATES - 1)).fetchone()
+    cursor = conn.execute(SEARCH_SQL, (start_mark, end_mark, snippet_tokens, expression,
+                                       cutoff[0] if cutoff else 0))
+    hits = []
+    seen = set()
+    roots = {}
+    # Rows come back best first, so stop reading once there are enough distinct hits
+    for message_id, conversation_id, title, role, message_text, body_id, snippet in cursor:
+        if conversation_id not in roots:
+            roots[conversation_id] = get_root_conversation_id(conversation_id)
+        root_id = roots[conversation_id]
+        # Equal long texts share a body, so comparing body ids avoids decompressing
+        key = (root_id, role, message_text, body_id)
+        if key in seen:
+            continue
+        seen.add(key)
+        hits.append({
+            'message_id': message_id,
+            'conversation_id': conversation_id,
+            'root_id': root_id,
+            'title': title,
+            'role': role,
+            'snippet': snippet,
+        })
+        if len(hits) >= limit:
+            break
+    cursor.close()
+    return hits
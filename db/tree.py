@@ -0,0 +1,212 @@
+import os
+import threading
+from collections import OrderedDict
+from db.database import get_connection
+from utils.tracing import traced
+
+# Conversation trees kept in memory; the least recently used is dropped first
+TREE_CACHE_SIZE = int(os.getenv("TREE_CACHE_SIZE", "64"))
+
+# A conversation's ancestors, itself first and the root conversation last
+ANCESTORS_SQL = """
+    WITH RECURSIVE up(id, parent_id, depth) AS (
+        SELECT id, parent_id, 0 FROM conversations WHERE id = ?
+        UNION ALL
+        SELECT c.id, c.parent_id, up.depth + 1 FROM conversations c JOIN up ON c.id = up.parent_id
+    )
+    SELECT id FROM up ORDER BY depth
+"""
+# Every conversation below one, with its depth below it; each level is a
+# range scan on the (parent_id, id) index
+DESCENDANTS_SQL = """
+    WITH RECURSIVE down(id, depth) AS (
+        SELECT ?, 0
+        UNION ALL
+        SELECT c.id, down.depth + 1 FROM conversations c JOIN down ON c.parent_id = down.id
+    )
+    SELECT id, depth FROM down WHERE depth > 0
+"""
+# The whole tree a conversation belongs to: up to its root, then down from it
+TREE_SQL = """
+    WITH RECURSIVE up(id, parent_id) AS (
+        SELECT id, parent_id FROM conversations WHERE id = ?
+        UNION ALL
+        SELECT c.id, c.parent_id FROM conversations c JOIN up ON c.id = up.parent_id
+    ),
+    down(id, depth) AS (
+        SELECT id, 0 FROM up WHERE parent_id IS NULL
+        UNION ALL
+        SELECT c.id, down.depth + 1 FROM conversations c JOIN down ON c.parent_id = down.id
+    )
+    SELECT c.id, c.parent_id, c.fork_message_id, down.depth, c.title, c.message_count
+    FROM down JOIN conversations c ON c.id = down.id
+"""
+
+@traced("db.get_ancestor_ids")
+def get_ancestor_ids(conversation_id):
+    """Get the ids from the root conversation down to (and including) conversation_id, in one query"""
+    conn = get_connection()
+    ids = [row[0] for row in conn.execute(ANCESTORS_SQL, (conversation_id,))]
+    ids.reverse()
+    return ids
+
+@traced("db.get_descendants")
+def get_descendants(conversation_id):
+    """Get (id, depth below conversation_id) of every branch under a conversation, in one query"""
+    conn = get_connection()
+    return conn.execute(DESCENDANTS_SQL, (conversation_id,)).fetchall()
+
+def get_depth(conversation_id):
+    """Get how many branches deep a conversation is; 0 for a root conversation"""
+    return max(len(get_ancestor_ids(conversation_id)) - 1, 0)
+
+class ConversationTree:
+    """
+    The shape of one conversation tree: who branched from whom.
+
+    Built from a single query and answers parent, children, ancestor,
+    descendant and depth lookups from memory. Titles and message counts
+    change as the user chats, so they are not kept here; see
+    get_tree_summaries() for those.
+    """
+    def __init__(self, rows):
+        """rows are (id, parent_id, fork_message_id, depth) of every conversation in the tree"""
+        self.root_id = None
+        self._parent = {}
+        self._fork = {}
+        self._depth = {}
+        self._children = {}
+        for conversation_id, parent_id, fork_message_id, depth in sorted(rows, key=lambda row: row[0]):
+            self._parent[conversation_id] = parent_id
+            self._fork[conversation_id] = fork_message_id
+            self._depth[conversation_id] = depth
+            self._children.setdefault(conversation_id, [])
+            if parent_id is None:
+                self.root_id = conversation_id
+            else:
+                self._children.setdefault(parent_id, []).append(conversation_id)
+
+    def __contains__(self, conversation_id):
+        return conversation_id in self._parent
+
+    def __len__(self):
+        return len(self._parent)
+
+    def parent(self, conversation_id):
+        """The conversation it branched from; None for the root"""
+        return self._parent[conversation_id]
+
+    def fork_message_id(self, conversation_id):
+        """The last message it inherits from its parent"""
+        return self._fork[conversation_id]
+
+    def children(self, conversation_id):
+        """Its direct branches, oldest first"""
+        return list(self._children[conversation_id])
+
+    def depth(self, conversation_id):
+        """Branches between it and the root; 0 for the root"""
+        return self._depth[conversation_id]
+
+    def ancestors(self, conversation_id):
+        """Its ancestors, the root first"""
+        path = []
+        parent_id = self._parent[conversation_id]
+        while parent_id is not None:
+            path.append(parent_id)
+            parent_id = self._parent[parent_id]
+        path.reverse()
+        return path
+
+    def descendants(self, conversation_id):
+        """Every branch under it, each followed by its own branches"""
+        found = []
+        stack = list(reversed(self._children[conversation_id]))
+        while stack:
+            child_id = stack.pop()
+            found.append(child_id)
+            stack.extend(reversed(self._children[child_id]))
+        return found
+
+    def walk(self):
+        """Every conversation in the tree, parents before their branches"""
+        if self.root_id is None:
+            return []
+        return [self.root_id] + self.descendants(self.root_id)
+
+_trees = OrderedDict()  # root id -> ConversationTree
+_tree_lock = threading.Lock()
+_generation = 0  # Bumped by every invalidation, so a load that overlapped one isn't cached
+
+def _cached_tree(conversation_id):
+    for root_id, tree in _trees.items():
+        if conversation_id in tree:
+            _trees.move_to_end(root_id)
+            return tree
+    return None
+
+def _load_tree(conversation_id):
+    """Query the tree a conversation belongs to and cache its shape; returns (tree, rows)"""
+    with _tree_lock:
+        generation = _generation
+    conn = get_connection()
+    rows = conn.execute(TREE_SQL, (conversation_id,)).fetchall()
+    if not rows:
+        return None, rows
+    tree = ConversationTree([row[:4] for row in rows])
+    with _tree_lock:
+        if generation != _generation:
+            # A branch was committed while this was read; the rows may predate it
+            return tree, rows
+        _trees[tree.root_id] = tree
+        _trees.move_to_end(tree.root_id)
+        while len(_trees) > TREE_CACHE_SIZE:
+            _trees.popitem(last=False)
+    return tree, rows
+
+def get_conversation_tree(conversation_id):
+    """
+    Get the tree a conversation belongs to, querying it only the first time.
+
+    A conversation the cached tree doesn't know yet (e.g. a branch another
+    thread just committed) reloads it.
+
+    Returns:
+        ConversationTree: None if the conversation doesn't exist
+    """
+    with _tree_lock:
+        tree = _cached_tree(conversation_id)
+    if tree is None:
+        tree, _ = _load_tree(conversation_id)
+    return tree
+
+@traced("db.get_tree_summaries")
+def get_tree_summaries(conversation_id):
+    """Get (id, title, parent_id, message_count, depth) of every conversation in a tree
+
+    One query for everything needed to lay out a conversation's tabs. The
+    root comes first and each branch is followed by its own branches. The
+    tree's shape is cached on the way.
+    """
+    tree, rows = _load_tree(conversation_id)
+    if tree is None:
+        return []
+    summaries = {conversation_id: (conversation_id, title, parent_id, message_count, depth)
+                 for conversation_id, parent_id, _, depth, title, message_count in rows}
+    return [summaries[conversation_id] for conversation_id in tree.walk()]
+
+def invalidate_conversation_tree(conversation_id):
+    """Forget the cached tree a conversation is in; called once a new branch of it is committed"""
+    global _generation
+    with _tree_lock:
+        _generation += 1
+        for root_id, tree in list(_trees.items()):
+            if conversation_id in tree:
+                del _trees[root_id]
+
+def clear_tree_cache():
+    """Forget every cached tree"""
+    global _generation
+    with _tree_lock:
+        _generation += 1
+        _trees.clear()
@@ -0,0 +1,151 @@
+import os
+import queue
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import Future
+from db.database import get_connection, transaction
+from utils.tracing import span
+
+# Most queued writes committed together in one transaction
+WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "256"))
+
+class DatabaseWriter:
+    """
+    Runs database writes on one dedicated thread, so callers never wait on a commit.
+
+    submit() queues a write function and returns a Future for its result
+    (e.g. the new row id). The thread takes whatever has queued up since its
+    last commit, up to WRITE_BATCH_SIZE writes, and commits them as one
+    transaction. Each write runs in its own savepoint, so one that fails is
+    rolled back alone and its Future gets the exception. Writes run in the
+    order they were submitted, so a conversation's messages keep their order.
+    Futures resolve once their write is committed.
+    """
+    def __init__(self, batch_size=WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._stats = {"writes": 0, "commits": 0, "failures": 0}
+        self._thread = threading.Thread(target=self._work, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) and return a Future for its result
+
+        After shutdown() the write runs on the calling thread instead, so
+        late writes are not lost.
+        """
+        future = Future()
+        with self._lock:
+            if not self._shutdown:
+                self._queue.put((future, fn, args, kwargs))
+                return future
+        try:
+            with transaction():
+                future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def write(self, fn, *args, **kwargs):
+        """Run a write on the writer thread and wait for its result"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def flush(self):
+        """Wait until everything submitted so far is committed"""
+        self.submit(lambda: None).result()
+
+    def shutdown(self):
+        """Commit the remaining writes, checkpoint the WAL to disk and stop the thread"""
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        """Writes run, transactions committed and writes that failed"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _work(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            # Everything queued behind the first write joins its commit
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [item for item in batch if item is not None]
+            if batch:
+                self._commit(batch)
+
+        # Nothing else will write: make the commits durable in the main database file
+        try:
+            get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            print(f"Error checkpointing database: {str(e)}")
+
+    def _commit(self, batch):
+        conn = get_connection()
+        results = []
+        try:
+            with span("db.writer.commit", writes=len(batch)), transaction():
+                for future, fn, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute("SAVEPOINT queued_write")
+                    try:
+                        result = fn(*args, **kwargs)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO queued_write")
+                        conn.execute("RELEASE queued_write")
+                        results.append((future, None, e))
+                        continue
+                    conn.execute("RELEASE queued_write")
+                    results.append((future, result, None))
+        except sqlite3.Error as e:
+            # The transaction couldn't start or commit: none of the batch was written
+            print(f"Error committing queued writes: {str(e)}")
+            results = [(future, None, e) for future, _, _, _ in batch if not future.cancelled()]
+
+        failures = 0
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                failures += 1
+                future.set_exception(error)
+        with self._lock:
+            self._stats["writes"] += len(results)
+            self._stats["commits"] += 1
+            self._stats["failures"] += failures
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """Get the shared database writer, starting its thread on first use"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = DatabaseWriter()
+        return _writer
+
+def shutdown_writer():
+    """Flush and stop the shared writer; called when the main window closes"""
+    with _writer_lock:
+        writer = _writer
+    if writer is not None:
+        writer.shutdown()
+
+# Registered after database.close_connections, so it runs first: queued
+# writes are committed before the connections close
+atexit.register(shutdown_writer)
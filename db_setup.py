@@ -1,9 +1,63 @@
 import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from db.database import register_functions, store_body, index_pending_messages, MESSAGE_BODY_MIN_SIZE
 
-def init_db(db_path='chat.db'):
-    conn = sqlite3.connect(db_path)
+def init_db(db_path='chat.db', target_version=None):
+    """Bring the database schema up to date by applying any pending migrations
+
+    The schema version is kept in PRAGMA user_version; each migration runs in
+    its own transaction together with the version bump.
+    """
+    if target_version is None:
+        target_version = len(MIGRATIONS)
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    register_functions(conn)
     cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:target_version], start=version + 1):
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    # Index messages with long bodies that another program added or removed
+    if max(version, target_version) >= 10:
+        cursor.execute("BEGIN")
+        index_pending_messages(conn)
+        cursor.execute("COMMIT")
+
+    # Refresh the planner statistics for the new indexes
+    cursor.execute("PRAGMA optimize")
+    conn.close()
 
+def init_db_async(db_path='chat.db'):
+    """Run init_db on a background thread, so the window can appear while it works
+
+    Returns a Future that resolves once the schema is up to date, or holds the
+    error if a migration failed. The thread isn't a daemon: quitting waits for
+    a running migration to finish.
+    """
+    future = Future()
+    def check_schema():
+        try:
+            init_db(db_path)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+    threading.Thread(target=check_schema, name="schema-check").start()
+    return future
+
+def create_tables(cursor):
+    """Migration 1: the original conversations and messages tables"""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS conversations (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -25,8 +79,335 @@ def init_db(db_path='chat.db'):
         )
     ''')
 
-    conn.commit()
-    conn.close()
+def add_fork_pointers(cursor):
+    """Migration 2: branches point at their last inherited message instead of copying history"""
+    # Databases from before versioned migrations may already have the column
+    if 'fork_message_id' not in table_columns(cursor, 'conversations'):
+        cursor.execute("ALTER TABLE conversations ADD COLUMN fork_message_id INTEGER REFERENCES messages(id)")
+        convert_copied_branches(cursor)
+
+def add_indexes(cursor):
+    """Migration 3: indexes for the per-conversation and per-parent lookups"""
+    # Message history is always read by conversation in id order
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (conversation_id, id)
+    ''')
+    # Branch lists and the sidebar (parent_id IS NULL) filter on parent_id in id order
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_parent
+        ON conversations (parent_id, id)
+    ''')
+
+def add_message_counts(cursor):
+    """Migration 4: conversations.message_count, kept current by triggers on messages"""
+    cursor.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute('''
+        UPDATE conversations SET message_count = (
+            SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_count_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE conversations SET message_count = message_count + 1 WHERE id = NEW.conversation_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_count_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE conversations SET message_count = message_count - 1 WHERE id = OLD.conversation_id;
+        END
+    ''')
+
+def add_token_counts(cursor):
+    """Migration 5: cache of per-message token counts for the context builder"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_tokens (
+            message_id INTEGER NOT NULL,
+            tokenizer TEXT NOT NULL,
+            token_count INTEGER NOT NULL,
+            PRIMARY KEY (message_id, tokenizer)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_tokens_delete AFTER DELETE ON messages
+        BEGIN
+            DELETE FROM message_tokens WHERE message_id = OLD.id;
+        END
+    ''')
+
+def add_render_cache(cursor):
+    """Migration 6: rendered markdown, keyed by message body hash and renderer variant"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rendered_html (
+            content_hash TEXT NOT NULL,
+            variant TEXT NOT NULL,  -- extensions, theme and markdown version
+            html TEXT NOT NULL,
+            PRIMARY KEY (content_hash, variant)
+        ) WITHOUT ROWID
+    ''')
+
+def add_message_search(cursor):
+    """Migration 7: full-text index over message bodies, kept in sync by triggers
+
+    The index reads its text from the messages table (external content), so
+    message bodies are not stored twice. Branches point at their parent's
+    history instead of copying it, so each message is indexed once however
+    many branches inherit it.
+    """
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+            message_text,
+            content='messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'  -- Short prefixes typed into the search box match the most words
+        )
+    ''')
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (NEW.id, NEW.message_text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', OLD.id, OLD.message_text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message_text ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', OLD.id, OLD.message_text);
+            INSERT INTO messages_fts (rowid, message_text) VALUES (NEW.id, NEW.message_text);
+        END
+    ''')
+
+def add_response_cache(cursor):
+    """Migration 8: opt-in cache of API responses, keyed by a hash of the request"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            request_hash TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,  -- Unix time; entries expire after a TTL
+            last_used REAL NOT NULL  -- Least recently used entries are evicted first
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)")
+
+def add_message_bodies(cursor):
+    """Migration 9: long message bodies stored once, compressed, in message_bodies
+
+    Messages with the same long text (a prompt sent to every branch, a reply
+    restored from the response cache) share one row. The search index now
+    reads its text through the message_texts view, which decompresses it.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_bodies (
+            id INTEGER PRIMARY KEY,
+            hash BLOB NOT NULL UNIQUE,  -- sha256 of the text
+            codec INTEGER NOT NULL,  -- 0: UTF-8, 1: zlib
+            size INTEGER NOT NULL,  -- Length of the text in bytes
+            refs INTEGER NOT NULL DEFAULT 0,  -- Messages using the body; it is deleted at 0
+            body BLOB NOT NULL
+        )
+    ''')
+    if 'body_id' not in table_columns(cursor, 'messages'):
+        cursor.execute("ALTER TABLE messages ADD COLUMN body_id INTEGER REFERENCES message_bodies(id)")
+
+    # The index and its triggers read messages.message_text; they are rebuilt below
+    for trigger in ('messages_fts_insert', 'messages_fts_delete', 'messages_fts_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS messages_fts")
+
+    # Move the long bodies out, a batch of rows at a time
+    refs = Counter()
+    last_id = 0
+    while True:
+        rows = cursor.execute(
+            "SELECT id, message_text FROM messages "
+            "WHERE id > ? AND length(CAST(message_text AS BLOB)) >= ? ORDER BY id LIMIT 1000",
+            (last_id, MESSAGE_BODY_MIN_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        updates = [(store_body(cursor, message_text)[1], message_id) for message_id, message_text in rows]
+        cursor.executemany("UPDATE messages SET message_text = NULL, body_id = ? WHERE id = ?", updates)
+        refs.update(body_id for body_id, _ in updates)
+        last_id = rows[-1][0]
+    cursor.executemany("UPDATE message_bodies SET refs = ? WHERE id = ?",
+                       [(count, body_id) for body_id, count in refs.items()])
+
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS message_texts AS
+        SELECT m.id, COALESCE(m.message_text, inflate(b.codec, b.body)) AS message_text
+        FROM messages m LEFT JOIN message_bodies b ON b.id = m.body_id
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE messages_fts USING fts5 (
+            message_text,
+            content='message_texts',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    # One trigger per event, so the index reads a body before it can be deleted
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_text_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE message_bodies SET refs = refs + 1 WHERE id = NEW.body_id;
+            INSERT INTO messages_fts (rowid, message_text)
+            SELECT id, message_text FROM message_texts WHERE id = NEW.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_text_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', OLD.id, COALESCE(
+                OLD.message_text, (SELECT inflate(codec, body) FROM message_bodies WHERE id = OLD.body_id)));
+            UPDATE message_bodies SET refs = refs - 1 WHERE id = OLD.body_id;
+            DELETE FROM message_bodies WHERE id = OLD.body_id AND refs <= 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_text_update AFTER UPDATE OF message_text, body_id ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', OLD.id, COALESCE(
+                OLD.message_text, (SELECT inflate(codec, body) FROM message_bodies WHERE id = OLD.body_id)));
+            UPDATE message_bodies SET refs = refs + 1 WHERE id = NEW.body_id;
+            UPDATE message_bodies SET refs = refs - 1 WHERE id = OLD.body_id;
+            DELETE FROM message_bodies WHERE id = OLD.body_id AND refs <= 0;
+            INSERT INTO messages_fts (rowid, message_text)
+            SELECT id, message_text FROM message_texts WHERE id = NEW.id;
+        END
+    ''')
+
+def add_search_queue(cursor):
+    """Migration 10: text triggers that work without the app's inflate() function
+
+    The migration 9 triggers decompressed bodies with inflate(), so a
+    connection that hadn't registered it (the sqlite3 shell, other tools)
+    could no longer change messages. Now the triggers index inline text
+    themselves and queue messages with a body in search_pending, which the
+    app applies (db.database.index_pending_messages) when it stores a body
+    and at startup. A queued removal holds on to its body's reference: the
+    body's text is needed to take the message out of the index.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS search_pending (
+            id INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL,
+            body_id INTEGER,  -- The text is in message_bodies, or else in message_text
+            message_text TEXT,
+            adds INTEGER NOT NULL  -- 1: add to the index, 0: remove from it
+        )
+    ''')
+    for trigger in ('messages_text_insert', 'messages_text_delete', 'messages_text_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    cursor.execute('''
+        CREATE TRIGGER messages_text_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE message_bodies SET refs = refs + 1 WHERE id = NEW.body_id;
+            INSERT INTO messages_fts (rowid, message_text)
+            SELECT NEW.id, NEW.message_text WHERE NEW.body_id IS NULL;
+            INSERT INTO search_pending (message_id, body_id, adds)
+            SELECT NEW.id, NEW.body_id, 1 WHERE NEW.body_id IS NOT NULL;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER messages_text_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            SELECT 'delete', OLD.id, OLD.message_text WHERE OLD.body_id IS NULL;
+            INSERT INTO search_pending (message_id, body_id, adds)
+            SELECT OLD.id, OLD.body_id, 0 WHERE OLD.body_id IS NOT NULL;
+        END
+    ''')
+    # With a body on either side both halves are queued, so they apply in order
+    cursor.execute('''
+        CREATE TRIGGER messages_text_update AFTER UPDATE OF message_text, body_id ON messages
+        BEGIN
+            UPDATE message_bodies SET refs = refs + 1 WHERE id = NEW.body_id;
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            SELECT 'delete', OLD.id, OLD.message_text WHERE OLD.body_id IS NULL AND NEW.body_id IS NULL;
+            INSERT INTO messages_fts (rowid, message_text)
+            SELECT NEW.id, NEW.message_text WHERE OLD.body_id IS NULL AND NEW.body_id IS NULL;
+            INSERT INTO search_pending (message_id, body_id, message_text, adds)
+            SELECT OLD.id, OLD.body_id, OLD.message_text, 0 WHERE OLD.body_id IS NOT NULL OR NEW.body_id IS NOT NULL;
+            INSERT INTO search_pending (message_id, body_id, message_text, adds)
+            SELECT NEW.id, NEW.body_id, NEW.message_text, 1 WHERE OLD.body_id IS NOT NULL OR NEW.body_id IS NOT NULL;
+        END
+    ''')
+
+def add_render_cache_eviction(cursor):
+    """Migration 11: rendered_html remembers when each row was last used, for LRU eviction"""
+    if 'last_used' not in table_columns(cursor, 'rendered_html'):
+        # Existing rows count as least recently used
+        cursor.execute("ALTER TABLE rendered_html ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rendered_html_last_used ON rendered_html (last_used)")
+
+def table_columns(cursor, table):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+def convert_copied_branches(cursor):
+    """Turn branches that hold a copy of their parent's history into pointer branches
+
+    The copied prefix of each branch is matched against its parent's messages;
+    the matching rows are deleted and the branch is pointed at the last
+    matching parent message instead.
+    """
+    branches = cursor.execute(
+        "SELECT id, parent_id FROM conversations WHERE parent_id IS NOT NULL ORDER BY id"
+    ).fetchall()
+
+    for branch_id, parent_id in branches:
+        parent_rows = cursor.execute(
+            "SELECT id, role, message_text FROM messages WHERE conversation_id = ? ORDER BY id",
+            (parent_id,)
+        ).fetchall()
+        branch_rows = cursor.execute(
+            "SELECT id, role, message_text FROM messages WHERE conversation_id = ? ORDER BY id",
+            (branch_id,)
+        ).fetchall()
+
+        shared = 0
+        for parent_row, branch_row in zip(parent_rows, branch_rows):
+            if parent_row[1:] != branch_row[1:]:
+                break
+            shared += 1
+        if shared == 0:
+            continue
+
+        cursor.executemany(
+            "DELETE FROM messages WHERE id = ?",
+            [(row[0],) for row in branch_rows[:shared]]
+        )
+        cursor.execute(
+            "UPDATE conversations SET fork_message_id = ? WHERE id = ?",
+            (parent_rows[shared - 1][0], branch_id)
+        )
+
+# Applied in order; a database at user_version N has run the first N
+MIGRATIONS = [
+    create_tables,
+    add_fork_pointers,
+    add_indexes,
+    add_message_counts,
+    add_token_counts,
+    add_render_cache,
+    add_message_search,
+    add_response_cache,
+    add_message_bodies,
+    add_search_queue,
+    add_render_cache_eviction,
+]
 
 if __name__ == '__main__':
     init_db()
@@ -1,13 +1,29 @@
-from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QTabWidget, QApplication, QHBoxLayout, QSplitter, QListWidget, QListWidgetItem, QPushButton, QLabel, QFrame, QStackedWidget)
-from PyQt5.QtCore import Qt, QSize
-from PyQt5.QtGui import QFont, QPalette, QColor
+from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QTabWidget, QApplication, QHBoxLayout, QSplitter, QListWidget, QListWidgetItem, QListView, QPushButton, QLabel, QFrame, QStackedWidget, QLineEdit, QShortcut)
+from PyQt5.QtCore import Qt, QSize, QTimer, pyqtSignal
+from PyQt5.QtGui import QFont, QPalette, QColor, QKeySequence
 import sys
 import os
-from ui.main_window import ChatTab
-from db.database import insert_conversation, get_all_conversations, get_conversation_title, get_branches_for_conversation, get_message_count
-import markdown
+import html
+from dotenv import load_dotenv
+# Load .env before the modules below read their settings
+load_dotenv()
+from ui.main_window import ChatTab, BranchTabPlaceholder
+from ui.conversation_list import ConversationListModel
+from db_setup import init_db_async
+from utils.request_executor import get_executor, shutdown_executor, RequestHandle, PRIORITY_CHAT
+from utils.markdown_renderer import shutdown_render_pool
+from db.database import insert_conversation, close_connections, search_messages
+from db.tree import get_conversation_tree, get_tree_summaries
+from db.writer import get_writer, shutdown_writer
+from utils.tracing import traced
 import importlib.util
 
+# Wait this long after the last keystroke before searching
+SEARCH_DELAY_MS = 150
+
+# Matched terms in search snippets; control characters can't clash with message text
+SNIPPET_START, SNIPPET_END = "\x02", "\x03"
+
 def check_dependencies():
     """Check if all required packages are installed"""
     required_packages = {
@@ -27,10 +43,21 @@ def check_dependencies():
         return False
     return True
 
+def close_api_session():
+    """Close the HTTP session on quit, if a request ever imported the client"""
+    api_client = sys.modules.get("utils.api_client")
+    if api_client is not None:
+        api_client.close_session()
+
 class ChatWindow(QMainWindow):
-    def __init__(self):
+    # Emitted on the GUI thread once the background schema check is done; None or its error
+    schema_checked = pyqtSignal(object)
+    
+    def __init__(self, schema_ready=None):
         super().__init__()
         self.setWindowTitle("Branching Chat")
+        # Set before the first paint: parsing it takes well under a millisecond, and
+        # applying it later would show unstyled widgets and then repolish all of them
         self.setStyleSheet("""
             QMainWindow, QWidget {
                 background-color: #ffffff;
@@ -54,14 +81,14 @@ class ChatWindow(QMainWindow):
             QPushButton:pressed {
                 background-color: #f0f0f0;
             }
-            QListWidget {
+            QListView {
                 background-color: #ffffff;
                 border: 1px solid #e1e1e1;
                 border-radius: 8px;
                 padding: 10px;
                 font-size: 14px;
             }
-            QListWidget::item {
+            QListView::item {
                 padding: 12px;
                 margin: 4px 0px;
                 border: none;
@@ -69,7 +96,7 @@ class ChatWindow(QMainWindow):
                 background-color: #f8f8f8;
                 color: #000000;
             }
-            QListWidget::item:selected {
+            QListView::item:selected {
                 background-color: #f0f0f0;
                 color: #000000;
                 font-weight: 500;
@@ -170,6 +197,23 @@ class ChatWindow(QMainWindow):
         new_chat_btn.clicked.connect(self.create_new_chat)
         sidebar_layout.addWidget(new_chat_btn)
         
+        # Search across every conversation and branch
+        self.search_field = QLineEdit()
+        self.search_field.setPlaceholderText("Search messages...")
+        self.search_field.setClearButtonEnabled(True)
+        self.search_field.textChanged.connect(self.schedule_search)
+        sidebar_layout.addWidget(self.search_field)
+        
+        # Search as the user types, once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.run_search)
+        
+        # Hidden debug panel with live span latencies
+        self.performance_panel = None
+        QShortcut(QKeySequence("Ctrl+Shift+P"), self, self.toggle_performance_panel)
+        
         # Empty state message
         self.empty_label = QLabel("No conversations yet.\nClick '+New Chat' to start.")
         self.empty_label.setAlignment(Qt.AlignCenter)
@@ -183,13 +227,16 @@ class ChatWindow(QMainWindow):
         """)
         sidebar_layout.addWidget(self.empty_label)
         
-        # List of conversations
-        self.conversation_list = QListWidget()
-        self.conversation_list.itemClicked.connect(self.open_conversation)
+        # List of conversations, paged in from the database as it scrolls
+        self.conversation_model = ConversationListModel(self)
+        self.conversation_list = QListView()
+        self.conversation_list.setModel(self.conversation_model)
+        self.conversation_list.setUniformItemSizes(True)
+        self.conversation_list.clicked.connect(self.open_conversation)
         sidebar_layout.addWidget(self.conversation_list)
         
-        # Initially hide the conversation list since it's empty
-        self.conversation_list.setVisible(False)
+        # Search hits replace the conversation list while there is a query; built on the first search
+        self.search_results = None
         
         # Right side - Chat container with tabs for each branch
         self.chat_container = QStackedWidget()
@@ -206,7 +253,44 @@ class ChatWindow(QMainWindow):
         
         main_layout.addWidget(splitter)
         
-        # Welcome widget
+        # The welcome page is built after the first paint
+        QTimer.singleShot(0, self.show_welcome)
+        
+        # Show the newest conversations once the schema is up to date; the empty state if there are none
+        self.schema_ready = schema_ready
+        self.pending_actions = []  # Run once the schema check passes
+        if schema_ready is None:
+            self.refresh_conversation_list()
+        else:
+            self.empty_label.setVisible(False)
+            self.schema_checked.connect(self.show_schema_status)
+            schema_ready.add_done_callback(lambda future: self.schema_checked.emit(future.exception()))
+    
+    def show_schema_status(self, error):
+        """Fill the sidebar once the database is ready, or say why it can't be opened"""
+        if error is not None:
+            print(f"Error preparing database: {str(error)}")
+            self.empty_label.setText(f"Could not open the database:\n{str(error)}")
+            self.empty_label.setVisible(True)
+            self.pending_actions.clear()
+            return
+        self.refresh_conversation_list()
+        actions, self.pending_actions = self.pending_actions, []
+        for action in actions:
+            action()
+    
+    def schema_is_ready(self, retry=None):
+        """True once the schema check has passed; while it runs, retry is called when it finishes"""
+        if self.schema_ready is None:
+            return True
+        if not self.schema_ready.done():
+            if retry is not None and retry not in self.pending_actions:
+                self.pending_actions.append(retry)
+            return False
+        return self.schema_ready.exception() is None
+    
+    def show_welcome(self):
+        """Add the welcome page to the chat area; it shows until a conversation is opened"""
         welcome_widget = QWidget()
         welcome_layout = QVBoxLayout(welcome_widget)
         welcome_layout.setContentsMargins(40, 60, 40, 60)
@@ -262,21 +346,29 @@ class ChatWindow(QMainWindow):
         welcome_layout.addWidget(start_button, 0, Qt.AlignCenter)
         welcome_layout.addStretch(1)
         
-        # Add welcome widget to the container
         self.chat_container.addWidget(welcome_widget)
     
+    def toggle_performance_panel(self):
+        """Show or hide the performance panel, creating it the first time"""
+        if self.performance_panel is None:
+            from ui.performance_panel import PerformancePanel
+            self.performance_panel = PerformancePanel(self)
+        self.performance_panel.setVisible(not self.performance_panel.isVisible())
+    
     def create_new_chat(self):
         """Create a new main conversation"""
+        if not self.schema_is_ready(retry=self.create_new_chat):
+            return
+        
         # Create a conversation in the database
-        main_conversation_id = insert_conversation(title="New Chat")
+        main_conversation_id = get_writer().write(insert_conversation, title="New Chat")
         
         # Create a tab widget for this conversation
-        tab_widget = QTabWidget()
-        tab_widget.setTabsClosable(True)
-        tab_widget.tabCloseRequested.connect(lambda index: self.close_branch_tab(tab_widget, index))
+        tab_widget = self.create_tab_widget()
         
         # Create main chat tab
-        main_tab = ChatTab("New Chat", conversation_id=main_conversation_id, parent_window=self)
+        main_tab = ChatTab("New Chat", conversation_id=main_conversation_id, parent_window=self,
+                           message_count=0, parent_id=None)
         tab_widget.addTab(main_tab, "Main")
         
         # Store the tab widget
@@ -286,89 +378,192 @@ class ChatWindow(QMainWindow):
         self.chat_container.addWidget(tab_widget)
         self.chat_container.setCurrentWidget(tab_widget)
         
-        # Refresh sidebar
-        self.refresh_conversation_list()
+        # Add it to the top of the sidebar
+        self.conversation_model.add_conversation(main_conversation_id, "New Chat")
+        self.update_sidebar_visibility()
     
+    @traced("ui.refresh_conversation_list")
     def refresh_conversation_list(self):
-        """Refresh the conversations list in the sidebar"""
-        self.conversation_list.clear()
-        conversations = get_all_conversations()
-        
-        has_conversations = False
-        for convo_id, title, parent_id in conversations:
-            # Only show parent conversations in the sidebar (no branches)
-            if parent_id is None:
-                has_conversations = True
-                item = QListWidgetItem(f"{title}")
-                item.setData(Qt.UserRole, convo_id)
-                self.conversation_list.addItem(item)
-        
-        # Show/hide elements based on whether there are conversations
-        self.conversation_list.setVisible(has_conversations)
-        self.empty_label.setVisible(not has_conversations)
+        """Reload the conversations list in the sidebar from the database"""
+        self.conversation_model.reload()
+        self.update_sidebar_visibility()
     
-    def open_conversation(self, item):
-        """Open a conversation when clicked in the sidebar"""
-        conversation_id = item.data(Qt.UserRole)
+    def conversation_renamed(self, conversation_id, title):
+        """Show a conversation's new title in the sidebar"""
+        self.conversation_model.rename_conversation(conversation_id, title)
+    
+    def update_sidebar_visibility(self):
+        """Show/hide elements based on whether there are conversations; search results take their place"""
+        has_conversations = self.conversation_model.rowCount() > 0
+        searching = bool(self.search_field.text().strip())
+        self.conversation_list.setVisible(has_conversations and not searching)
+        self.empty_label.setVisible(not has_conversations and not searching)
+    
+    def schedule_search(self, text):
+        """Restart the search delay on every keystroke; an empty query shows the conversations again"""
+        if text.strip():
+            self.search_timer.start()
+            return
+        self.search_timer.stop()
+        if self.search_results is not None:
+            self.search_results.clear()
+            self.search_results.setVisible(False)
+        self.update_sidebar_visibility()
+    
+    def search_results_list(self):
+        """The list search hits are shown in, created the first time there are any to show"""
+        if self.search_results is None:
+            self.search_results = QListWidget()
+            self.search_results.itemClicked.connect(self.open_search_result)
+            self.sidebar.layout().addWidget(self.search_results)
+        return self.search_results
+    
+    @traced("ui.run_search")
+    def run_search(self):
+        """Show the best matching messages for the text in the search field"""
+        if not self.schema_is_ready(retry=self.run_search):
+            return
+        hits = search_messages(self.search_field.text(), start_mark=SNIPPET_START, end_mark=SNIPPET_END)
+        search_results = self.search_results_list()
+        search_results.clear()
+        for hit in hits:
+            snippet = html.escape(hit['snippet'].replace("\n", " "))
+            snippet = snippet.replace(SNIPPET_START, "<b>").replace(SNIPPET_END, "</b>")
+            label = QLabel(f"""<span style="color:#666666; font-size: 12px;">{html.escape(hit['title'] or "Untitled")}</span><br>{snippet}""")
+            label.setWordWrap(True)
+            label.setStyleSheet("background-color: transparent; font-weight: 400;")
+            item = QListWidgetItem()
+            item.setData(Qt.UserRole, hit)
+            item.setSizeHint(label.sizeHint())
+            search_results.addItem(item)
+            search_results.setItemWidget(item, label)
+        if not hits:
+            search_results.addItem(QListWidgetItem("No matching messages"))
         
+        self.conversation_list.setVisible(False)
+        self.empty_label.setVisible(False)
+        search_results.setVisible(True)
+    
+    def open_search_result(self, item):
+        """Open the conversation or branch a search hit is in and scroll to the message"""
+        hit = item.data(Qt.UserRole)
+        if hit is None:
+            return
+        tab_widget = self.show_conversation(hit['root_id'])
+        if tab_widget is None:
+            return
+        for index in range(tab_widget.count()):
+            if tab_widget.widget(index).conversation_id == hit['conversation_id']:
+                tab_widget.setCurrentIndex(index)
+                self.load_branch_tab(tab_widget, index).scroll_to_message(hit['message_id'])
+                break
+    
+    def open_conversation(self, index):
+        """Open a conversation when clicked in the sidebar"""
+        self.show_conversation(index.data(Qt.UserRole))
+    
+    @traced("ui.show_conversation")
+    def show_conversation(self, conversation_id):
+        """Show a conversation's tabs, creating them the first time; returns its tab widget, or None if it no longer exists"""
         # Check if we already have a tab widget for this conversation
         if conversation_id in self.chat_tabs:
             # Show the existing tab widget
             self.chat_container.setCurrentWidget(self.chat_tabs[conversation_id])
         else:
-            # Create a new tab widget for this conversation
-            title = get_conversation_title(conversation_id)
+            # The conversation and its whole branch tree's metadata in one query
+            summaries = get_tree_summaries(conversation_id)
+            if not summaries:
+                # Deleted since the sidebar or search results were filled
+                print(f"Conversation {conversation_id} no longer exists")
+                self.refresh_conversation_list()
+                return None
+            _, title, parent_id, message_count, _ = summaries[0]
             
             # Create tab widget
-            tab_widget = QTabWidget()
-            tab_widget.setTabsClosable(True)
-            tab_widget.tabCloseRequested.connect(lambda index: self.close_branch_tab(tab_widget, index))
+            tab_widget = self.create_tab_widget()
             
             # Create main chat tab
-            main_tab = ChatTab(title, conversation_id=conversation_id, parent_window=self)
+            main_tab = ChatTab(title, conversation_id=conversation_id, parent_window=self,
+                               message_count=message_count, parent_id=parent_id)
             tab_widget.addTab(main_tab, "Main")
             
             # Load branches for this conversation
-            self.load_branches_as_tabs(conversation_id, tab_widget)
+            self.load_branches_as_tabs(conversation_id, tab_widget, summaries[1:])
             
             # Store and show the tab widget
             self.chat_tabs[conversation_id] = tab_widget
             self.chat_container.addWidget(tab_widget)
             self.chat_container.setCurrentWidget(tab_widget)
+        return self.chat_tabs[conversation_id]
     
-    def load_branches_as_tabs(self, parent_conversation_id, tab_widget):
-        """Load all branches for a conversation as tabs"""
-        branches = get_branches_for_conversation(parent_conversation_id)
+    def create_tab_widget(self):
+        """Tab widget for a conversation and its branches"""
+        tab_widget = QTabWidget()
+        tab_widget.setTabsClosable(True)
+        tab_widget.tabCloseRequested.connect(lambda index: self.close_branch_tab(tab_widget, index))
+        tab_widget.currentChanged.connect(lambda index: self.load_branch_tab(tab_widget, index))
+        return tab_widget
+    
+    def load_branches_as_tabs(self, parent_conversation_id, tab_widget, branches=None):
+        """Add placeholder tabs for every branch in a conversation's tree; each loads when first selected
         
-        for branch_id, branch_title in branches:
-            branch_tab = ChatTab(branch_title, conversation_id=branch_id, parent_window=self)
-            
-            # Get message count to determine if this is a new branch or an existing one
-            parent_message_count = get_message_count(parent_conversation_id)
-            branch_message_count = get_message_count(branch_id)
-            
-            # If this branch only has copied messages from parent, mark as first exchange
-            # But only if it has at least one message (otherwise it's completely empty)
-            if branch_message_count > 0:
-                # If parent and branch have the same number of messages,
-                # this branch hasn't had its own conversation yet
-                branch_tab.is_first_exchange = (branch_message_count == parent_message_count)
-            
-            # Add visual separator to indicate branch starting point
-            branch_tab.chat_log.append("""<div style="margin: 20px 0; text-align: center;">
-                <hr style="border: 2px solid #000000; margin: 10px 0;">
-                <div style="background-color: #ffde59; padding: 12px; border: 3px solid #000000; border-radius: 4px; display: inline-block; margin: 10px auto; box-shadow: 5px 5px 0px #000000;">
-                    <span style="color:#000000; font-weight: bold; font-size: 15px;">Branch created from parent conversation. New messages below:</span>
-                </div>
-                <hr style="border: 2px solid #000000; margin: 10px 0;">
-            </div>""")
-            
-            tab_widget.addTab(branch_tab, branch_title)
+        branches are (id, title, parent_id, message_count, depth) rows with
+        each branch before its own branches; they are queried when not passed in.
+        """
+        if branches is None:
+            branches = get_tree_summaries(parent_conversation_id)[1:]
+        
+        for branch_id, branch_title, parent_id, message_count, depth in branches:
+            placeholder = BranchTabPlaceholder(branch_id, branch_title, parent_id, message_count)
+            tab_widget.addTab(placeholder, self.branch_tab_text(branch_title, depth))
+    
+    def branch_tab_text(self, title, depth):
+        """Tab label for a branch; branches of branches are marked with how deep they are"""
+        return "↳" * (depth - 1) + (" " if depth > 1 else "") + title
+    
+    def tab_widget_for(self, conversation_id):
+        """The tab widget showing a conversation's tree, if it is open"""
+        if not conversation_id:
+            return None
+        tree = get_conversation_tree(conversation_id)
+        return self.chat_tabs.get(tree.root_id if tree else conversation_id)
+    
+    @traced("ui.load_branch_tab")
+    def load_branch_tab(self, tab_widget, index):
+        """Replace a placeholder tab with its ChatTab; returns the tab at index"""
+        placeholder = tab_widget.widget(index)
+        if not isinstance(placeholder, BranchTabPlaceholder):
+            return placeholder
+        
+        # Branches only store their own messages, so ChatTab marks a branch
+        # without any as a first exchange for title generation
+        branch_tab = ChatTab(placeholder.title, conversation_id=placeholder.conversation_id, parent_window=self,
+                             message_count=placeholder.message_count, parent_id=placeholder.parent_id)
+        
+        # Add visual separator to indicate branch starting point
+        branch_tab.chat_log.append("""<div style="margin: 20px 0; text-align: center;">
+            <hr style="border: 2px solid #000000; margin: 10px 0;">
+            <div style="background-color: #ffde59; padding: 12px; border: 3px solid #000000; border-radius: 4px; display: inline-block; margin: 10px auto; box-shadow: 5px 5px 0px #000000;">
+                <span style="color:#000000; font-weight: bold; font-size: 15px;">Branch created from parent conversation. New messages below:</span>
+            </div>
+            <hr style="border: 2px solid #000000; margin: 10px 0;">
+        </div>""")
+        
+        # Swap the tabs without the removal selecting (and loading) a neighbouring tab
+        tab_widget.blockSignals(True)
+        text = tab_widget.tabText(index)
+        tab_widget.removeTab(index)
+        tab_widget.insertTab(index, branch_tab, text)
+        tab_widget.setCurrentIndex(index)
+        tab_widget.blockSignals(False)
+        placeholder.deleteLater()
+        return branch_tab
     
     def add_branch_tab(self, parent_id, branch_id, branch_title):
-        """Add a new branch tab to the parent conversation's tab widget"""
-        if parent_id in self.chat_tabs:
-            tab_widget = self.chat_tabs[parent_id]
+        """Add a new branch tab after its parent's other branches in the conversation's tab widget"""
+        tab_widget = self.tab_widget_for(branch_id)
+        if tab_widget is not None:
+            tree = get_conversation_tree(branch_id)
             
             # We want branches to get proper titles after their first exchange
             # is_first_exchange should be true if branches are new
@@ -387,8 +582,12 @@ class ChatWindow(QMainWindow):
                 <hr style="border: 2px solid #000000; margin: 10px 0;">
             </div>""")
             
-            # Add the tab
-            index = tab_widget.addTab(branch_tab, branch_title)
+            # Add the tab after the last tab of the parent's subtree
+            subtree = {parent_id, *tree.descendants(parent_id)}
+            subtree.discard(branch_id)
+            index = max((i for i in range(tab_widget.count())
+                         if tab_widget.widget(i).conversation_id in subtree), default=tab_widget.count() - 1) + 1
+            tab_widget.insertTab(index, branch_tab, self.branch_tab_text(branch_title, tree.depth(branch_id)))
             tab_widget.setCurrentIndex(index)
             
             # Return the branch tab for further customization
@@ -400,16 +599,90 @@ class ChatWindow(QMainWindow):
         """Close a branch tab"""
         # Don't close the main tab (index 0)
         if index > 0:
+            tab_widget.widget(index).cancel_requests()
             tab_widget.removeTab(index)
-
-if __name__ == '__main__':
-    app = QApplication(sys.argv)
     
-    # Check if required dependencies are installed
-    if not check_dependencies():
-        sys.exit(1)
+    def send_to_all_branches(self, tab, message):
+        """
+        Send a message to the main conversation and every branch in its tree at once.
+        
+        All the replies stream concurrently on one asyncio event loop, so they
+        take as long as the slowest branch rather than the sum of them.
+        
+        Args:
+            tab (ChatTab): The tab the message was typed in
+            message (str): The user's message
+        """
+        tab_widget = self.tab_widget_for(tab.conversation_id)
+        if tab_widget is None:
+            # A conversation not yet saved has no branches
+            tab.input_field.setText(message)
+            tab.send_message()
+            return
+        
+        # Every branch needs its tab to show the reply in
+        current_index = tab_widget.currentIndex()
+        tabs = [self.load_branch_tab(tab_widget, index) for index in range(tab_widget.count())]
+        tab_widget.setCurrentIndex(current_index)
+        
+        requests = []
+        for branch_tab in tabs:
+            saved = branch_tab.start_reply(message)
+            branch_tab.reply_handle = RequestHandle(owner=branch_tab, key="reply")
+            requests.append((branch_tab, branch_tab.reply_handle, saved))
+        
+        get_executor().submit(self._send_to_all_thread, requests, message,
+                              priority=PRIORITY_CHAT, owner=self)
+    
+    def _send_to_all_thread(self, handle, requests, message):
+        """Worker function that runs every branch's request on one event loop"""
+        import asyncio
+        from utils import async_api_client
+        
+        async def send_all():
+            async with async_api_client.create_client() as client:
+                await async_api_client.gather_bounded(
+                    tab.call_api_async(client, tab_handle, saved, message)
+                    for tab, tab_handle, saved in requests)
         
-    window = ChatWindow()
+        try:
+            asyncio.run(send_all())
+        except Exception as e:
+            error_message = f"Error calling API: {str(e)}"
+            print(error_message)
+            for tab, tab_handle, saved in requests:
+                tab.response_failed.emit(tab_handle, error_message)
+    
+    def closeEvent(self, event):
+        """Commit queued database writes before the window goes away"""
+        shutdown_writer()
+        super().closeEvent(event)
+
+def create_app(argv):
+    """Create the application and show the main window; the caller runs the event loop
+
+    Nothing slow happens before the window is shown: schema migrations run on
+    a background thread, and markdown, pygments and the HTTP clients are
+    imported when first used.
+    """
+    app = QApplication(argv)
+    app.aboutToQuit.connect(shutdown_executor)
+    app.aboutToQuit.connect(shutdown_render_pool)
+    app.aboutToQuit.connect(close_api_session)
+    app.aboutToQuit.connect(shutdown_writer)
+    app.aboutToQuit.connect(close_connections)
+    
+    # Apply any pending schema migrations while the window comes up
+    schema_ready = init_db_async()
+    
+    window = ChatWindow(schema_ready)
     window.resize(1100, 750)
     window.show()
+    
+    # Check if required dependencies are installed, once the window is up
+    QTimer.singleShot(0, lambda: check_dependencies() or app.exit(1))
+    return app, window
+
+if __name__ == '__main__':
+    app, window = create_app(sys.argv)
     sys.exit(app.exec_())
@@ -0,0 +1,70 @@
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
+from db.database import get_root_conversations
+
+# Conversations read from the database each time the list is scrolled to the end
+SIDEBAR_PAGE_SIZE = 100
+
+class ConversationListModel(QAbstractListModel):
+    """Top-level conversations for the sidebar, newest first
+
+    Rows are read a page at a time as the view scrolls (canFetchMore /
+    fetchMore). New and renamed conversations are applied as single-row
+    inserts and updates, so the list is never rebuilt.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []  # [conversation id, title], newest first
+        # Nothing is read until reload(); the schema may still be being checked
+        self._has_more = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        conversation_id, title = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            return f"{title}"
+        if role == Qt.UserRole:
+            return conversation_id
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._has_more
+
+    def fetchMore(self, parent=QModelIndex()):
+        """Append the next page of older conversations"""
+        if parent.isValid():
+            return
+        before_id = self._rows[-1][0] if self._rows else None
+        page = get_root_conversations(SIDEBAR_PAGE_SIZE, before_id)
+        self._has_more = len(page) == SIDEBAR_PAGE_SIZE
+        if not page:
+            return
+        self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(page) - 1)
+        self._rows.extend([conversation_id, title] for conversation_id, title in page)
+        self.endInsertRows()
+
+    def reload(self):
+        """Drop every row and read the first page again"""
+        self.beginResetModel()
+        self._rows = []
+        self._has_more = True
+        self.endResetModel()
+        self.fetchMore()
+
+    def add_conversation(self, conversation_id, title):
+        """Show a newly created conversation at the top"""
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        self._rows.insert(0, [conversation_id, title])
+        self.endInsertRows()
+
+    def rename_conversation(self, conversation_id, title):
+        """Update a conversation's title if its row is loaded"""
+        for row, entry in enumerate(self._rows):
+            if entry[0] == conversation_id:
+                entry[1] = title
+                index = self.index(row)
+                self.dataChanged.emit(index, index, [Qt.DisplayRole])
+                return
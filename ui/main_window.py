@@ -1,15 +1,19 @@
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QTextEdit, QLineEdit, QPushButton, 
                            QHBoxLayout, QTabWidget, QScrollArea, QLabel, QFrame, QToolButton,
                            QMenu, QAction)
-from PyQt5.QtCore import Qt, QSize, QPoint
-from PyQt5.QtGui import QFont, QColor, QTextCursor
-from utils.api_client import get_chat_response, generate_title_from_conversation
-from db.database import (insert_message, insert_conversation, get_conversation_messages, 
-                        get_branches_for_conversation, get_conversation_title,
-                        update_conversation_title, get_message_count)
-import threading
-import markdown
-import re
+from PyQt5.QtCore import Qt, QSize, QPoint, QTimer, pyqtSignal
+from PyQt5.QtGui import QFont, QColor, QTextCursor, QTextCharFormat, QTextDocumentFragment
+from utils.request_executor import get_executor, PRIORITY_CHAT, PRIORITY_TITLE
+from db.database import (insert_message, insert_conversation, update_conversation_title,
+                        get_message_count, get_conversation_message_ids, get_conversation_page)
+from db.writer import get_writer
+from db.tree import get_conversation_tree
+from utils.context_builder import build_context
+from utils.markdown_renderer import get_renderer, plain_text_html
+from utils.tracing import traced
+
+# Messages loaded when a tab opens and each time the user scrolls to the top
+HISTORY_PAGE_SIZE = 50
 
 class BranchButton(QPushButton):
     """Custom button for displaying branches in the conversation"""
@@ -30,8 +34,38 @@ class BranchButton(QPushButton):
         self.setMaximumWidth(300)
         self.setMinimumHeight(45)
 
+class MessageSpan:
+    """Location of a rendered message in the chat log document"""
+    def __init__(self, first_block, last_block, role, db_id=None):
+        self.first_block = first_block
+        self.last_block = last_block
+        self.role = role
+        self.db_id = db_id  # messages.id, once the message is stored
+
+class BranchTabPlaceholder(QWidget):
+    """Stands in for a branch's ChatTab until the tab is first selected"""
+    def __init__(self, conversation_id, title, parent_id, message_count):
+        super().__init__()
+        self.conversation_id = conversation_id
+        self.title = title
+        self.parent_id = parent_id
+        self.message_count = message_count
+    
+    def cancel_requests(self):
+        """Nothing has been sent from a tab that was never opened"""
+
 class ChatTab(QWidget):
-    def __init__(self, title, conversation_id=None, parent_window=None):
+    # Emitted from API worker threads; Qt delivers them on the GUI thread
+    response_delta = pyqtSignal(object, str)  # request handle, text piece
+    response_finished = pyqtSignal(object, str, object)  # request handle, full reply, messages.id
+    response_failed = pyqtSignal(object, str)  # request handle, error message
+    title_generated = pyqtSignal(str)
+    message_rendered = pyqtSignal(int, str)  # message_id, HTML from the render pool
+    message_stored = pyqtSignal(int, object)  # message_id, messages.id once the writer committed it
+    
+    def __init__(self, title, conversation_id=None, parent_window=None, message_count=None, parent_id=None):
+        """message_count and parent_id can be passed in from a metadata query the
+        caller already ran; parent_id is only used when message_count is given."""
         super().__init__()
         self.conversation_id = conversation_id
         self.title = title
@@ -39,10 +73,28 @@ class ChatTab(QWidget):
         self.parent_id = None  # Will be set if this is a branch
         self.current_highlighted_text = ""  # Store the currently highlighted text
         self.branch_popup_button = None  # Will hold a reference to the floating branch button
+        self.reply_handle = None  # Executor handle of the reply in progress
+        self.reply_typing_index = None  # Document position of its typing indicator
+        self.streaming_start = None  # Document position of the reply being streamed
+        self.message_index = {}  # message_id -> MessageSpan, filled as messages are appended
+        self.oldest_loaded_id = None  # messages.id of the oldest message shown
+        self.has_older_messages = False
+        self.render_scratch = None  # Off-screen editor used to lay out re-rendered messages
+        self.pending_renders = {}  # message_id -> rendered HTML waiting to be swapped in
         self.init_ui()
         
+        self.response_delta.connect(self.show_response_delta)
+        self.response_finished.connect(self.show_response)
+        self.response_failed.connect(self.show_response_error)
+        self.title_generated.connect(self.show_title)
+        self.message_rendered.connect(self.show_rendered_message)
+        self.message_stored.connect(self.remember_message_id)
+        
         # Flag to track if this is the first exchange (for title generation)
-        self.is_first_exchange = get_message_count(self.conversation_id) == 0 if self.conversation_id else True
+        metadata_given = message_count is not None
+        if message_count is None and self.conversation_id:
+            message_count = get_message_count(self.conversation_id)
+        self.is_first_exchange = not message_count
         self.first_user_message = ""
         
         # Initialize Markdown extensions with code highlighting
@@ -102,12 +154,16 @@ class ChatTab(QWidget):
             .codehilite .s2 { color: #ce9178; } /* String.Double */
         </style>
         """
+        self.markdown_renderer = get_renderer(self.markdown_extensions, self.code_css)
         
         # Load existing messages if conversation_id exists
         if self.conversation_id:
             self.load_conversation_history()
             # Get parent_id if this is a branch
-            self.check_if_branch()
+            if not metadata_given:
+                self.check_if_branch()
+            else:
+                self.parent_id = parent_id
         
         # Add CSS to chat log
         self.chat_log.document().setDefaultStyleSheet(self.code_css)
@@ -135,6 +191,10 @@ class ChatTab(QWidget):
         # Connect text selection change signal to handle highlighted text
         self.chat_log.selectionChanged.connect(self.handle_text_selection)
         
+        # QTextEdit can't run the message option links, so map clicks on them ourselves
+        self.chat_log.mousePressEvent = self.handle_chat_log_mouse_press
+        self.chat_log.verticalScrollBar().valueChanged.connect(self.handle_history_scroll)
+        
         layout.addWidget(self.chat_log)
         
         # Input area
@@ -212,8 +272,16 @@ class ChatTab(QWidget):
         """)
         self.branch_button.clicked.connect(self.create_branch)
         
+        self.send_all_button = QPushButton("Send to All")
+        self.send_all_button.setMinimumHeight(50)
+        self.send_all_button.setMinimumWidth(120)
+        self.send_all_button.setToolTip("Send this message to every branch of the conversation at once")
+        self.send_all_button.setStyleSheet(self.branch_button.styleSheet())
+        self.send_all_button.clicked.connect(self.send_to_all_branches)
+        
         button_layout.addWidget(self.send_button)
         button_layout.addWidget(self.branch_button)
+        button_layout.addWidget(self.send_all_button)
         
         h_layout.addLayout(button_layout)
         layout.addWidget(input_area)
@@ -224,14 +292,27 @@ class ChatTab(QWidget):
 
     def check_if_branch(self):
         """Get parent_id if this is a branch conversation"""
-        from db.database import get_parent_id
-        self.parent_id = get_parent_id(self.conversation_id)
+        tree = get_conversation_tree(self.conversation_id)
+        self.parent_id = tree.parent(self.conversation_id) if tree else None
 
-    def format_markdown(self, text):
-        """Convert markdown text to HTML with syntax highlighting"""
-        # Process code blocks with syntax highlighting
-        html = markdown.markdown(text, extensions=self.markdown_extensions)
-        return html
+    def format_markdown(self, text, message_id=None):
+        """Convert markdown text to HTML with syntax highlighting
+        
+        For a message in the chat log, code blocks are highlighted in the
+        render pool: plain text is returned for now and the message is
+        redrawn through message_rendered when the HTML is ready.
+        """
+        if message_id is None:
+            return self.markdown_renderer.render(text)
+        html = self.markdown_renderer.render_async(text, lambda html: self.deliver_rendered_message(message_id, html))
+        return html if html is not None else plain_text_html(text)
+    
+    def deliver_rendered_message(self, message_id, html):
+        """Called on a render pool thread; hands the HTML to the GUI thread"""
+        try:
+            self.message_rendered.emit(message_id, html)
+        except RuntimeError:
+            pass  # The tab was closed while the message was rendering
         
     def get_next_message_id(self):
         """Generate a unique ID for the next message"""
@@ -240,79 +321,221 @@ class ChatTab(QWidget):
         self._message_counter += 1
         return self._message_counter
 
+    @traced("ui.load_conversation_history")
     def load_conversation_history(self):
-        """Load existing messages from the database into the chat log"""
-        messages = get_conversation_messages(self.conversation_id)
-        for message in messages:
-            message_id = self.get_next_message_id()
-            if message['role'] == 'user':
-                formatted_content = self.format_markdown(message['content'])
-                self.chat_log.append(f"""<div id="msg-{message_id}" style="margin: 10px 0; padding: 16px; background-color: #f8f8f8; border-radius: 12px;">
-                    <div style="display: flex; justify-content: space-between; align-items: center;">
-                        <b style="color:#000000; font-size: 15px; font-weight: 500;">You</b>
-                        <span class="message-options" data-id="{message_id}" data-role="user" style="cursor: pointer; font-weight: 500; color: #666666;">⋮</span>
-                    </div>
-                    <div style="margin-top: 8px; line-height: 1.6;">{formatted_content}</div>
-                </div>""")
-            else:
-                formatted_content = self.format_markdown(message['content'])
-                self.chat_log.append(f"""<div id="msg-{message_id}" style="margin: 10px 0; padding: 16px; background-color: #ffffff; border: 1px solid #e1e1e1; border-radius: 12px;">
-                    <div style="display: flex; justify-content: space-between; align-items: center;">
-                        <b style="color:#000000; font-size: 15px; font-weight: 500;">Assistant</b>
-                        <span class="message-options" data-id="{message_id}" data-role="assistant" style="cursor: pointer; font-weight: 500; color: #666666;">⋮</span>
-                    </div>
-                    <div style="margin-top: 8px; line-height: 1.6;">{formatted_content}</div>
-                </div>""")
-        
-        # Connect options menu after loading all messages
-        self.connect_options_menu()
+        """Load the latest page of messages from the database into the chat log"""
+        rows = get_conversation_page(self.conversation_id, HISTORY_PAGE_SIZE)
+        self.prefetch_rendered(rows)
+        for db_id, role, content in rows:
+            self.append_message(role, content, db_id)
+        
+        # Older messages are paged in when the user scrolls to the top
+        self.oldest_loaded_id = rows[0][0] if rows else None
+        self.has_older_messages = len(rows) == HISTORY_PAGE_SIZE
 
-    def connect_options_menu(self):
-        """Connect the options menu to all message option buttons"""
-        self.chat_log.document().documentLayout().documentSizeChanged.connect(
-            lambda: self.setup_message_options())
+    def prefetch_rendered(self, rows):
+        """Load a page's cached HTML in one query instead of one per message"""
+        self.markdown_renderer.prefetch([content for _, role, content in rows if role != 'system'])
 
-    def setup_message_options(self):
-        """Setup event handlers for message option buttons"""
-        # We need to use JavaScript to handle the click events for the message options
-        script = """
-        var optionElements = document.getElementsByClassName('message-options');
-        for (var i = 0; i < optionElements.length; i++) {
-            optionElements[i].onclick = function() {
-                var messageId = this.getAttribute('data-id');
-                var role = this.getAttribute('data-role');
-                window.messageOptionClicked(messageId, role);
-            };
-        }
-        """
+    def handle_history_scroll(self, value):
+        """Page in older messages once the chat log is scrolled to the top"""
+        if value == self.chat_log.verticalScrollBar().minimum() and self.has_older_messages:
+            self.load_older_messages()
+
+    @traced("ui.load_older_messages")
+    def load_older_messages(self):
+        """Prepend the page of messages before the oldest one shown"""
+        rows = get_conversation_page(self.conversation_id, HISTORY_PAGE_SIZE, before_id=self.oldest_loaded_id)
+        self.has_older_messages = len(rows) == HISTORY_PAGE_SIZE
+        if not rows:
+            return
+        self.oldest_loaded_id = rows[0][0]
+        self.prefetch_rendered(rows)
+        
+        # Lay the page out in a scratch document with the same markup and styles
+        scratch = QTextEdit()
+        scratch.document().setDefaultStyleSheet(self.chat_log.document().defaultStyleSheet())
+        page_spans = []
+        for db_id, role, content in rows:
+            message_id = self.get_next_message_id()
+            first_block = scratch.document().blockCount() if not scratch.document().isEmpty() else 0
+            scratch.append(self.message_html(message_id, role, content))
+            page_spans.append((message_id, first_block, scratch.document().blockCount() - 1, role, db_id))
+        
+        document = self.chat_log.document()
+        scroll_bar = self.chat_log.verticalScrollBar()
+        old_blocks, old_chars, old_maximum = document.blockCount(), document.characterCount(), scroll_bar.maximum()
+        first_state = document.firstBlock().userState()
+        
+        # Insert ahead of an empty block so the page doesn't merge into the first message
+        cursor = QTextCursor(document)
+        cursor.movePosition(QTextCursor.Start)
+        cursor.insertBlock()
+        cursor.movePosition(QTextCursor.Start)
+        cursor.insertFragment(QTextDocumentFragment(scratch.document()))
+        
+        # Everything already shown moved down; keep the index and positions in step
+        added_blocks = document.blockCount() - old_blocks
+        added_chars = document.characterCount() - old_chars
+        # Splitting the first block left its text in a new block without the tag
+        document.findBlockByNumber(added_blocks).setUserState(first_state)
+        for span in self.message_index.values():
+            span.first_block += added_blocks
+            span.last_block += added_blocks
+        if self.streaming_start is not None:
+            self.streaming_start += added_chars
+        if self.reply_typing_index is not None:
+            self.reply_typing_index += added_chars
+        for message_id, first_block, last_block, role, db_id in page_spans:
+            self.index_message(message_id, first_block, last_block, role, db_id)
+        
+        # Keep the message that was at the top in view
+        scroll_bar.setValue(scroll_bar.value() + scroll_bar.maximum() - old_maximum)
+
+    def scroll_to_message(self, db_id):
+        """Scroll a stored message to the top of the chat log, paging in older history until it is shown"""
+        def find_span():
+            return next((span for span in self.message_index.values() if span.db_id == db_id), None)
+        
+        span = find_span()
+        while span is None and self.has_older_messages and db_id < self.oldest_loaded_id:
+            self.load_older_messages()
+            span = find_span()
+        if span is None:
+            return
         
-        # This won't work directly since QTextEdit doesn't have full browser capabilities
-        # Instead, we'll use mousePress and manually check for clicks on options
-        self.chat_log.mousePressEvent = self.handle_chat_log_mouse_press
+        block = self.chat_log.document().findBlockByNumber(span.first_block)
+        top = self.chat_log.document().documentLayout().blockBoundingRect(block).top()
+        self.chat_log.verticalScrollBar().setValue(int(top))
+
+    def message_html(self, message_id, role, content):
+        """Markup for a message in the chat log"""
+        if role == 'system':
+            return self.selection_context_html(content)
+        return self.message_frame_html(message_id, role, self.format_markdown(content, message_id))
+    
+    def message_frame_html(self, message_id, role, formatted_content):
+        """Markup around a message's rendered content"""
+        if role == 'user':
+            label, background = "You", "background-color: #f8f8f8;"
+        else:
+            label, background = "Assistant", "background-color: #ffffff; border: 1px solid #e1e1e1;"
+        return f"""<div id="msg-{message_id}" style="margin: 10px 0; padding: 16px; {background} border-radius: 12px;">
+            <div style="display: flex; justify-content: space-between; align-items: center;">
+                <b style="color:#000000; font-size: 15px; font-weight: 500;">{label}</b>
+                <span class="message-options" data-id="{message_id}" data-role="{role}" style="cursor: pointer; font-weight: 500; color: #666666;">⋮</span>
+            </div>
+            <div style="margin-top: 8px; line-height: 1.6;">{formatted_content}</div>
+        </div>"""
+
+    def selection_context_html(self, selected_text):
+        """Markup for the highlighted text a branch was created from"""
+        # Check if it's code by looking for common patterns
+        is_code = False
+        if "```" in selected_text or any(keyword in selected_text for keyword in ["def ", "function", "class ", "import ", "from ", "var ", "const "]):
+            is_code = True
+        
+        if is_code:
+            # Format as code block with special styling
+            return f"""<div style="margin: 15px 0; padding: 16px; background-color: #1e1e1e; border-radius: 12px;">
+                <b style="color:#ffffff; font-size: 15px; font-weight: 500;">Selected Code Context</b>
+                <pre style="margin-top: 12px; padding: 15px; background-color: #2d2d2d; border-radius: 8px; color: #e0e0e0; font-family: 'SF Mono', Menlo, Consolas, monospace; font-size: 14px; line-height: 1.6; overflow-x: auto;">{selected_text}</pre>
+            </div>"""
+        # Format as regular text with special styling
+        return f"""<div style="margin: 15px 0; padding: 16px; background-color: #f8f8f8; border-radius: 12px;">
+            <b style="color:#000000; font-size: 15px; font-weight: 500;">Selected Text Context</b>
+            <div style="margin-top: 8px; padding: 12px; background-color: #ffffff; border: 1px solid #e1e1e1; border-radius: 8px; font-style: italic; line-height: 1.6;">{selected_text}</div>
+        </div>"""
+
+    @traced("ui.append_message")
+    def append_message(self, role, content, db_id=None):
+        """Render a message at the end of the chat log and index its blocks"""
+        message_id = self.get_next_message_id()
+        document = self.chat_log.document()
+        # append() fills the first block of an empty document instead of adding one
+        first_block = document.blockCount() if not document.isEmpty() else 0
+        self.chat_log.append(self.message_html(message_id, role, content))
+        self.index_message(message_id, first_block, document.blockCount() - 1, role, db_id)
+        return message_id
+
+    def show_rendered_message(self, message_id, formatted_content):
+        """Queue a message's rendered HTML; renders arriving together are swapped in at once"""
+        if not self.pending_renders:
+            QTimer.singleShot(0, self.flush_rendered_messages)
+        self.pending_renders[message_id] = formatted_content
+    
+    def flush_rendered_messages(self):
+        """Swap the plain-text placeholders of the queued messages for their rendered HTML"""
+        pending, self.pending_renders = self.pending_renders, {}
+        spans = [(self.message_index[message_id], message_id) for message_id in pending
+                 if message_id in self.message_index]
+        document = self.chat_log.document()
+        cursor = QTextCursor(document)
+        # One edit block so the document is laid out once for the whole batch
+        cursor.beginEditBlock()
+        # Bottom up, so each swap leaves the blocks of the ones still to do in place
+        for span, message_id in sorted(spans, key=lambda item: item[0].first_block, reverse=True):
+            self.replace_message_content(cursor, message_id, span, pending[message_id])
+        cursor.endEditBlock()
+    
+    @traced("ui.replace_message")
+    def replace_message_content(self, cursor, message_id, span, formatted_content):
+        """Replace the blocks of an indexed message with new markup and re-index them"""
+        document = self.chat_log.document()
+        old_blocks, old_chars = document.blockCount(), document.characterCount()
+        
+        # Lay the message out the same way append() does, in a scratch editor kept for reuse
+        if self.render_scratch is None:
+            self.render_scratch = QTextEdit()
+            self.render_scratch.document().setDefaultStyleSheet(document.defaultStyleSheet())
+        scratch = self.render_scratch
+        scratch.clear()
+        scratch.append(self.message_frame_html(message_id, span.role, formatted_content))
+        
+        start = document.findBlockByNumber(span.first_block).position()
+        last = document.findBlockByNumber(span.last_block)
+        cursor.setPosition(start)
+        cursor.setPosition(last.position() + last.length() - 1, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        cursor.insertFragment(QTextDocumentFragment(scratch.document()))
+        
+        # Messages and pending replies after this one moved by the size difference
+        added_blocks = document.blockCount() - old_blocks
+        added_chars = document.characterCount() - old_chars
+        for other in self.message_index.values():
+            if other.first_block > span.first_block:
+                other.first_block += added_blocks
+                other.last_block += added_blocks
+        if self.streaming_start is not None and self.streaming_start > start:
+            self.streaming_start += added_chars
+        if self.reply_typing_index is not None and self.reply_typing_index > start:
+            self.reply_typing_index += added_chars
+        self.index_message(message_id, span.first_block, span.last_block + added_blocks, span.role, span.db_id)
+    
+    def index_message(self, message_id, first_block, last_block, role, db_id=None):
+        """Record where a message sits and tag its blocks so a click maps back to it directly"""
+        block = self.chat_log.document().findBlockByNumber(first_block)
+        while block.isValid() and block.blockNumber() <= last_block:
+            block.setUserState(message_id)
+            block = block.next()
+        self.message_index[message_id] = MessageSpan(first_block, last_block, role, db_id)
 
     def handle_chat_log_mouse_press(self, event):
         """Handle mouse press events in the chat log"""
         # Call the original mousePressEvent
         QTextEdit.mousePressEvent(self.chat_log, event)
         
-        # Get the position and check if we clicked on a message option
+        # Look up the message under the click through its block tag
         cursor = self.chat_log.cursorForPosition(event.pos())
-        format = cursor.charFormat()
+        block = cursor.block()
+        span = self.message_index.get(block.userState())
+        if span is None or block.blockNumber() != span.first_block:
+            return
         
-        # Check if the cursor is at a position with a message-options class
-        if cursor.atBlockEnd() and "message-options" in self.chat_log.toHtml()[cursor.position()-30:cursor.position()+30]:
-            # Determine which message was clicked by examining nearby HTML
-            html_fragment = self.chat_log.toHtml()[max(0, cursor.position()-100):cursor.position()+100]
-            
-            # Try to extract message ID and role using simple pattern matching
-            import re
-            match = re.search(r'data-id="(\d+)" data-role="([^"]+)"', html_fragment)
-            if match:
-                message_id = match.group(1)
-                message_role = match.group(2)
-                
-                # Show context menu at the current mouse position
-                self.show_message_options_menu(event.globalPos(), message_id, message_role)
+        # Only the options marker at the end of the message header opens the menu
+        header = block.text().rstrip()
+        if header.endswith("⋮") and cursor.positionInBlock() >= len(header) - 1:
+            self.show_message_options_menu(event.globalPos(), str(block.userState()), span.role)
 
     def show_message_options_menu(self, position, message_id, message_role):
         """Show context menu for a message"""
@@ -331,25 +554,25 @@ class ChatTab(QWidget):
         if not self.conversation_id:
             return
             
-        # If this is already a branch, use its parent_id
-        parent_id = self.parent_id if self.parent_id else self.conversation_id
+        # Branches of branches keep their place in the tree
+        parent_id = self.conversation_id
         
         # Create a new branch title
         branch_title = f"Branch from message #{message_id}"
-        new_convo_id = insert_conversation(parent_id=parent_id, title=branch_title)
         
-        # Get the parent conversation's history
-        all_messages = get_conversation_messages(self.conversation_id)
-        
-        # Only include messages up to and including the selected message
-        # First, find the index of the selected message
-        message_index = int(message_id) - 1  # Assuming IDs are sequential and 1-indexed
-        message_index = min(message_index, len(all_messages) - 1)  # Safety check
+        # The branch inherits the history up to and including the selected message
+        get_writer().flush()  # A just-sent message gets its database id
+        span = self.message_index.get(int(message_id))
+        if span is None or span.db_id is None:
+            # e.g. a reply that failed to save; there is nothing to fork from
+            self.chat_log.append(f"""<div style="margin: 10px 0; padding: 12px; background-color: #ffcccc; border: 2px solid #000000; border-radius: 4px;">
+                <i style="color:#000000;"><b>Error:</b> Could not create branch - message #{message_id} is not saved</i>
+            </div>""")
+            return
+        fork_message_id = span.db_id
         
-        # Copy messages up to and including the selected message
-        for i, message in enumerate(all_messages):
-            if i <= message_index:
-                insert_message(new_convo_id, message['role'], message['content'])
+        new_convo_id = get_writer().write(insert_conversation, parent_id=parent_id, title=branch_title,
+                                          fork_message_id=fork_message_id)
         
         # Check if parent window is available for tab management
         if not self.parent_window:
@@ -376,43 +599,74 @@ class ChatTab(QWidget):
     def send_message(self):
         message = self.input_field.text().strip()
         if message:
-            formatted_message = self.format_markdown(message)
-            message_id = self.get_next_message_id()
-            self.chat_log.append(f"""<div id="msg-{message_id}" style="margin: 10px 0; padding: 16px; background-color: #f8f8f8; border-radius: 12px;">
-                <div style="display: flex; justify-content: space-between; align-items: center;">
-                    <b style="color:#000000; font-size: 15px; font-weight: 500;">You</b>
-                    <span class="message-options" data-id="{message_id}" data-role="user" style="cursor: pointer; font-weight: 500; color: #666666;">⋮</span>
-                </div>
-                <div style="margin-top: 8px; line-height: 1.6;">{formatted_message}</div>
-            </div>""")
             self.input_field.clear()
+            saved = self.start_reply(message)
             
-            # Connect options menu to the newly added message
-            self.connect_options_menu()
-            
-            # Store the first user message for title generation
-            if self.is_first_exchange:
-                self.first_user_message = message
-            
-            # Make sure we have a conversation_id
-            if not self.conversation_id:
-                self.conversation_id = insert_conversation(title=self.title)
-            
-            # Add the user message to the database
-            insert_message(self.conversation_id, "user", message)
-            
-            # Retrieve the full conversation history including the latest message
-            conversation_history = get_conversation_messages(self.conversation_id)
-            
-            # Show typing indicator
-            typing_index = self.chat_log.document().characterCount()
-            self.chat_log.append("""<div style="margin: 10px 0; padding: 16px; background-color: #ffffff; border: 1px solid #e1e1e1; border-radius: 12px;">
-                <i style="color:#666666;">Assistant is typing...</i>
-            </div>""")
-            
-            # Start the API call in a separate thread to avoid UI freezing
-            thread = threading.Thread(target=self.call_api, args=(conversation_history, typing_index, message))
-            thread.start()
+            # Run the API call on the shared worker pool to avoid UI freezing
+            self.reply_handle = get_executor().submit(self.call_api, saved, message,
+                                                      priority=PRIORITY_CHAT, owner=self, key="reply")
+
+    def send_to_all_branches(self):
+        """Send the input field's message to this tab and every other branch of the conversation at once"""
+        message = self.input_field.text().strip()
+        if message and self.parent_window:
+            self.input_field.clear()
+            self.parent_window.send_to_all_branches(self, message)
+
+    def start_reply(self, message):
+        """
+        Show a user message, queue it for storing and put up the typing indicator.
+        
+        The caller sends the request and sets self.reply_handle.
+        
+        Args:
+            message (str): The user's message
+        
+        Returns:
+            Future: Resolves once the message is committed; the request waits
+            for it before reading the history
+        """
+        # A new message supersedes a reply that is still on its way
+        if self.reply_handle is not None:
+            self.reply_handle.cancel()
+            self.show_response_error(self.reply_handle, "Reply cancelled because a new message was sent")
+        
+        message_id = self.append_message("user", message)
+        
+        # Store the first user message for title generation
+        if self.is_first_exchange:
+            self.first_user_message = message
+        
+        # Make sure we have a conversation_id; only the first message of a new
+        # conversation waits for the database
+        if not self.conversation_id:
+            self.conversation_id = get_writer().write(insert_conversation, title=self.title)
+        
+        # Add the user message to the database on the writer thread
+        saved = get_writer().submit(insert_message, self.conversation_id, "user", message)
+        
+        def remember_id(future):
+            # Runs on the writer thread; the span is updated on the GUI thread
+            if future.exception() is None:
+                try:
+                    self.message_stored.emit(message_id, future.result())
+                except RuntimeError:
+                    pass  # The tab was closed before the message was stored
+        saved.add_done_callback(remember_id)
+        
+        # Show typing indicator
+        self.reply_typing_index = self.chat_log.document().characterCount()
+        self.chat_log.append("""<div style="margin: 10px 0; padding: 16px; background-color: #ffffff; border: 1px solid #e1e1e1; border-radius: 12px;">
+            <i style="color:#666666;">Assistant is typing...</i>
+        </div>""")
+        return saved
+
+    def remember_message_id(self, message_id, db_id):
+        """Record a shown message's database id once it is stored"""
+        # Looked up now: the message may have been redrawn under a new span meanwhile
+        span = self.message_index.get(message_id)
+        if span is not None:
+            span.db_id = db_id
 
     def simulate_response(self, user_message):
         response = f"Simulated reply for: {user_message}"
@@ -425,17 +679,10 @@ class ChatTab(QWidget):
     def create_branch(self):
         # Need to have a conversation_id to branch from
         if not self.conversation_id:
-            self.conversation_id = insert_conversation(title=self.title)
+            self.conversation_id = get_writer().write(insert_conversation, title=self.title)
         
-        # If this is already a branch, use its parent_id
-        parent_id = self.parent_id if self.parent_id else self.conversation_id
-        
-        # Create a new conversation with the parent ID
-        branch_title = f"Branch of {self.title}"
-        new_convo_id = insert_conversation(parent_id=parent_id, title=branch_title)
-        
-        # Get the parent conversation's history
-        parent_messages = get_conversation_messages(self.conversation_id)
+        # Branches of branches keep their place in the tree
+        parent_id = self.conversation_id
         
         # Check if parent window is available for tab management
         if not self.parent_window:
@@ -444,9 +691,13 @@ class ChatTab(QWidget):
             </div>""")
             return
         
-        # Copy messages to the new branch
-        for message in parent_messages:
-            insert_message(new_convo_id, message['role'], message['content'])
+        # Create a new conversation with the parent ID that inherits the whole current history
+        branch_title = f"Branch of {self.title}"
+        get_writer().flush()  # The history must include messages still being written
+        history_ids = get_conversation_message_ids(self.conversation_id)
+        fork_message_id = history_ids[-1] if history_ids else None
+        new_convo_id = get_writer().write(insert_conversation, parent_id=parent_id, title=branch_title,
+                                          fork_message_id=fork_message_id)
         
         # Add the branch to parent's tab widget
         self.parent_window.add_branch_tab(parent_id, new_convo_id, branch_title)
@@ -456,101 +707,202 @@ class ChatTab(QWidget):
             <span style="color:#000000; font-weight: 500; font-size: 15px;">Branch created: {branch_title}</span>
         </div>""")
 
-    def call_api(self, conversation_history, typing_index=None, user_message=None):
+    def call_api(self, handle, saved, user_message=None):
+        """Worker function run by the request executor; results go back through signals"""
+        # The HTTP client is imported on first use, keeping requests out of startup
+        from utils.api_client import stream_chat_response, RequestCancelledError
         try:
-            response = get_chat_response(conversation_history)
-            
-            # Remove typing indicator if it exists
-            if typing_index is not None:
-                cursor = self.chat_log.textCursor()
-                cursor.setPosition(typing_index)
-                cursor.movePosition(cursor.End, cursor.KeepAnchor)
-                cursor.removeSelectedText()
-            
-            # Format assistant response with markdown
-            formatted_response = self.format_markdown(response)
-            message_id = self.get_next_message_id()
-            self.chat_log.append(f"""<div id="msg-{message_id}" style="margin: 10px 0; padding: 16px; background-color: #ffffff; border: 1px solid #e1e1e1; border-radius: 12px;">
-                <div style="display: flex; justify-content: space-between; align-items: center;">
-                    <b style="color:#000000; font-size: 15px; font-weight: 500;">Assistant</b>
-                    <span class="message-options" data-id="{message_id}" data-role="assistant" style="cursor: pointer; font-weight: 500; color: #666666;">⋮</span>
-                </div>
-                <div style="margin-top: 8px; line-height: 1.6;">{formatted_response}</div>
-            </div>""")
+            # Build the request context once the user message is stored: the
+            # recent history that fits the token budget
+            saved.result()
+            conversation_history = build_context(self.conversation_id)
             
-            # Connect options menu to the newly added message
-            self.connect_options_menu()
-            
-            # Double-check we have conversation_id before inserting
-            if not self.conversation_id:
-                self.conversation_id = insert_conversation(title=self.title)
-            
-            insert_message(self.conversation_id, "assistant", response)
-            
-            # Generate title after first exchange
-            if self.is_first_exchange and user_message and self.conversation_id:
-                self.is_first_exchange = False
-                self.generate_and_update_title(user_message, response)
+            # Stream the reply; each piece is drawn on the GUI thread as it arrives
+            chunks = []
+            for delta in stream_chat_response(conversation_history, cancel=handle.cancel_event):
+                if handle.cancelled():
+                    # Tab closed or reply superseded: drop the partial reply
+                    return
+                chunks.append(delta)
+                self.response_delta.emit(handle, delta)
+            self.finish_reply(handle, "".join(chunks), user_message)
                 
+        except RequestCancelledError:
+            # Cancelled while waiting on the rate limits or a retry
+            return
         except Exception as e:
             error_message = f"Error calling API: {str(e)}"
             print(error_message)
+            self.response_failed.emit(handle, error_message)
+    
+    async def call_api_async(self, client, handle, saved, user_message=None):
+        """call_api for the asyncio client; several tabs' replies run on one event loop"""
+        import asyncio
+        from utils import async_api_client
+        from utils.api_client import RequestCancelledError
+        try:
+            # Database work runs off the loop, so the other branches keep streaming meanwhile
+            await asyncio.wrap_future(saved)
+            conversation_history = await asyncio.to_thread(build_context, self.conversation_id)
             
-            # Remove typing indicator if it exists
-            if typing_index is not None:
-                cursor = self.chat_log.textCursor()
-                cursor.setPosition(typing_index)
-                cursor.movePosition(cursor.End, cursor.KeepAnchor)
-                cursor.removeSelectedText()
-            
-            self.chat_log.append(f"""<div style="margin: 10px 0; padding: 16px; background-color: #fff5f5; border-radius: 12px;">
-                <b style="color:#dc2626; font-size: 15px; font-weight: 500;">Error</b>
-                <div style="margin-top: 8px; color: #dc2626; line-height: 1.6;">{error_message}</div>
+            chunks = []
+            async for delta in async_api_client.stream_chat_response(client, conversation_history,
+                                                                     cancel=handle.cancel_event):
+                if handle.cancelled():
+                    return
+                chunks.append(delta)
+                self.response_delta.emit(handle, delta)
+            response = "".join(chunks)
+            db_id = await asyncio.wrap_future(
+                get_writer().submit(insert_message, self.conversation_id, "assistant", response))
+            self.reply_stored(handle, response, db_id, user_message)
+        
+        except RequestCancelledError:
+            # Tab closed while waiting on the rate limits or a retry
+            return
+        except Exception as e:
+            error_message = f"Error calling API: {str(e)}"
+            print(error_message)
+            self.response_failed.emit(handle, error_message)
+    
+    def finish_reply(self, handle, response, user_message=None):
+        """Store a complete reply and show it; called on the worker thread"""
+        # Double-check we have conversation_id before inserting
+        if not self.conversation_id:
+            self.conversation_id = get_writer().write(insert_conversation, title=self.title)
+        
+        # Persist the complete reply once, then replace the streamed text with it
+        db_id = get_writer().write(insert_message, self.conversation_id, "assistant", response)
+        self.reply_stored(handle, response, db_id, user_message)
+    
+    def reply_stored(self, handle, response, db_id, user_message=None):
+        """Show a stored reply in place of the streamed text; called on the worker thread"""
+        self.response_finished.emit(handle, response, db_id)
+        
+        # Generate title after first exchange
+        if self.is_first_exchange and user_message and self.conversation_id:
+            self.is_first_exchange = False
+            self.generate_and_update_title(user_message, response)
+    
+    def remove_from_position(self, position):
+        """Remove everything from the block starting at position to the end of the chat log"""
+        cursor = QTextCursor(self.chat_log.document())
+        # Start at the preceding block separator so no empty block is left behind
+        cursor.setPosition(max(position - 1, 0))
+        cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+    
+    def clear_pending_reply(self):
+        """Remove the typing indicator or partially streamed reply of the current request"""
+        start = self.streaming_start if self.streaming_start is not None else self.reply_typing_index
+        self.streaming_start = None
+        self.reply_typing_index = None
+        if start is not None:
+            self.remove_from_position(start)
+    
+    @traced("ui.show_response_delta")
+    def show_response_delta(self, handle, delta):
+        """Append a streamed piece of the assistant's reply to the chat log"""
+        if handle is not self.reply_handle:
+            return  # Late output from a superseded request
+        
+        if self.streaming_start is None:
+            # First piece: swap the typing indicator for the reply header
+            self.clear_pending_reply()
+            self.streaming_start = self.chat_log.document().characterCount()
+            self.chat_log.append("""<div style="margin: 10px 0; padding: 16px; background-color: #ffffff; border: 1px solid #e1e1e1; border-radius: 12px;">
+                <b style="color:#000000; font-size: 15px; font-weight: 500;">Assistant</b>
             </div>""")
+            self.chat_log.append("")
+        
+        # Plain text while streaming; markdown is rendered once the reply is complete
+        cursor = QTextCursor(self.chat_log.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.setCharFormat(QTextCharFormat())
+        cursor.insertText(delta)
+        
+        scroll_bar = self.chat_log.verticalScrollBar()
+        scroll_bar.setValue(scroll_bar.maximum())
+    
+    def show_response(self, handle, response, db_id=None):
+        """Replace the typing indicator or streamed text with the formatted reply"""
+        if handle is not self.reply_handle:
+            return
+        self.clear_pending_reply()
+        self.reply_handle = None
+        self.append_message("assistant", response, db_id)
+    
+    def show_response_error(self, handle, error_message):
+        """Replace the typing indicator or streamed text with an error notice"""
+        if handle is not self.reply_handle:
+            return
+        self.clear_pending_reply()
+        self.reply_handle = None
+        
+        self.chat_log.append(f"""<div style="margin: 10px 0; padding: 16px; background-color: #fff5f5; border-radius: 12px;">
+            <b style="color:#dc2626; font-size: 15px; font-weight: 500;">Error</b>
+            <div style="margin-top: 8px; color: #dc2626; line-height: 1.6;">{error_message}</div>
+        </div>""")
+    
+    def cancel_requests(self):
+        """Cancel this tab's outstanding API requests, e.g. when the tab is closed"""
+        get_executor().cancel_owner(self)
+        if self.reply_handle is not None:
+            # Replies sent to all branches run outside the executor's bookkeeping
+            self.reply_handle.cancel()
+        self.reply_handle = None
     
     def generate_and_update_title(self, user_message, assistant_response):
         """Generate a title based on the first exchange and update the conversation"""
         if not self.conversation_id:
             return
         
-        # Start a thread to generate the title
-        thread = threading.Thread(target=self._generate_title_thread, args=(user_message, assistant_response))
-        thread.start()
+        # Titles wait behind chat replies; a newer title request replaces an older one
+        get_executor().submit(self._generate_title_thread, user_message, assistant_response,
+                              priority=PRIORITY_TITLE, owner=self, key="title")
     
-    def _generate_title_thread(self, user_message, assistant_response):
-        """Thread function to generate and update the conversation title"""
+    def _generate_title_thread(self, handle, user_message, assistant_response):
+        """Worker function to generate the conversation title and store it"""
+        from utils.api_client import generate_title_from_conversation, RequestCancelledError
         try:
             # Generate title using the API
-            new_title = generate_title_from_conversation(user_message, assistant_response)
+            new_title = generate_title_from_conversation(user_message, assistant_response,
+                                                         cancel=handle.cancel_event)
             
             # Update the database
-            if new_title and new_title != "New Conversation" and new_title != "New Chat":
-                update_conversation_title(self.conversation_id, new_title)
+            if new_title and new_title != "New Conversation" and new_title != "New Chat" and not handle.cancelled():
+                get_writer().submit(update_conversation_title, self.conversation_id, new_title)
                 self.title = new_title
-                
-                # Update in UI - find the tab widget containing this tab
-                if self.parent_window:
-                    if self.parent_id:
-                        # This is a branch tab
-                        if self.parent_id in self.parent_window.chat_tabs:
-                            tab_widget = self.parent_window.chat_tabs[self.parent_id]
-                            for i in range(tab_widget.count()):
-                                if tab_widget.widget(i) == self:
-                                    tab_widget.setTabText(i, new_title)
-                                    break
-                    else:
-                        # This is a main tab
-                        if self.conversation_id in self.parent_window.chat_tabs:
-                            tab_widget = self.parent_window.chat_tabs[self.conversation_id]
-                            # Update main tab text (usually at index 0)
-                            if tab_widget.widget(0) == self:
-                                tab_widget.setTabText(0, "Main")
-                            
-                        # Refresh sidebar to show updated title
-                        self.parent_window.refresh_conversation_list()
+                self.title_generated.emit(new_title)
                         
+        except RequestCancelledError:
+            pass
         except Exception as e:
             print(f"Error generating title: {str(e)}")
+    
+    def show_title(self, new_title):
+        """Show a newly generated title in the tab bar and sidebar"""
+        # Update in UI - find the tab widget containing this tab
+        if self.parent_window:
+            if self.parent_id:
+                # This is a branch tab, somewhere in its root conversation's tab widget
+                tab_widget = self.parent_window.tab_widget_for(self.conversation_id)
+                if tab_widget is not None:
+                    depth = get_conversation_tree(self.conversation_id).depth(self.conversation_id)
+                    for i in range(tab_widget.count()):
+                        if tab_widget.widget(i) == self:
+                            tab_widget.setTabText(i, self.parent_window.branch_tab_text(new_title, depth))
+                            break
+            else:
+                # This is a main tab
+                if self.conversation_id in self.parent_window.chat_tabs:
+                    tab_widget = self.parent_window.chat_tabs[self.conversation_id]
+                    # Update main tab text (usually at index 0)
+                    if tab_widget.widget(0) == self:
+                        tab_widget.setTabText(0, "Main")
+                    
+                # Show the updated title in the sidebar
+                self.parent_window.conversation_renamed(self.conversation_id, new_title)
 
     def handle_text_selection(self):
         """Handle when text is selected/highlighted in the chat log"""
@@ -608,16 +960,11 @@ class ChatTab(QWidget):
         """Create a branch based on the currently highlighted text"""
         if not self.current_highlighted_text or not self.conversation_id:
             return
+        # Qt separates selected paragraphs with U+2029
+        selected_text = self.current_highlighted_text.replace("\u2029", "\n")
             
-        # If this is already a branch, use its parent_id
-        parent_id = self.parent_id if self.parent_id else self.conversation_id
-        
-        # Create a new conversation with the parent ID
-        branch_title = f"Branch: {self.current_highlighted_text[:30]}..." if len(self.current_highlighted_text) > 30 else f"Branch: {self.current_highlighted_text}"
-        new_convo_id = insert_conversation(parent_id=parent_id, title=branch_title)
-        
-        # Get the parent conversation's history
-        parent_messages = get_conversation_messages(self.conversation_id)
+        # Branches of branches keep their place in the tree
+        parent_id = self.conversation_id
         
         # Check if parent window is available for tab management
         if not self.parent_window:
@@ -626,41 +973,28 @@ class ChatTab(QWidget):
             </div>""")
             return
         
-        # Copy messages to the new branch
-        for message in parent_messages:
-            insert_message(new_convo_id, message['role'], message['content'])
-        
-        # Add the branch to parent's tab widget
-        branch_tab = self.parent_window.add_branch_tab(parent_id, new_convo_id, branch_title)
+        # Create a new conversation with the parent ID that inherits the whole current history
+        branch_title = f"Branch: {self.current_highlighted_text[:30]}..." if len(self.current_highlighted_text) > 30 else f"Branch: {self.current_highlighted_text}"
+        get_writer().flush()
+        history_ids = get_conversation_message_ids(self.conversation_id)
+        fork_message_id = history_ids[-1] if history_ids else None
+        
+        def insert_branch():
+            # One write: a branch is never stored without its selection context
+            new_convo_id = insert_conversation(parent_id=parent_id, title=branch_title, fork_message_id=fork_message_id)
+            # Store the highlighted text in the branch so every request keeps it as context
+            insert_message(new_convo_id, "system", selected_text)
+            return new_convo_id
+        new_convo_id = get_writer().write(insert_branch)
+        
+        # Add the branch to parent's tab widget; its history load shows the stored selection
+        self.parent_window.add_branch_tab(parent_id, new_convo_id, branch_title)
         
         # Notify in the current tab that a branch was created
         self.chat_log.append(f"""<div style="margin: 15px 0; padding: 16px; background-color: #f8f8f8; border-radius: 12px;">
             <span style="color:#000000; font-weight: 500; font-size: 15px;">Branch created with selected text</span>
         </div>""")
         
-        # Add the highlighted text as context to the new branch
-        if branch_tab:
-            # Format the highlighted text specially
-            formatted_highlight = self.current_highlighted_text
-            
-            # Check if it's code by looking for common patterns
-            is_code = False
-            if "```" in formatted_highlight or any(keyword in formatted_highlight for keyword in ["def ", "function", "class ", "import ", "from ", "var ", "const "]):
-                is_code = True
-            
-            if is_code:
-                # Format as code block with special styling
-                branch_tab.chat_log.append(f"""<div style="margin: 15px 0; padding: 16px; background-color: #1e1e1e; border-radius: 12px;">
-                    <b style="color:#ffffff; font-size: 15px; font-weight: 500;">Selected Code Context</b>
-                    <pre style="margin-top: 12px; padding: 15px; background-color: #2d2d2d; border-radius: 8px; color: #e0e0e0; font-family: 'SF Mono', Menlo, Consolas, monospace; font-size: 14px; line-height: 1.6; overflow-x: auto;">{formatted_highlight}</pre>
-                </div>""")
-            else:
-                # Format as regular text with special styling
-                branch_tab.chat_log.append(f"""<div style="margin: 15px 0; padding: 16px; background-color: #f8f8f8; border-radius: 12px;">
-                    <b style="color:#000000; font-size: 15px; font-weight: 500;">Selected Text Context</b>
-                    <div style="margin-top: 8px; padding: 12px; background-color: #ffffff; border: 1px solid #e1e1e1; border-radius: 8px; font-style: italic; line-height: 1.6;">{formatted_highlight}</div>
-                </div>""")
-        
         # Hide the popup button after creating the branch
         self.hide_branch_popup_button()
 
@@ -0,0 +1,96 @@
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem,
+                             QPushButton, QLabel, QFileDialog, QHeaderView)
+from PyQt5.QtCore import Qt, QTimer
+from utils.tracing import get_tracer, TRACING_ENABLED
+
+# How often the open panel re-reads the span histograms
+PANEL_REFRESH_MS = 1000
+
+COLUMNS = ["Span", "Count", "p50 ms", "p95 ms", "p99 ms", "Max ms"]
+
+class PerformancePanel(QWidget):
+    """Live latency percentiles and counts of every traced span (utils/tracing.py)
+
+    A tool window the main window shows and hides with Ctrl+Shift+P. It only
+    reads the histograms while it is visible.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent, Qt.Tool)
+        self.setWindowTitle("Performance")
+        self.resize(640, 480)
+
+        layout = QVBoxLayout(self)
+        self.summary_label = QLabel()
+        layout.addWidget(self.summary_label)
+
+        self.table = QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(0, Qt.AscendingOrder)
+        layout.addWidget(self.table)
+
+        button_layout = QHBoxLayout()
+        reset_button = QPushButton("Reset")
+        reset_button.clicked.connect(self.reset)
+        export_button = QPushButton("Export Chrome trace...")
+        export_button.clicked.connect(self.export_trace)
+        button_layout.addWidget(reset_button)
+        button_layout.addStretch(1)
+        button_layout.addWidget(export_button)
+        layout.addLayout(button_layout)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(PANEL_REFRESH_MS)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        """Show the current percentiles, keeping the user's sort order"""
+        if not TRACING_ENABLED:
+            self.summary_label.setText("Tracing is off (PERF_TRACING=0)")
+            return
+        stats = get_tracer().stats()
+        self.summary_label.setText(f"{len(stats)} spans, {sum(s['count'] for s in stats.values())} calls")
+
+        # Sorting while rows are filled in would move them mid-update
+        self.table.setSortingEnabled(False)
+        self.table.setRowCount(len(stats))
+        for row, (name, span_stats) in enumerate(sorted(stats.items())):
+            values = [name, span_stats["count"], span_stats["p50"], span_stats["p95"],
+                      span_stats["p99"], span_stats["max"]]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                if isinstance(value, float):
+                    # Numbers sort numerically; shown rounded
+                    item.setData(Qt.DisplayRole, round(value, 3))
+                else:
+                    item.setData(Qt.DisplayRole, value)
+                if column:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
+        self.table.setSortingEnabled(True)
+
+    def reset(self):
+        """Start the histograms over, e.g. before repeating an action to measure it"""
+        get_tracer().reset()
+        self.refresh()
+
+    def export_trace(self):
+        """Save the recorded spans for chrome://tracing or ui.perfetto.dev"""
+        path, _ = QFileDialog.getSaveFileName(self, "Export Chrome trace", "trace.json", "JSON (*.json)")
+        if path:
+            try:
+                get_tracer().export_chrome_trace(path)
+            except OSError as e:
+                print(f"Error exporting trace: {str(e)}")
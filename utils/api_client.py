@@ -1,29 +1,472 @@
 import os
+import re
+import json
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from utils.response_cache import get_response_cache, request_key
+from utils.context_builder import get_tokenizer, MESSAGE_OVERHEAD_TOKENS
+from utils.tracing import traced, record_since
 
 load_dotenv()  # Loads variables from .env
 
 API_KEY= os.getenv("OPENAI_API_KEY")
-API_URL = "https://api.openai.com/v1/chat/completions"
+API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
 
-def get_chat_response(conversation_history):
+# Shared HTTP session settings; keep-alive connections are reused across calls
+POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "10"))
+CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "120"))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Get the shared requests.Session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive"
+            })
+            _session = session
+        return _session
+
+def close_session():
+    """Close the shared session and its pooled connections"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+# Retries after a rate limit, server error or dropped connection
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "30"))
+
+# Client-side limits; 0 takes them from the x-ratelimit-limit-* headers of the first reply
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "0"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))
+
+class APIError(Exception):
+    """A chat completions request that failed; str() is shown to the user"""
+    retryable = False
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after  # Seconds the server asked us to wait, if it said
+
+class RateLimitError(APIError):
+    """429: too many requests or tokens for now"""
+    retryable = True
+
+class QuotaExceededError(APIError):
+    """429 for an exhausted account quota; waiting doesn't help"""
+
+class ServerError(APIError):
+    """5xx, or a request the server timed out"""
+    retryable = True
+
+class APIConnectionError(APIError):
+    """The request never got a reply: connection refused or dropped, or a timeout"""
+    retryable = True
+
+class APIResponseError(APIError):
+    """A 200 reply that isn't a chat completion we can read"""
+
+class RequestCancelledError(APIError):
+    """The caller cancelled the request while it waited to be sent or retried"""
+
+def parse_duration(value):
+    """Seconds in an x-ratelimit-reset-* value such as "20ms", "1s" or "6m0.5s"; None if unreadable"""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value or "")
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def retry_after_seconds(headers):
+    """The wait a 429 or 503 asks for, from retry-after-ms or Retry-After; None if absent"""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # An HTTP date rather than a number of seconds
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def error_from_response(status, headers, body):
+    """The APIError for a failed reply, with the server's message when it sent one"""
+    message = body.strip()[:500]
+    code = None
+    try:
+        error = json.loads(body).get('error') or {}
+        message = error.get('message') or message
+        code = error.get('code') or error.get('type')
+    except (ValueError, AttributeError):
+        pass
+    retry_after = retry_after_seconds(headers)
+    text = f"API returned {status}: {message}" if message else f"API returned {status}"
+    
+    if status == 429:
+        if code == "insufficient_quota":
+            return QuotaExceededError(text, status)
+        return RateLimitError(text, status, retry_after)
+    if status >= 500 or status == 408:
+        return ServerError(text, status, retry_after)
+    return APIError(text, status)
+
+class TokenBucket:
+    """Client-side rate limit of per_minute units, refilled continuously
+
+    A limit of 0 only applies waits imposed by the server (block_until).
+    """
+    def __init__(self, per_minute=0):
+        self.per_minute = per_minute
+        self._level = float(per_minute)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take amount from the bucket; returns the seconds to wait before sending"""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._blocked_until - now)
+            if self.per_minute <= 0:
+                return wait
+            rate = self.per_minute / 60
+            self._level = min(self.per_minute, self._level + (now - self._updated) * rate)
+            self._updated = now
+            # A request bigger than the whole bucket waits for a full one, not forever
+            self._level -= min(amount, self.per_minute)
+            if self._level < 0:
+                wait = max(wait, -self._level / rate)
+            return wait
+
+    def sync(self, limit=None, remaining=None, reset=None):
+        """Adopt the server's view from x-ratelimit-limit/remaining/reset headers"""
+        with self._lock:
+            if limit and limit != self.per_minute:
+                self._level = min(self._level, limit) if self.per_minute > 0 else float(limit)
+                self.per_minute = limit
+            if remaining == 0 and reset:
+                # Nothing until the window resets, then the full limit again
+                now = time.monotonic()
+                self._blocked_until = max(self._blocked_until, now + reset)
+                self._level = float(self.per_minute)
+                self._updated = now
+            elif remaining is not None and self.per_minute > 0:
+                self._level = min(self._level, remaining)
+
+def header_number(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+class RequestScheduler:
+    """
+    Paces and retries API requests.
+    
+    Each attempt first takes a request and its estimated tokens from the
+    requests-per-minute and tokens-per-minute buckets, sleeping if they are
+    empty. Rate limit headers on every reply keep the buckets in step with the
+    server. Retryable failures are retried with exponential backoff and full
+    jitter, or after the server's Retry-After when it sends one.
+    """
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._stats = {"attempts": 0, "retries": 0, "failures": 0, "throttle_seconds": 0.0}
+
+    def reserve(self, tokens):
+        """Seconds to wait before sending a request of about this many tokens"""
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        with self._lock:
+            self._stats["attempts"] += 1
+            self._stats["throttle_seconds"] += wait
+        return wait
+
+    def observe(self, headers):
+        """Update the buckets from a reply's x-ratelimit-* headers"""
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            bucket.sync(header_number(headers, f"x-ratelimit-limit-{kind}"),
+                        header_number(headers, f"x-ratelimit-remaining-{kind}"),
+                        parse_duration(headers.get(f"x-ratelimit-reset-{kind}")))
+
+    def retry_delay(self, error, attempt):
+        """
+        Seconds to wait before retrying after error, or None to give up.
+        
+        A Retry-After longer than the backoff cap isn't waited out: the user
+        gets the error rather than a reply that seems to hang.
+        """
+        if not error.retryable or attempt >= self.max_retries:
+            with self._lock:
+                self._stats["failures"] += 1
+            return None
+        if error.retry_after is not None:
+            if error.retry_after > self.backoff_max:
+                with self._lock:
+                    self._stats["failures"] += 1
+                return None
+            delay = error.retry_after
+        else:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        with self._lock:
+            self._stats["retries"] += 1
+        return delay
+
+    def send(self, send, tokens, cancel=None):
+        """
+        Call send() until it returns a successful reply.
+        
+        Args:
+            send (callable): Makes one attempt and returns the requests.Response
+            tokens (int): Estimated tokens the request uses
+            cancel (threading.Event): Set to stop waiting for the rate limits or a retry
+        
+        Returns:
+            requests.Response: The 200 reply
+        
+        Raises:
+            APIError: The last failure, once it isn't retryable or retries run out
+            RequestCancelledError: cancel was set
+        """
+        cancel = cancel or threading.Event()
+        attempt = 0
+        while True:
+            wait = self.reserve(tokens)
+            if cancel.wait(wait) if wait else cancel.is_set():
+                raise RequestCancelledError("Request cancelled")
+            start = time.perf_counter()
+            try:
+                response = send()
+            except requests.RequestException as e:
+                record_since("api.attempt", start, error=type(e).__name__)
+                error = APIConnectionError(f"Could not reach the API: {str(e)}")
+            else:
+                # Until the headers arrive for a streamed request, the whole reply otherwise
+                record_since("api.attempt", start, status=response.status_code)
+                self.observe(response.headers)
+                if response.status_code == 200:
+                    return response
+                error = error_from_response(response.status_code, response.headers, response.text)
+                response.close()
+            delay = self.retry_delay(error, attempt)
+            if delay is None:
+                raise error
+            print(f"Retrying API request in {delay:.1f}s: {str(error)}")
+            if cancel.wait(delay):
+                raise RequestCancelledError("Request cancelled")
+            attempt += 1
+
+    def stats(self):
+        """Attempt, retry and failure counts, and seconds spent waiting on the buckets"""
+        with self._lock:
+            return dict(self._stats)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Get the shared request scheduler; its rate limits cover every request the app sends"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+def estimate_tokens(data):
+    """Tokens a request counts against the tokens-per-minute limit: prompt plus max_tokens"""
+    tokenizer = get_tokenizer()
+    prompt = sum(tokenizer.count(message['content']) + MESSAGE_OVERHEAD_TOKENS for message in data['messages'])
+    return prompt + data.get('max_tokens', 0)
+
+# Returned by parse_stream_line for the event that ends a streamed reply
+STREAM_DONE = object()
+
+def build_headers(stream=False):
+    """Request headers for the chat completions endpoint"""
     headers = {
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
     }
+    if stream:
+        headers["Accept"] = "text/event-stream"
+    return headers
+
+def chat_request(conversation_history, stream=False):
+    """Request body for a chat reply"""
     data = {
         "model": "gpt-3.5-turbo",
         "messages": conversation_history
     }
-    response = requests.post(API_URL, headers=headers, json=data)
-    if response.status_code == 200:
+    if stream:
+        data["stream"] = True
+    return data
+
+def title_request(user_message, assistant_response):
+    """Request body asking for a title for the first exchange of a conversation"""
+    # Create a special prompt to generate a title
+    messages = [
+        {"role": "system", "content": "Generate a concise, descriptive title (3-6 words) for a conversation based on the user's question and assistant's response. Focus on the main topic or intent. Return only the title, no quotes or additional text."},
+        {"role": "user", "content": f"User question: {user_message}\n\nAssistant response: {assistant_response}"}
+    ]
+    
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": messages,
+        "max_tokens": 20,  # Limit to a short response
+        "temperature": 0.7  # Slightly creative but not too random
+    }
+
+def clean_title(content):
+    """The title from a title_request reply, without surrounding whitespace or quotes"""
+    return content.strip().strip('"\'')
+
+def parse_stream_line(line):
+    """Parse one line of a streamed reply
+
+    Server-sent events: one "data: <json>" line per chunk, blank lines between.
+
+    Returns:
+        The piece of reply text in the line, STREAM_DONE at the end of the
+        reply, or None for lines without text
+    """
+    if not line.startswith("data:"):
+        return None
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return STREAM_DONE
+    try:
+        chunk = json.loads(payload)
+        if not chunk.get('choices'):
+            return None
+        return chunk['choices'][0].get('delta', {}).get('content') or None
+    except (ValueError, AttributeError, KeyError, IndexError, TypeError):
+        raise APIResponseError(f"Unreadable chunk in the streamed reply: {payload[:200]}")
+
+def reply_content(response):
+    """The message text of a complete (not streamed) reply"""
+    try:
         return response.json()['choices'][0]['message']['content']
-    else:
-        print("Error from API:", response.text)
-        return "Sorry, something went wrong."
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise APIResponseError(f"Unexpected reply from the API: {type(e).__name__}: {str(e)}")
+
+@traced("api.get_chat_response")
+def get_chat_response(conversation_history, cancel=None):
+    """
+    Get the assistant's complete reply.
+    
+    Args:
+        conversation_history (list): Messages in the chat completions format
+        cancel (threading.Event): Set to give up while waiting to send or retry
+    
+    Returns:
+        str: The reply text
+    
+    Raises:
+        APIError: The request failed after any retries
+    """
+    headers = build_headers()
+    data = chat_request(conversation_history)
+    cache = get_response_cache()
+    if cache:
+        key = request_key(API_URL, data)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    
+    response = get_scheduler().send(
+        lambda: get_session().post(API_URL, headers=headers, json=data, timeout=TIMEOUT),
+        estimate_tokens(data), cancel)
+    content = reply_content(response)
+    if cache:
+        cache.put(key, content)
+    return content
+
+@traced("api.stream_chat_response")
+def stream_chat_response(conversation_history, cancel=None):
+    """
+    Stream the assistant's reply as it is generated.
+    
+    Failures before the reply starts are retried; once text has been yielded
+    a dropped connection is raised rather than starting the reply over.
+    
+    Args:
+        conversation_history (list): Messages in the chat completions format
+        cancel (threading.Event): Set to give up while waiting to send or retry
+    
+    Yields:
+        str: Pieces of the reply text, in order, as the server sends them
+    
+    Raises:
+        APIError: The request failed
+    """
+    start = time.perf_counter()
+    headers = build_headers(stream=True)
+    data = chat_request(conversation_history, stream=True)
+    cache = get_response_cache()
+    if cache:
+        key = request_key(API_URL, data)
+        cached = cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    
+    chunks = []
+    response = get_scheduler().send(
+        lambda: get_session().post(API_URL, headers=headers, json=data, stream=True, timeout=TIMEOUT),
+        estimate_tokens(data), cancel)
+    with response:
+        try:
+            for raw_line in response.iter_lines():
+                delta = parse_stream_line(raw_line.decode('utf-8'))
+                if delta is STREAM_DONE:
+                    # Only a reply that arrived in full is cached
+                    if cache and chunks:
+                        cache.put(key, "".join(chunks))
+                    break
+                if delta:
+                    if not chunks:
+                        record_since("api.stream_chat_response.first_token", start)
+                    chunks.append(delta)
+                    yield delta
+        except requests.RequestException as e:
+            raise APIConnectionError(f"Connection lost while receiving the reply: {str(e)}")
 
-def generate_title_from_conversation(user_message, assistant_response):
+@traced("api.generate_title")
+def generate_title_from_conversation(user_message, assistant_response, cancel=None):
     """
     Generate a concise, descriptive title for a conversation based on the first 
     user message and assistant response.
@@ -31,38 +474,29 @@ def generate_title_from_conversation(user_message, assistant_response):
     Args:
         user_message (str): The first message from the user
         assistant_response (str): The first response from the assistant
+        cancel (threading.Event): Set to give up while waiting to send or retry
     
     Returns:
         str: A concise title for the conversation
-    """
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
     
-    # Create a special prompt to generate a title
-    messages = [
-        {"role": "system", "content": "Generate a concise, descriptive title (3-6 words) for a conversation based on the user's question and assistant's response. Focus on the main topic or intent. Return only the title, no quotes or additional text."},
-        {"role": "user", "content": f"User question: {user_message}\n\nAssistant response: {assistant_response}"}
-    ]
+    Raises:
+        APIError: The request failed after any retries
+    """
+    headers = build_headers()
+    data = title_request(user_message, assistant_response)
     
-    data = {
-        "model": "gpt-3.5-turbo",
-        "messages": messages,
-        "max_tokens": 20,  # Limit to a short response
-        "temperature": 0.7  # Slightly creative but not too random
-    }
+    cache = get_response_cache()
+    if cache:
+        key = request_key(API_URL, data)
+        cached = cache.get(key)
+        if cached is not None:
+            return clean_title(cached)
     
-    try:
-        response = requests.post(API_URL, headers=headers, json=data)
-        if response.status_code == 200:
-            title = response.json()['choices'][0]['message']['content'].strip()
-            # Remove any quotes if present
-            title = title.strip('"\'')
-            return title
-        else:
-            print("Error generating title:", response.text)
-            return "New Conversation"
-    except Exception as e:
-        print(f"Exception generating title: {str(e)}")
-        return "New Conversation"
+    response = get_scheduler().send(
+        lambda: get_session().post(API_URL, headers=headers, json=data, timeout=TIMEOUT),
+        estimate_tokens(data), cancel)
+    content = reply_content(response)
+    if cache:
+        cache.put(key, content)
+    # Remove any quotes if present
+    return clean_title(content)
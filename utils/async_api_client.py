@@ -0,0 +1,185 @@
+import os
+import time
+import asyncio
+import httpx
+from utils import api_client
+from utils.api_client import (build_headers, chat_request, title_request, clean_title,
+                              parse_stream_line, STREAM_DONE, get_scheduler, estimate_tokens,
+                              error_from_response, reply_content, APIConnectionError,
+                              RequestCancelledError)
+from utils.response_cache import get_response_cache, request_key
+from utils.tracing import traced, record_since
+
+# Requests a gather_bounded() call keeps in flight at once
+MAX_CONCURRENT_ASYNC_REQUESTS = int(os.getenv("MAX_CONCURRENT_ASYNC_REQUESTS", "8"))
+
+# How often a rate-limit or backoff wait checks whether its request was cancelled
+CANCEL_POLL_INTERVAL = 0.05
+
+def create_client():
+    """An httpx.AsyncClient with the same pooling and timeouts as the shared requests session
+
+    Use it as an async context manager, on the event loop that runs the requests.
+    """
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(api_client.READ_TIMEOUT, connect=api_client.CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=api_client.POOL_SIZE,
+                            max_keepalive_connections=api_client.POOL_SIZE),
+    )
+
+async def sleep_unless_cancelled(delay, cancel=None):
+    """asyncio.sleep(delay) that ends early once cancel is set; True if it was"""
+    if cancel is None:
+        await asyncio.sleep(delay)
+        return False
+    deadline = time.monotonic() + delay
+    while not cancel.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(remaining, CANCEL_POLL_INTERVAL))
+    return True
+
+async def send_with_retries(send, tokens, scheduler=None, cancel=None):
+    """
+    Async RequestScheduler.send: await send() until it returns a successful reply.
+    
+    The shared scheduler's rate limits also cover these requests.
+    
+    Args:
+        send (callable): Makes one attempt and returns an awaitable httpx.Response
+        tokens (int): Estimated tokens the request uses
+        scheduler (RequestScheduler): Defaults to the shared scheduler
+        cancel (threading.Event): Set to stop waiting for the rate limits or a retry
+    
+    Returns:
+        httpx.Response: The 200 reply
+    
+    Raises:
+        APIError: The last failure, once it isn't retryable or retries run out
+        RequestCancelledError: cancel was set
+    """
+    scheduler = scheduler or get_scheduler()
+    attempt = 0
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise RequestCancelledError("Request cancelled")
+        wait = scheduler.reserve(tokens)
+        if wait and await sleep_unless_cancelled(wait, cancel):
+            raise RequestCancelledError("Request cancelled")
+        start = time.perf_counter()
+        try:
+            response = await send()
+        except httpx.TransportError as e:
+            record_since("api.attempt", start, error=type(e).__name__)
+            error = APIConnectionError(f"Could not reach the API: {str(e)}")
+        else:
+            record_since("api.attempt", start, status=response.status_code)
+            scheduler.observe(response.headers)
+            if response.status_code == 200:
+                return response
+            await response.aread()
+            error = error_from_response(response.status_code, response.headers, response.text)
+            await response.aclose()
+        delay = scheduler.retry_delay(error, attempt)
+        if delay is None:
+            raise error
+        print(f"Retrying API request in {delay:.1f}s: {str(error)}")
+        if await sleep_unless_cancelled(delay, cancel):
+            raise RequestCancelledError("Request cancelled")
+        attempt += 1
+
+@traced("api.get_chat_response")
+async def get_chat_response(client, conversation_history, cancel=None):
+    """Async get_chat_response: the assistant's complete reply"""
+    data = chat_request(conversation_history)
+    cache = get_response_cache()
+    if cache:
+        key = request_key(api_client.API_URL, data)
+        # A memory miss reads the SQLite table, so look it up off the event loop
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return cached
+
+    response = await send_with_retries(
+        lambda: client.post(api_client.API_URL, headers=build_headers(), json=data),
+        estimate_tokens(data), cancel=cancel)
+    content = reply_content(response)
+    if cache:
+        cache.put(key, content)
+    return content
+
+@traced("api.stream_chat_response")
+async def stream_chat_response(client, conversation_history, cancel=None):
+    """Async stream_chat_response: yields pieces of the reply as they arrive"""
+    start = time.perf_counter()
+    data = chat_request(conversation_history, stream=True)
+    cache = get_response_cache()
+    if cache:
+        key = request_key(api_client.API_URL, data)
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            yield cached
+            return
+
+    def send():
+        request = client.build_request("POST", api_client.API_URL, headers=build_headers(stream=True), json=data)
+        return client.send(request, stream=True)
+
+    chunks = []
+    response = await send_with_retries(send, estimate_tokens(data), cancel=cancel)
+    try:
+        async for line in response.aiter_lines():
+            delta = parse_stream_line(line)
+            if delta is STREAM_DONE:
+                # Only a reply that arrived in full is cached
+                if cache and chunks:
+                    cache.put(key, "".join(chunks))
+                break
+            if delta:
+                if not chunks:
+                    record_since("api.stream_chat_response.first_token", start)
+                chunks.append(delta)
+                yield delta
+    except httpx.TransportError as e:
+        raise APIConnectionError(f"Connection lost while receiving the reply: {str(e)}")
+    finally:
+        await response.aclose()
+
+@traced("api.generate_title")
+async def generate_title_from_conversation(client, user_message, assistant_response, cancel=None):
+    """Async generate_title_from_conversation: a short title for the first exchange"""
+    data = title_request(user_message, assistant_response)
+    cache = get_response_cache()
+    if cache:
+        key = request_key(api_client.API_URL, data)
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return clean_title(cached)
+
+    response = await send_with_retries(
+        lambda: client.post(api_client.API_URL, headers=build_headers(), json=data),
+        estimate_tokens(data), cancel=cancel)
+    content = reply_content(response)
+    if cache:
+        cache.put(key, content)
+    return clean_title(content)
+
+async def gather_bounded(coroutines, limit=MAX_CONCURRENT_ASYNC_REQUESTS):
+    """
+    Run coroutines concurrently with at most limit of them running at a time.
+
+    Args:
+        coroutines (iterable): Coroutine objects, e.g. one request per branch
+        limit (int): Maximum number running at once
+
+    Returns:
+        list: Each coroutine's result, or the exception it raised, in order
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines), return_exceptions=True)
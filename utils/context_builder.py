@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+from db.database import (get_conversation_page, get_context_messages_by_role,
+                         get_token_counts, save_token_counts)
+from db.writer import get_writer
+
+# Tokens of history sent with each request, leaving room in the model's
+# context window for the reply
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+
+# Optional system prompt sent ahead of every conversation
+SYSTEM_PROMPT = os.getenv("OPENAI_SYSTEM_PROMPT", "")
+
+# Role markers and separators the chat format adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# History rows read from the database per step while filling the budget
+CONTEXT_PAGE_SIZE = 100
+
+# Branches created from a text selection store the selection as a 'system' row
+SELECTION_CONTEXT_PROMPT = "The user selected the following text from the conversation and wants to focus on it:\n\n"
+
+class ApproximateTokenizer:
+    """Dependency-free token estimate: words and punctuation, about 4 characters per token"""
+    name = "approx-v1"
+    _pieces = re.compile(r"\w+|[^\w\s]")
+
+    def count(self, text):
+        return sum((len(piece) + 3) // 4 for piece in self._pieces.findall(text))
+
+class TiktokenTokenizer:
+    """Exact counts using OpenAI's tiktoken, if it is installed"""
+    def __init__(self, encoding_name="cl100k_base"):
+        import tiktoken
+        self._encoding = tiktoken.get_encoding(encoding_name)
+        self.name = f"tiktoken-{encoding_name}"
+
+    def count(self, text):
+        return len(self._encoding.encode(text))
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """Get the tokenizer used for budgeting: tiktoken when available, else the estimate
+
+    tiktoken downloads its encoding on first use; if that fails (e.g. no
+    network) the estimate is used for the rest of the session.
+    """
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            try:
+                _tokenizer = TiktokenTokenizer()
+            except ImportError:
+                _tokenizer = ApproximateTokenizer()
+            except Exception as e:
+                print(f"Error loading tiktoken encoding, estimating token counts instead: {str(e)}")
+                _tokenizer = ApproximateTokenizer()
+        return _tokenizer
+
+def set_tokenizer(tokenizer):
+    """Use a different tokenizer; it needs a unique name and a count(text) method"""
+    global _tokenizer
+    with _tokenizer_lock:
+        _tokenizer = tokenizer
+
+def count_message_tokens(rows, tokenizer):
+    """Token counts for (id, role, text) rows, from the database cache where possible"""
+    counts = get_token_counts([row[0] for row in rows], tokenizer.name)
+    missing = {message_id: tokenizer.count(text) for message_id, _, text in rows if message_id not in counts}
+    if missing:
+        # Only a cache: nothing waits for the write
+        get_writer().submit(save_token_counts, tokenizer.name, missing)
+        counts.update(missing)
+    return counts
+
+def build_context(conversation_id, budget=None, tokenizer=None, system_prompt=None):
+    """
+    Build the message list for a chat request that fits within a token budget.
+
+    The system prompt and any branch-selection context are always included;
+    the rest of the history is added newest first until the budget is spent,
+    so the oldest turns are the ones dropped. The latest message is always
+    sent, even if it alone exceeds the budget.
+
+    Args:
+        conversation_id (int): Conversation (or branch) to build the context for
+        budget (int): Token budget; defaults to CONTEXT_TOKEN_BUDGET
+        tokenizer: Object with name and count(text); defaults to get_tokenizer()
+        system_prompt (str): Defaults to SYSTEM_PROMPT; empty to send none
+
+    Returns:
+        list: Messages in the chat completions format, oldest first
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    tokenizer = tokenizer or get_tokenizer()
+    system_prompt = SYSTEM_PROMPT if system_prompt is None else system_prompt
+
+    pinned = []
+    used = 0
+    if system_prompt:
+        pinned.append({'role': 'system', 'content': system_prompt})
+        used += tokenizer.count(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+
+    selection_rows = get_context_messages_by_role(conversation_id, 'system')
+    selection_counts = count_message_tokens(selection_rows, tokenizer)
+    for message_id, _, text in selection_rows:
+        pinned.append({'role': 'system', 'content': SELECTION_CONTEXT_PROMPT + text})
+        used += selection_counts[message_id] + tokenizer.count(SELECTION_CONTEXT_PROMPT) + MESSAGE_OVERHEAD_TOKENS
+
+    # Walk back from the newest message one page at a time until the budget is spent
+    recent = []
+    before_id = None
+    while True:
+        rows = get_conversation_page(conversation_id, CONTEXT_PAGE_SIZE, before_id)
+        if not rows:
+            break
+        counts = count_message_tokens(rows, tokenizer)
+        for message_id, role, text in reversed(rows):
+            if role == 'system':
+                continue  # Already pinned above
+            cost = counts[message_id] + MESSAGE_OVERHEAD_TOKENS
+            if recent and used + cost > budget:
+                recent.reverse()
+                return pinned + recent
+            used += cost
+            recent.append({'role': role, 'content': text})
+        before_id = rows[0][0]
+
+    recent.reverse()
+    return pinned + recent
@@ -0,0 +1,251 @@
+import os
+import time
+import html
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor
+from db.database import (get_rendered_html, get_rendered_html_many, save_rendered_html,
+                         touch_rendered_html, prune_rendered_html)
+from db.writer import get_writer
+from utils.tracing import span, record_since
+
+# Rendered messages kept in memory per renderer
+RENDER_CACHE_SIZE = 2000
+
+# Rendered messages kept in the rendered_html table; the least recently used are evicted beyond this
+RENDERED_HTML_MAX_ROWS = int(os.getenv("RENDERED_HTML_MAX_ROWS", "20000"))
+
+# Worker processes for highlighting code blocks; Pygments is CPU-bound and
+# holds the GIL, so threads would still stall the GUI
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(min(4, os.cpu_count() or 1))))
+
+def content_key(text):
+    """Cache key for a message body"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def needs_highlighting(text):
+    """Whether rendering the text runs Pygments; only fenced code blocks do"""
+    return "```" in text
+
+def plain_text_html(text):
+    """Escaped text with its line breaks, shown until the rendered HTML is ready"""
+    return html.escape(text).replace("\n", "<br>")
+
+_worker_parsers = {}
+
+def render_markdown(extensions, text):
+    """Convert markdown text to HTML; runs in a render worker process"""
+    import markdown
+    key = tuple(extensions)
+    parser = _worker_parsers.get(key)
+    if parser is None:
+        parser = _worker_parsers[key] = markdown.Markdown(extensions=list(extensions))
+    return parser.reset().convert(text)
+
+_pool = None
+_pool_stopped = False
+_pool_lock = threading.Lock()
+
+def get_render_pool():
+    """Get the shared render process pool, created on first use
+
+    Returns None once the pool has been shut down, or has failed and rendering
+    has fallen back to the calling thread.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None and not _pool_stopped and RENDER_PROCESSES > 0:
+            # multiprocessing is only imported once something needs highlighting
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # Spawn rather than fork: the GUI process is already running threads
+            _pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def shutdown_render_pool():
+    """Stop the render workers; called when the application quits"""
+    global _pool, _pool_stopped
+    with _pool_lock:
+        _pool_stopped = True
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+class MarkdownRenderer:
+    """Markdown to HTML for chat messages, memoized by content hash
+
+    Results are kept in an in-memory LRU backed by the rendered_html table,
+    so a message is only converted once per extension set and theme, across
+    tabs and across runs.
+    """
+    def __init__(self, extensions, theme="", cache_size=RENDER_CACHE_SIZE):
+        # Markdown and its extensions load with the first renderer, not at startup
+        import markdown
+        self.extensions = list(extensions)
+        # Cached HTML is only reused for the same extensions, theme and markdown version
+        variant_source = repr((self.extensions, theme, markdown.__version__))
+        self.variant = hashlib.sha256(variant_source.encode('utf-8')).hexdigest()[:16]
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._in_flight = {}  # content key -> callbacks waiting for the render
+        self._touched = []  # content keys read from the table, not yet marked as used there
+
+    def _parser(self):
+        """This thread's Markdown instance; building one loads every extension"""
+        parser = getattr(self._local, "parser", None)
+        if parser is None:
+            import markdown
+            parser = markdown.Markdown(extensions=self.extensions)
+            self._local.parser = parser
+        return parser
+
+    def cached(self, text):
+        """Return the rendered HTML if it is already cached, otherwise None"""
+        return self._lookup(content_key(text))
+
+    def prefetch(self, texts):
+        """Load the cached HTML of several messages from the table in one query
+
+        Call it before rendering a page of history, so each message that
+        misses the in-memory LRU doesn't do its own lookup.
+        """
+        with self._lock:
+            keys = list({key for key in map(content_key, texts) if key not in self._cache})
+        if not keys:
+            return
+        found = get_rendered_html_many(keys, self.variant)
+        for key, html in found.items():
+            self._remember(key, html)
+        self._mark_used(list(found))
+
+    def render(self, text):
+        """Convert markdown text to HTML, from the cache when possible"""
+        key = content_key(text)
+        html = self._lookup(key)
+        if html is None:
+            with span("render.markdown", chars=len(text)):
+                html = self._parser().reset().convert(text)
+            get_writer().submit(save_rendered_html, key, self.variant, html, time.time())
+            self._remember(key, html)
+        return html
+
+    def render_async(self, text, callback):
+        """Render in the background if the text has code to highlight
+
+        Returns the HTML straight away when it is cached or cheap to produce.
+        Otherwise returns None, and callback(html) is called from a pool
+        thread once a worker process has rendered it; renders of the same
+        text are shared.
+        """
+        key = content_key(text)
+        html = self._lookup(key)
+        if html is not None:
+            return html
+        pool = get_render_pool()
+        if pool is None or not needs_highlighting(text):
+            return self.render(text)
+
+        with self._lock:
+            waiting = self._in_flight.get(key)
+            if waiting is not None:
+                waiting.append(callback)
+                return None
+            self._in_flight[key] = [callback]
+        start = time.perf_counter()
+        try:
+            future = pool.submit(render_markdown, self.extensions, text)
+        except (BrokenExecutor, RuntimeError) as e:
+            # A worker died or the pool was shut down: render on this thread from now on
+            print(f"Error starting background render: {str(e)}")
+            shutdown_render_pool()
+            with self._lock:
+                self._in_flight.pop(key, None)
+            return self.render(text)
+        future.add_done_callback(lambda future: self._finish(key, text, future, start))
+        return None
+
+    def busy(self):
+        """Whether any background renders are still running"""
+        with self._lock:
+            return bool(self._in_flight)
+
+    def _finish(self, key, text, future, start):
+        # Waiting for a worker plus rendering in it
+        record_since("render.pool", start, chars=len(text))
+        if future.cancelled():
+            # The application is quitting; nobody is waiting for the HTML
+            with self._lock:
+                self._in_flight.pop(key, None)
+            return
+        try:
+            html = future.result()
+        except Exception as e:
+            # A worker died: render this one here, and the rest on the calling thread
+            print(f"Error rendering markdown in the background: {str(e)}")
+            if isinstance(e, BrokenExecutor):
+                shutdown_render_pool()
+            html = self._parser().reset().convert(text)
+        get_writer().submit(save_rendered_html, key, self.variant, html, time.time())
+        self._remember(key, html)
+        with self._lock:
+            callbacks = self._in_flight.pop(key, [])
+        for callback in callbacks:
+            callback(html)
+
+    def _lookup(self, key):
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                return html
+        html = get_rendered_html(key, self.variant)
+        if html is not None:
+            self._remember(key, html)
+            self._mark_used([key])
+        return html
+
+    def _mark_used(self, keys):
+        # One write marks every row read while the last one was queued
+        if not keys:
+            return
+        with self._lock:
+            first = not self._touched
+            self._touched.extend(keys)
+        if first:
+            get_writer().submit(self._touch)
+
+    def _touch(self):
+        # Runs on the writer thread
+        with self._lock:
+            keys, self._touched = self._touched, []
+        touch_rendered_html(keys, self.variant, time.time())
+
+    def _remember(self, key, html):
+        with self._lock:
+            self._cache[key] = html
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+def get_renderer(extensions, theme=""):
+    """Get the shared renderer for an extension set and theme
+
+    The first one also trims the rendered_html table: HTML of any other
+    variant (an old theme or extension set) goes, and the rest is capped at
+    RENDERED_HTML_MAX_ROWS.
+    """
+    key = (tuple(extensions), theme)
+    with _renderers_lock:
+        if key not in _renderers:
+            renderer = MarkdownRenderer(extensions, theme)
+            if not _renderers:
+                get_writer().submit(prune_rendered_html, renderer.variant, RENDERED_HTML_MAX_ROWS)
+            _renderers[key] = renderer
+        return _renderers[key]
@@ -0,0 +1,117 @@
+import os
+import queue
+import itertools
+import threading
+
+# Lower values run first: chat replies go ahead of title generation
+PRIORITY_CHAT = 0
+PRIORITY_TITLE = 10
+
+# Cap on outbound API requests running at the same time
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "4"))
+
+class RequestHandle:
+    """A submitted request; the running function polls it to notice cancellation"""
+    def __init__(self, owner=None, key=None):
+        self.owner = owner
+        self.key = key
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+
+    def cancel(self):
+        """Skip the request if it hasn't started, or ask the running function to stop"""
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def cancel_event(self):
+        """Event set by cancel(), for waits that should end as soon as it is"""
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+class RequestExecutor:
+    """Runs API calls on a fixed pool of worker threads, highest priority first
+
+    Submitted functions are called as fn(handle, *args) on a worker thread and
+    report results themselves (ChatTab emits Qt signals). A request submitted
+    with the same owner and key as a pending one supersedes and cancels it.
+    """
+    def __init__(self, max_workers=MAX_CONCURRENT_REQUESTS):
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()  # FIFO among equal priorities
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._shutdown = False
+        self._workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._work, name=f"api-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, fn, *args, priority=PRIORITY_CHAT, owner=None, key=None):
+        """Queue fn(handle, *args) and return its RequestHandle"""
+        handle = RequestHandle(owner, key)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Request executor has been shut down")
+            if key is not None:
+                for other in self._pending:
+                    if other.owner is owner and other.key == key:
+                        other.cancel()
+            self._pending.add(handle)
+        self._queue.put((priority, next(self._order), handle, fn, args))
+        return handle
+
+    def cancel_owner(self, owner):
+        """Cancel every pending or running request submitted for owner (e.g. a closed tab)"""
+        with self._lock:
+            for handle in self._pending:
+                if handle.owner is owner:
+                    handle.cancel()
+
+    def shutdown(self):
+        """Cancel all requests and stop the workers once their current call returns"""
+        with self._lock:
+            self._shutdown = True
+            for handle in self._pending:
+                handle.cancel()
+        for _ in self._workers:
+            self._queue.put((float('inf'), next(self._order), None, None, None))
+
+    def _work(self):
+        while True:
+            _, _, handle, fn, args = self._queue.get()
+            if handle is None:
+                return
+            try:
+                if not handle.cancelled():
+                    fn(handle, *args)
+            except Exception as e:
+                print(f"Error in API request: {str(e)}")
+            finally:
+                handle._done.set()
+                with self._lock:
+                    self._pending.discard(handle)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """Get the shared request executor, starting its workers on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = RequestExecutor()
+        return _executor
+
+def shutdown_executor():
+    """Stop the shared executor; called when the application quits"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from db.database import get_cached_response, touch_cached_response, save_cached_response
+from db.writer import get_writer
+
+# Off unless asked for: a cached chat reply is reused instead of sampling a new one
+RESPONSE_CACHE_ENABLED = os.getenv("OPENAI_RESPONSE_CACHE", "0").lower() in ("1", "true", "yes")
+
+# Seconds a cached response stays valid
+RESPONSE_CACHE_TTL = float(os.getenv("OPENAI_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Entries kept in the database; the least recently used are evicted beyond this
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("OPENAI_RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+
+# Entries also kept in memory, so repeated calls don't touch the database
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+
+def request_key(url, data):
+    """Content hash of a request: endpoint, model, parameters and messages
+
+    Streamed and non-streamed requests for the same completion share a key.
+    """
+    request = {name: value for name, value in data.items() if name != "stream"}
+    canonical = json.dumps([url, request], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Cache of successful API responses in the response_cache table
+
+    A small in-memory LRU sits in front of the table. Hit, miss and eviction
+    counts are kept for stats().
+    """
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()  # key -> (created_at, response)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "memory_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def get(self, key):
+        """Return the cached response for a request key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] >= now - self.ttl:
+                self._memory.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["memory_hits"] += 1
+                return entry[1]
+
+        cached = get_cached_response(key, now - self.ttl)
+        if cached is None:
+            with self._lock:
+                self._memory.pop(key, None)
+                self._stats["misses"] += 1
+            return None
+        # Marked as used on the writer thread; the hit doesn't wait for it
+        get_writer().submit(touch_cached_response, key, now)
+        response, created_at = cached
+        with self._lock:
+            self._stats["hits"] += 1
+            self._remember(key, created_at, response)
+        return response
+
+    def put(self, key, response):
+        """Cache a successful response; it is written to the table on the writer thread"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            self._stats["stores"] += 1
+        saved = get_writer().submit(save_cached_response, key, response, now, now - self.ttl, self.max_entries)
+        saved.add_done_callback(self._count_evictions)
+
+    def _count_evictions(self, saved):
+        if saved.exception() is not None:
+            print(f"Error caching response: {str(saved.exception())}")
+            return
+        with self._lock:
+            self._stats["evictions"] += saved.result()
+
+    def stats(self):
+        """Hit/miss counts since startup, with the hit rate"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _remember(self, key, created_at, response):
+        self._memory[key] = (created_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Get the shared response cache, or None if caching is turned off"""
+    global _cache
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -0,0 +1,228 @@
+import os
+import math
+import json
+import sys
+import time
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Set PERF_TRACING=0 to leave functions unwrapped and spans as no-ops
+TRACING_ENABLED = os.getenv("PERF_TRACING", "1").lower() not in ("0", "false", "no")
+
+# Most recent spans kept for the Chrome trace export; older ones are dropped
+TRACE_BUFFER_SIZE = int(os.getenv("PERF_TRACE_BUFFER_SIZE", "100000"))
+
+# Histogram buckets grow by this factor from 1 µs, so percentiles are within about 5%
+_BUCKET_FLOOR = 1e-6
+_BUCKET_GROWTH = 1.1
+_LOG_GROWTH = math.log(_BUCKET_GROWTH)
+
+# Code flags telling generator, coroutine and async generator functions apart,
+# as inspect checks them; importing inspect itself would slow down startup
+_CO_GENERATOR = 0x20
+_CO_COROUTINE = 0x80
+_CO_ASYNC_GENERATOR = 0x200
+
+class Histogram:
+    """Latencies of one kind of span in log-spaced buckets; count, total, min and max are exact"""
+    def __init__(self):
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = int(math.log(seconds / _BUCKET_FLOOR) / _LOG_GROWTH) if seconds > _BUCKET_FLOOR else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """Seconds that percent of the spans took at most"""
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Middle of the bucket, kept inside what was actually seen
+                estimate = _BUCKET_FLOOR * _BUCKET_GROWTH ** (index + 0.5)
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+class Tracer:
+    """
+    Collects timed spans from any thread.
+
+    Every span updates a histogram for its name; the most recent
+    TRACE_BUFFER_SIZE spans are also kept as events for export_chrome_trace().
+    """
+    def __init__(self, buffer_size=TRACE_BUFFER_SIZE):
+        self._lock = threading.Lock()
+        self._histograms = {}  # span name -> Histogram
+        self._events = deque(maxlen=buffer_size)  # (name, start, duration, thread id, task id, args)
+        self._thread_names = {}
+        self._origin = time.perf_counter()
+
+    def record(self, name, start, duration, args=None, task_id=None):
+        """
+        Add a span that started at perf_counter() time start and lasted duration seconds.
+
+        Spans of concurrent asyncio tasks overlap on one thread; give them the
+        task's id and they are exported as async events on their own tracks.
+        """
+        tid = threading.get_ident()
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(duration)
+            if tid not in self._thread_names:
+                self._thread_names[tid] = threading.current_thread().name
+            self._events.append((name, start, duration, tid, task_id, args))
+
+    def stats(self):
+        """{span name: {count, mean, p50, p95, p99, max}} with times in milliseconds"""
+        with self._lock:
+            return {name: {
+                "count": histogram.count,
+                "mean": histogram.total / histogram.count * 1000,
+                "p50": histogram.percentile(50) * 1000,
+                "p95": histogram.percentile(95) * 1000,
+                "p99": histogram.percentile(99) * 1000,
+                "max": histogram.max * 1000,
+            } for name, histogram in self._histograms.items()}
+
+    def reset(self):
+        """Forget every span recorded so far"""
+        with self._lock:
+            self._histograms.clear()
+            self._events.clear()
+
+    def chrome_trace(self):
+        """The recorded spans in Chrome's trace event format (chrome://tracing, Perfetto)"""
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+        trace = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}}
+                 for tid, thread_name in thread_names.items()]
+        for name, start, duration, tid, task_id, args in events:
+            category = name.split(".", 1)[0]
+            ts = round((start - self._origin) * 1e6, 3)
+            if task_id is None:
+                event = {"name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+                         "ts": ts, "dur": round(duration * 1e6, 3)}
+                if args:
+                    event["args"] = args
+                trace.append(event)
+            else:
+                begin = {"name": name, "cat": category, "ph": "b", "pid": pid, "tid": tid, "id": task_id, "ts": ts}
+                if args:
+                    begin["args"] = args
+                trace.append(begin)
+                trace.append({"name": name, "cat": category, "ph": "e", "pid": pid, "tid": tid, "id": task_id,
+                              "ts": round(ts + duration * 1e6, 3)})
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path):
+        """Write the recorded spans to path as Chrome trace event JSON"""
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+_tracer = Tracer()
+
+def get_tracer():
+    """Get the process-wide tracer"""
+    return _tracer
+
+@contextmanager
+def span(name, **args):
+    """Time the with block as a span called name; keyword arguments are shown in the trace"""
+    if not TRACING_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _tracer.record(name, start, time.perf_counter() - start, args or None)
+
+def traced(name):
+    """
+    Decorator recording each call of a function as a span called name.
+
+    For a generator function the span covers the whole iteration, from the
+    first item requested until it is exhausted or closed. Coroutine functions
+    and async generators are timed the same way, as spans of their task.
+    """
+    def decorate(function):
+        if not TRACING_ENABLED:
+            return function
+        flags = function.__code__.co_flags
+        if flags & _CO_COROUTINE:
+            @functools.wraps(function)
+            async def traced_coroutine(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    _tracer.record(name, start, time.perf_counter() - start, task_id=_task_id())
+            return traced_coroutine
+        if flags & _CO_ASYNC_GENERATOR:
+            @functools.wraps(function)
+            async def traced_async_generator(*args, **kwargs):
+                start = time.perf_counter()
+                generator = function(*args, **kwargs)
+                try:
+                    async for item in generator:
+                        yield item
+                finally:
+                    # Run the generator's own cleanup now, not when it is garbage collected
+                    await generator.aclose()
+                    _tracer.record(name, start, time.perf_counter() - start, task_id=_task_id())
+            return traced_async_generator
+        if flags & _CO_GENERATOR:
+            @functools.wraps(function)
+            def traced_generator(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    yield from function(*args, **kwargs)
+                finally:
+                    _tracer.record(name, start, time.perf_counter() - start)
+            return traced_generator
+
+        @functools.wraps(function)
+        def traced_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _tracer.record(name, start, time.perf_counter() - start)
+        return traced_function
+    return decorate
+
+def _task_id():
+    """Id of the running asyncio task, or None outside one"""
+    # Only look if something else has imported asyncio; importing it here would slow startup
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return None
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        return None
+    return id(task) if task is not None else None
+
+def record_since(name, start, **args):
+    """Record a span from perf_counter() time start until now, e.g. time to the first streamed token"""
+    if TRACING_ENABLED:
+        _tracer.record(name, start, time.perf_counter() - start, args or None, _task_id())